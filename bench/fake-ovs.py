@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# Stand-in for ovs-vsctl, ovn-nbctl, ovs-ofctl and ip, used by
+# ovn-k8-bench.py, which runs it as "fake-ovs.py PROGRAM ARGS...".
+# ovs-vsctl keeps a small Open_vSwitch database in a JSON file in
+# $OVN_K8_BENCH_DIR; the other programs only accept their input. Every run
+# first sleeps for $OVN_K8_BENCH_EXEC_LATENCY milliseconds.
+import fcntl
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.environ.get("OVN_K8_BENCH_DIR", ".")
+EXEC_LATENCY = float(os.environ.get("OVN_K8_BENCH_EXEC_LATENCY", "0"))
+OVSDB = os.path.join(BENCH_DIR, "ovsdb.json")
+
+
+def datum(value):
+    # Formats a column value the way --data=json does.
+    if isinstance(value, dict):
+        return ["map", [[k, v] for k, v in sorted(value.items())]]
+    if value is None:
+        return ["set", []]
+    return value
+
+
+def column_key(column):
+    # "external-ids:foo" -> ("external_ids", "foo")
+    if ":" in column:
+        (column, key) = column.split(":", 1)
+    else:
+        key = None
+    return (column.replace("-", "_"), key)
+
+
+def get_row(db, table, record, create=False):
+    table = table.lower()
+    if table == "open_vswitch":
+        return db["open_vswitch"]
+    rows = db.setdefault(table, {})
+    if record not in rows and create:
+        rows[record] = {"name": record, "external_ids": {}}
+    return rows.get(record)
+
+
+def rows_matching(db, table, conditions):
+    table = table.lower()
+    if table == "open_vswitch":
+        rows = [db["open_vswitch"]]
+    else:
+        rows = [db.setdefault(table, {})[name]
+                for name in sorted(db.setdefault(table, {}))]
+
+    matches = []
+    for row in rows:
+        for condition in conditions:
+            (column, value) = condition.split("=", 1)
+            (column, key) = column_key(column)
+            if key is not None:
+                actual = row.get(column, {}).get(key)
+            else:
+                actual = row.get(column)
+            if str(actual) != value.strip('"'):
+                break
+        else:
+            matches.append(row)
+    return matches
+
+
+def vsctl_command(db, options, args, output):
+    command = args[0]
+    if command in ("list", "find"):
+        table = args[1]
+        if command == "list" and len(args) > 2:
+            rows = [get_row(db, table, args[2])]
+        else:
+            rows = rows_matching(db, table, args[2:])
+        columns = options.get("columns", "name,external_ids").split(",")
+        data = [[datum(row.get(column)) for column in columns]
+                for row in rows if row]
+        output.append(json.dumps({"headings": columns, "data": data}))
+    elif command == "get":
+        row = get_row(db, args[1], args[2])
+        (column, key) = column_key(args[3])
+        value = (row or {}).get(column)
+        if key is not None:
+            value = (value or {}).get(key)
+        if value is None:
+            if "if-exists" in options:
+                return
+            sys.stderr.write("no key %s\n" % (args[3]))
+            sys.exit(1)
+        if value.isdigit():
+            output.append(value)
+        else:
+            output.append(json.dumps(value))
+    elif command == "set":
+        row = get_row(db, args[1], args[2], create=True)
+        for assignment in args[3:]:
+            (column, value) = assignment.split("=", 1)
+            (column, key) = column_key(column)
+            if key is not None:
+                row.setdefault(column, {})[key] = value.strip('"')
+            else:
+                row[column] = value.strip('"')
+    elif command == "remove":
+        row = get_row(db, args[1], args[2])
+        if row is None:
+            return
+        (column, key) = column_key(args[3])
+        for key in args[4:]:
+            row.get(column, {}).pop(key, None)
+    elif command == "add-port":
+        port = args[2]
+        db.setdefault("port", {})[port] = {"name": port, "tag": None}
+        db.setdefault("interface", {})[port] = {"name": port,
+                                                "external_ids": {}}
+        for assignment in args[3:]:
+            (column, value) = assignment.split("=", 1)
+            db["port"][port][column] = value
+    elif command == "del-port":
+        port = args[-1]
+        if port not in db.get("port", {}):
+            if "if-exists" in options:
+                return
+            sys.stderr.write("no port named %s\n" % (port))
+            sys.exit(1)
+        db["port"].pop(port)
+        db["interface"].pop(port, None)
+    else:
+        sys.stderr.write("unsupported command %s\n" % (command))
+        sys.exit(1)
+
+
+def ovs_vsctl(argv):
+    # Commands are separated by "--"; options come before each command.
+    commands = [[]]
+    for arg in argv:
+        if arg == "--":
+            commands.append([])
+        else:
+            commands[-1].append(arg)
+
+    with open(OVSDB, "r+") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        db = json.load(fd)
+        output = []
+        for command in commands:
+            options = {}
+            while command and command[0].startswith("-"):
+                option = command.pop(0).lstrip("-").split("=", 1)
+                options[option[0]] = option[1] if len(option) > 1 else ""
+            if command:
+                vsctl_command(db, options, command, output)
+        fd.seek(0)
+        fd.truncate()
+        json.dump(db, fd)
+
+    if output:
+        print "\n".join(output)
+
+
+def main():
+    time.sleep(EXEC_LATENCY / 1000.0)
+
+    prog = sys.argv[1]
+    argv = sys.argv[2:]
+    if prog == "ovs-vsctl":
+        ovs_vsctl(argv)
+    elif prog == "ovs-ofctl":
+        if "dump-flows" in argv:
+            print "NXST_FLOW reply (xid=0x4):"
+        elif "-" in argv:
+            sys.stdin.read()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+#!/usr/bin/python
+# Measures pod setup, status and teardown of ovn-k8-overlay.py and
+# ovn-k8-underlay.py, and lswitch-setup of the latter, against local
+# stand-ins: fake-ovs.py runs as ovs-vsctl, ovn-nbctl, ovs-ofctl and ip, and
+# a fake Docker daemon, API server and Neutron/Keystone are served from this
+# process. Netlink needs root and real containers, so each netlink step of
+# the plugins is replaced by one run of the fake ip.
+import argparse
+import BaseHTTPServer
+import imp
+import json
+import math
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(BENCH_DIR)
+FAKE_PROGRAMS = ["ovs-vsctl", "ovn-nbctl", "ovs-ofctl", "ip"]
+NETLINK_STEPS = ["netns_link", "pod_link_setup", "pod_link_delete",
+                 "neigh_update"]
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers JSON requests from the 'routes' of the server it runs in,
+    a list of (method, path regex, function(match, body)) where the
+    function returns (status, reply)."""
+
+    protocol_version = "HTTP/1.1"
+
+    def handle_method(self, method):
+        time.sleep(self.server.latency / 1000.0)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        path = self.path.split("?", 1)[0]
+        for (route_method, pattern, function) in self.server.routes:
+            match = re.match(pattern + "$", path)
+            if route_method == method and match:
+                (status, reply) = function(match, body)
+                break
+        else:
+            (status, reply) = (404, {"message": "%s not found" % (path)})
+
+        data = json.dumps(reply) if reply is not None else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+    def address_string(self):
+        return "bench"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, routes, latency):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           FakeHandler)
+        self.routes = routes
+        self.latency = latency
+        self.url = "http://127.0.0.1:%d" % (self.server_address[1])
+
+
+class FakeUnixServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, routes, latency):
+        SocketServer.UnixStreamServer.__init__(self, path, FakeHandler)
+        self.routes = routes
+        self.latency = latency
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class FakeDocker(object):
+    """Inspects containers that all run as this process, each with its own
+    address."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containers = {}
+
+    def inspect(self, match, body):
+        container_id = match.group(1)
+        with self.lock:
+            if container_id not in self.containers:
+                self.containers[container_id] = len(self.containers) + 2
+            host = self.containers[container_id]
+        return (200, {"Id": container_id,
+                      "State": {"Running": True, "Pid": os.getpid()},
+                      "NetworkSettings": {
+                          "IPAddress": "10.%d.%d.%d" % (host >> 16,
+                                                        (host >> 8) & 255,
+                                                        host & 255),
+                          "IPPrefixLen": 8,
+                          "MacAddress": "02:42:%02x:%02x:%02x:%02x"
+                                        % (10, host >> 16, (host >> 8) & 255,
+                                           host & 255),
+                          "Gateway": "10.0.0.1"}})
+
+    def routes(self):
+        return [("GET", r"(/v[0-9.]+)?/version",
+                 lambda match, body: (200, {"ApiVersion": "1.22",
+                                            "Version": "1.10.0"})),
+                ("GET", r"(?:/v[0-9.]+)?/containers/([^/]+)/json",
+                 self.inspect)]
+
+
+class FakeAPIServer(object):
+    """Serves the pods the benchmark creates, all in one namespace and all
+    carrying the same annotations."""
+
+    def __init__(self, annotations):
+        self.annotations = annotations
+
+    def pod(self, namespace, name):
+        return {"metadata": {"namespace": namespace, "name": name,
+                             "resourceVersion": "1",
+                             "annotations": self.annotations}}
+
+    def routes(self):
+        return [("GET", r"/api/v1/namespaces/([^/]+)/pods/([^/]+)",
+                 lambda match, body: (200, self.pod(match.group(1),
+                                                    match.group(2)))),
+                ("GET", r"/api/v1/pods",
+                 lambda match, body: (200, {"metadata":
+                                            {"resourceVersion": "1"},
+                                            "items": []}))]
+
+
+class FakeNeutron(object):
+    """Keystone v2 token issuing and the few Neutron calls the underlay
+    plugin makes. Addresses are handed out in order from the subnet."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.url = ""
+        self.subnets = {}
+        self.ports = {}
+        self.macs = 0
+
+    def token(self, match, body):
+        endpoint = {"region": "RegionOne", "publicURL": self.url,
+                    "internalURL": self.url, "adminURL": self.url}
+        tenant = body["auth"].get("tenantId", "bench")
+        return (200, {"access": {
+            "token": {"id": uuid.uuid4().hex,
+                      "expires": "2099-01-01T00:00:00Z",
+                      "tenant": {"id": tenant, "name": tenant}},
+            "user": {"id": "bench", "name": "bench"},
+            "serviceCatalog": [{"type": "network", "name": "neutron",
+                                "endpoints": [endpoint]}]}})
+
+    def create_network(self, match, body):
+        return (201, {"network": {"id": str(uuid.uuid4()),
+                                  "name": body["network"]["name"]}})
+
+    def create_subnet(self, match, body):
+        (network, prefix) = body["subnet"]["cidr"].split("/")
+        base = struct.unpack("!I", socket.inet_aton(network))[0]
+        subnet = {"id": str(uuid.uuid4()),
+                  "network_id": body["subnet"]["network_id"],
+                  "cidr": body["subnet"]["cidr"],
+                  "gateway_ip": socket.inet_ntoa(struct.pack("!I", base + 1))}
+        with self.lock:
+            self.subnets[subnet["network_id"]] = [base + 2, subnet]
+        return (201, {"subnet": subnet})
+
+    def new_port(self, request):
+        with self.lock:
+            allocation = self.subnets[request["network_id"]]
+            address = socket.inet_ntoa(struct.pack("!I", allocation[0]))
+            allocation[0] += 1
+            self.macs += 1
+            port = dict(request)
+            port.update({"id": str(uuid.uuid4()),
+                         "mac_address": "fa:16:3e:%02x:%02x:%02x"
+                                        % (self.macs >> 16,
+                                           (self.macs >> 8) & 255,
+                                           self.macs & 255),
+                         "fixed_ips": [{"subnet_id": allocation[1]["id"],
+                                        "ip_address": address}]})
+            self.ports[port["id"]] = port
+        return port
+
+    def create_port(self, match, body):
+        if "ports" in body:
+            return (201, {"ports": [self.new_port(request)
+                                    for request in body["ports"]]})
+        return (201, {"port": self.new_port(body["port"])})
+
+    def update_port(self, match, body):
+        port = self.ports.get(match.group(1))
+        if not port:
+            return (404, {"NeutronError": {"message": "port not found"}})
+        port.update(body["port"])
+        return (200, {"port": port})
+
+    def delete(self, match, body):
+        self.ports.pop(match.group(1), None)
+        return (204, None)
+
+    def routes(self):
+        return [("POST", r"/v2.0/tokens", self.token),
+                ("POST", r"/v2.0/networks(?:\.json)?", self.create_network),
+                ("POST", r"/v2.0/subnets(?:\.json)?", self.create_subnet),
+                ("POST", r"/v2.0/ports(?:\.json)?", self.create_port),
+                ("PUT", r"/v2.0/ports/([^/.]+)(?:\.json)?", self.update_port),
+                ("DELETE", r"/v2.0/(?:ports|networks)/([^/.]+)(?:\.json)?",
+                 self.delete)]
+
+
+def setup_environment(args, workdir):
+    # Puts the fake programs first in PATH and starts the fake services.
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    for program in FAKE_PROGRAMS:
+        path = os.path.join(bindir, program)
+        with open(path, "w") as fd:
+            fd.write("#!/bin/sh\nexec %s %s %s \"$@\"\n"
+                     % (sys.executable, os.path.join(BENCH_DIR, "fake-ovs.py"),
+                        program))
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = "%s:%s" % (bindir, os.environ.get("PATH", ""))
+    os.environ["OVN_K8_BENCH_DIR"] = workdir
+    os.environ["OVN_K8_BENCH_EXEC_LATENCY"] = str(args.exec_latency)
+
+    docker_socket = os.path.join(workdir, "docker.sock")
+    serve(FakeUnixServer(docker_socket, FakeDocker().routes(),
+                         args.docker_latency))
+
+    annotations = None
+    if args.security_group:
+        annotations = {"security-group": args.security_group}
+    api_server = serve(FakeHTTPServer(FakeAPIServer(annotations).routes(),
+                                      args.api_latency))
+
+    neutron = FakeNeutron()
+    neutron_server = serve(FakeHTTPServer(neutron.routes(),
+                                          args.neutron_latency))
+    neutron.url = neutron_server.url
+
+    openrc = os.path.join(workdir, "openrc")
+    with open(openrc, "w") as fd:
+        fd.write("OS_USERNAME=bench\nOS_PASSWORD=bench\n"
+                 "OS_TENANT_ID=bench\nOS_AUTH_URL=%s/v2.0\n"
+                 "OS_VIF_ID=%s\n" % (neutron_server.url, uuid.uuid4()))
+
+    with open(os.path.join(workdir, "ovsdb.json"), "w") as fd:
+        json.dump({"open_vswitch": {"external_ids": {
+            "ovn-remote": "tcp:127.0.0.1:6641",
+            "lswitch": "bench",
+            "api_server": api_server.url,
+            "node_name": "bench",
+            "neutron-config": openrc}}}, fd)
+
+    return "unix://%s" % (docker_socket)
+
+
+def load_plugin(mode, workdir, docker_url):
+    plugin = imp.load_source("ovn_k8_%s" % (mode),
+                             os.path.join(TOP_DIR, "ovn-k8-%s.py" % (mode)))
+    plugin.DOCKER_URL = docker_url
+    plugin.POD_INDEX_DIR = os.path.join(workdir, "pods-%s" % (mode))
+    plugin.SPAN_LOG = os.path.join(workdir, "spans-%s.log" % (mode))
+    plugin.METRICS_FILE = os.path.join(workdir, "metrics-%s.prom" % (mode))
+    plugin.METRICS_STATE = os.path.join(workdir, "metrics-%s.json" % (mode))
+    if mode == "underlay":
+        plugin.LPORT_CACHE = os.path.join(workdir, "lport.cache")
+        plugin.SECURITY_GROUP_QUEUE_DIR = os.path.join(workdir, "sg-queue")
+    else:
+        plugin.LPORT_POOL_FILE = os.path.join(workdir, "lports.json")
+
+    def netlink_step(*args, **kwargs):
+        plugin.call_popen(["ip", "link"])
+
+    for step in NETLINK_STEPS:
+        if hasattr(plugin, step):
+            setattr(plugin, step, netlink_step)
+    return plugin
+
+
+def percentile(latencies, pct):
+    if not latencies:
+        return 0.0
+    index = int(math.ceil(pct / 100.0 * len(latencies))) - 1
+    return latencies[max(index, 0)]
+
+
+def measure(name, function, items, concurrency, reset=None):
+    # Runs function over items on 'concurrency' threads. A SystemExit with
+    # a message, which is how the plugins fail, counts as an error.
+    def run(item):
+        if reset:
+            reset()
+        start = time.time()
+        error = None
+        try:
+            function(item)
+        except SystemExit as e:
+            if e.code:
+                error = str(e.code)
+        except Exception as e:
+            error = str(e)
+        return (time.time() - start, error)
+
+    stdout = sys.stdout
+    stderr = sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    pool = ThreadPool(concurrency)
+    start = time.time()
+    try:
+        results = pool.map(run, items, chunksize=1)
+    finally:
+        wall = time.time() - start
+        pool.close()
+        pool.join()
+        sys.stdout.close()
+        sys.stdout = stdout
+        sys.stderr = stderr
+
+    latencies = sorted([latency for (latency, error) in results])
+    errors = [error for (latency, error) in results if error]
+    return {"operation": name,
+            "count": len(results),
+            "errors": len(errors),
+            "first_error": errors[0] if errors else "",
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "ops_per_sec": len(results) / wall if wall else 0.0}
+
+
+def bench_plugin(mode, args, plugin):
+    results = []
+
+    if mode == "overlay" and args.pool_size:
+        plugin.ovs_vsctl("set open_vswitch . external_ids:lport-pool-size=%d"
+                         % (args.pool_size))
+        plugin.lport_pool_adjust(blocking=True)
+
+    if mode == "underlay":
+        lswitch_args = argparse.Namespace(network="bench",
+                                          subnet=args.subnet,
+                                          router_id="bench-router",
+                                          chunk_size=args.chunk_size,
+                                          workers=args.workers,
+                                          pool_size=args.pool_size,
+                                          pool_low=None, pool_high=None,
+                                          shard=["bench-vif-%d,%s,%s"
+                                                 % (i, plugin.OVN_BRIDGE,
+                                                    plugin.NEIGH_DEVICE)
+                                                 for i in range(1,
+                                                                args.shards)])
+
+        def lswitch_setup(run):
+            plugin.lport_caches_destroy()
+            plugin.lswitch_setup(lswitch_args)
+
+        results.append(measure("lswitch-setup", lswitch_setup,
+                               range(args.lswitch_runs), 1))
+
+    pods = []
+    for i in range(args.pods):
+        container_id = ("%015x" % (i) + uuid.uuid4().hex +
+                        uuid.uuid4().hex)[0:64]
+        pods.append(argparse.Namespace(k8_args=["default", "bench-%d" % (i),
+                                                container_id],
+                                       all=False))
+
+    reset = None
+    if args.cold:
+        def reset():
+            for cache in ("POD_INDEX", "CONTAINER_CACHE",
+                          "ANNOTATIONS_CACHE"):
+                getattr(plugin, cache).clear()
+
+    for (name, function) in (("setup", plugin.plugin_setup),
+                             ("status", plugin.plugin_status),
+                             ("teardown", plugin.plugin_teardown)):
+        results.append(measure(name, function, pods, args.concurrency,
+                               reset))
+        plugin.spans_flush()
+
+    for result in results:
+        result["plugin"] = mode
+    return results
+
+
+def print_results(results):
+    print "%-9s %-14s %7s %6s %9s %9s %9s %9s" % (
+        "plugin", "operation", "count", "errors", "p50 ms", "p95 ms",
+        "p99 ms", "ops/s")
+    for result in results:
+        print "%-9s %-14s %7d %6d %9.2f %9.2f %9.2f %9.1f" % (
+            result["plugin"], result["operation"], result["count"],
+            result["errors"], result["p50_ms"], result["p95_ms"],
+            result["p99_ms"], result["ops_per_sec"])
+    for result in results:
+        if result["first_error"]:
+            print "%s %s: %s" % (result["plugin"], result["operation"],
+                                 result["first_error"])
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+                description="Benchmark the ovn-k8 plugins against local "
+                "stand-ins for OVS, OVN, Docker, Neutron and the API server")
+    parser.add_argument('--plugin', choices=["overlay", "underlay", "both"],
+                        default="both", help="plugin to benchmark "
+                        "(default: both)")
+    parser.add_argument('--pods', type=int, default=200,
+                        help="pods to set up, query and tear down "
+                        "(default: 200)")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="operations in flight (default: 8)")
+    parser.add_argument('--cold', action='store_true',
+                        help="drop the plugins' in-memory caches before "
+                        "every operation, roughly what one process per "
+                        "kubelet call sees")
+    parser.add_argument('--exec-latency', type=float, default=0,
+                        help="added to every run of a fake program, in ms")
+    parser.add_argument('--docker-latency', type=float, default=0,
+                        help="added to every Docker request, in ms")
+    parser.add_argument('--api-latency', type=float, default=0,
+                        help="added to every API server request, in ms")
+    parser.add_argument('--neutron-latency', type=float, default=0,
+                        help="added to every Neutron/Keystone request, in ms")
+    parser.add_argument('--security-group', default="bench-sg",
+                        help="security-group annotation of every pod; "
+                        "empty for none (default: bench-sg)")
+    parser.add_argument('--subnet', default="192.168.0.0/22",
+                        help="subnet given to lswitch-setup "
+                        "(default: 192.168.0.0/22)")
+    parser.add_argument('--lswitch-runs', type=int, default=3,
+                        help="times to run lswitch-setup (default: 3)")
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help="lswitch-setup --chunk-size (default: 100)")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="lswitch-setup --workers (default: 8)")
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help="lswitch-setup --pool-size, and the "
+                        "overlay's lport-pool-size (default: 0, every "
+                        "lport up front)")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="parent VIFs to spread the lports over, with "
+                        "lswitch-setup --shard (default: 1)")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.plugin == "both":
+        modes = ["overlay", "underlay"]
+    else:
+        modes = [args.plugin]
+
+    workdir = tempfile.mkdtemp(prefix="ovn-k8-bench.")
+    try:
+        docker_url = setup_environment(args, workdir)
+        results = []
+        for mode in modes:
+            plugin = load_plugin(mode, workdir, docker_url)
+            results.extend(bench_plugin(mode, args, plugin))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        print_results(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# Measures how long each subcommand of ovn-k8-overlay.py and
+# ovn-k8-underlay.py takes when run the way kubelet runs the plugin: as a
+# new process every time. The plugins run against the same stand-ins as
+# ovn-k8-bench.py; a bare interpreter start is measured as the baseline.
+import argparse
+import imp
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(BENCH_DIR)
+CONTAINER_ID = "0" * 64
+
+# Subcommands that need neither Docker, a running agent nor root.
+COMMANDS = [("init", ["init"]),
+            ("status POD", ["status", "default", "bench", CONTAINER_ID]),
+            ("status --all", ["status", "--all"]),
+            ("--help", ["--help"])]
+
+
+def measure(argv, runs):
+    latencies = []
+    failures = 0
+    with open(os.devnull, "w") as devnull:
+        for i in range(runs):
+            start = time.time()
+            if subprocess.call(argv, stdout=devnull, stderr=devnull):
+                failures += 1
+            latencies.append(time.time() - start)
+    return (sorted(latencies), failures)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+                description="Measure the start up cost of each ovn-k8 "
+                "plugin subcommand")
+    parser.add_argument('--plugin', choices=["overlay", "underlay", "both"],
+                        default="both", help="plugin to measure "
+                        "(default: both)")
+    parser.add_argument('--runs', type=int, default=20,
+                        help="runs of each subcommand (default: 20)")
+    parser.add_argument('--exec-latency', type=float, default=0,
+                        help="added to every run of a fake program, in ms")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.plugin == "both":
+        modes = ["overlay", "underlay"]
+    else:
+        modes = [args.plugin]
+
+    bench = imp.load_source("ovn_k8_bench",
+                            os.path.join(BENCH_DIR, "ovn-k8-bench.py"))
+    bench_args = bench.get_parser().parse_args(
+                    ["--exec-latency", str(args.exec_latency)])
+
+    runs = [("python", "(baseline)", [sys.executable, "-c", "pass"])]
+    for mode in modes:
+        script = os.path.join(TOP_DIR, "ovn-k8-%s.py" % (mode))
+        for (name, command) in COMMANDS:
+            runs.append((mode, name, [sys.executable, script] + command))
+
+    workdir = tempfile.mkdtemp(prefix="ovn-k8-startup.")
+    results = []
+    try:
+        bench.setup_environment(bench_args, workdir)
+        for (plugin, name, argv) in runs:
+            (latencies, failures) = measure(argv, args.runs)
+            results.append({"plugin": plugin,
+                            "command": name,
+                            "runs": len(latencies),
+                            "failures": failures,
+                            "p50_ms": bench.percentile(latencies, 50) * 1000,
+                            "p95_ms": bench.percentile(latencies, 95) * 1000,
+                            "max_ms": latencies[-1] * 1000})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print json.dumps(results, indent=2)
+        return
+
+    print "%-9s %-14s %5s %8s %9s %9s %9s" % (
+        "plugin", "command", "runs", "failures", "p50 ms", "p95 ms",
+        "max ms")
+    for result in results:
+        print "%-9s %-14s %5d %8d %9.2f %9.2f %9.2f" % (
+            result["plugin"], result["command"], result["runs"],
+            result["failures"], result["p50_ms"], result["p95_ms"],
+            result["max_ms"])
+
+if __name__ == '__main__':
+    main()
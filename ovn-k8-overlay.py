@@ -1,34 +1,227 @@
 #!/usr/bin/python
 import argparse
-import ast
-import atexit
-import getpass
+import contextlib
+import fcntl
 import json
 import os
-import re
-import requests
+import Queue
 import shlex
+import socket
+import SocketServer
+import StringIO
 import subprocess
 import sys
+import threading
 import time
-import uuid
-
-from docker import Client
 
+AGENT_SOCKET = "/var/run/openvswitch/ovn-k8.sock"
+ANNOTATIONS_CACHE = {}
+ANNOTATIONS_TTL = 5
+API_SERVER = ""
+API_SESSION = None
+CONTAINER_CACHE = {}
+CONTAINER_CACHE_SIZE = 4096
+DOCKER_CLIENT = None
+DOCKER_URL = "unix://var/run/docker.sock"
+LPORT_POOL = None
+LPORT_POOL_FILE = "/var/run/openvswitch/ovn-k8-lports.json"
+LPORT_POOL_HIGH = 0
+LPORT_POOL_LOCK = threading.Lock()
+LPORT_POOL_LOW = 0
+LPORT_POOL_SIZE = 0
+LSWITCH = ""
+METRICS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10]
+METRICS_FILE = "/var/lib/node_exporter/textfile_collector/ovn-k8.prom"
+METRICS_STATE = "/var/run/openvswitch/ovn-k8-metrics.json"
 OVN_REMOTE = ""
 OVN_BRIDGE = "br-int"
+OVSDB_REMOTE = "unix:/var/run/openvswitch/db.sock"
+OVSDB_REPLICA = None
+POD_INDEX = {}
+POD_INDEX_DIR = "/var/run/openvswitch/ovn-k8-pods"
+POD_INFORMER = None
+SPAN_CONTEXT = threading.local()
+SPAN_LOG = "/var/log/openvswitch/ovn-k8-spans.log"
+SPANS = []
+SPANS_LOCK = threading.Lock()
+TIMED_COMMANDS = ["setup", "teardown", "setup-batch",
+                  "teardown-batch"]
+VETH_POOL = None
+
+
+# Timing spans. Steps of pod setup and teardown, and every run of an
+# external program, are timed and buffered; when one of TIMED_COMMANDS
+# finishes, its spans are appended as JSON lines to SPAN_LOG and folded
+# into histograms that are written out for node_exporter's textfile
+# collector. Either output is skipped while its directory does not exist.
+METRIC_FAMILIES = {
+    "command": ("ovn_k8_command_duration_seconds", ["command"],
+                "Time taken by each plugin command."),
+    "step": ("ovn_k8_step_duration_seconds", ["command", "step"],
+             "Time taken by each step of pod setup and teardown."),
+    "exec": ("ovn_k8_exec_duration_seconds", ["program"],
+             "Time taken by each run of an external program."),
+}
+
+
+@contextlib.contextmanager
+def span(kind, name):
+    # Nothing is recorded for the commands that are not timed.
+    if getattr(SPAN_CONTEXT, "command", "background") is None:
+        yield
+        return
+
+    start = time.time()
+    failed = False
+    try:
+        yield
+    except SystemExit as e:
+        failed = bool(e.code)
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        record = {"time": start, "kind": kind, "name": name,
+                  "duration": time.time() - start, "failed": failed,
+                  "command": getattr(SPAN_CONTEXT, "command", "background"),
+                  "container_id": getattr(SPAN_CONTEXT, "container_id", "")}
+        with SPANS_LOCK:
+            SPANS.append(record)
+
+
+def metrics_labels(record):
+    if record["kind"] == "command":
+        return [record["name"]]
+    elif record["kind"] == "step":
+        return [record["command"], record["name"]]
+    return [record["name"]]
+
+
+def metrics_render(state):
+    lines = []
+    for kind in sorted(METRIC_FAMILIES):
+        (metric, label_names, description) = METRIC_FAMILIES[kind]
+        histograms = state.get(kind, {})
+        lines.append("# HELP %s %s" % (metric, description))
+        lines.append("# TYPE %s histogram" % (metric))
+        for key in sorted(histograms):
+            histogram = histograms[key]
+            labels = ",".join(['%s="%s"' % (label, value) for (label, value)
+                               in zip(label_names, key.split("\t"))])
+            for (bound, count) in zip(METRICS_BUCKETS, histogram["buckets"]):
+                lines.append('%s_bucket{%s,le="%s"} %d'
+                             % (metric, labels, bound, count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d'
+                         % (metric, labels, histogram["count"]))
+            lines.append("%s_sum{%s} %f" % (metric, labels, histogram["sum"]))
+            lines.append("%s_count{%s} %d"
+                         % (metric, labels, histogram["count"]))
+
+        failures = metric.replace("_duration_seconds", "_failures_total")
+        lines.append("# HELP %s Failures counted in %s." % (failures, metric))
+        lines.append("# TYPE %s counter" % (failures))
+        for key in sorted(histograms):
+            labels = ",".join(['%s="%s"' % (label, value) for (label, value)
+                               in zip(label_names, key.split("\t"))])
+            lines.append("%s{%s} %d" % (failures, labels,
+                                        histograms[key]["failures"]))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_update(spans):
+    # The histograms outlive the process in METRICS_STATE, which is locked
+    # while they are updated so that concurrent plugin calls add up.
+    fd = os.open(METRICS_STATE, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            state = json.load(f)
+        except ValueError:
+            state = {}
+
+        for record in spans:
+            histograms = state.setdefault(record["kind"], {})
+            key = "\t".join(metrics_labels(record))
+            histogram = histograms.setdefault(
+                            key, {"buckets": [0] * len(METRICS_BUCKETS),
+                                  "sum": 0.0, "count": 0, "failures": 0})
+            for (i, bound) in enumerate(METRICS_BUCKETS):
+                if record["duration"] <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += record["duration"]
+            histogram["count"] += 1
+            if record["failed"]:
+                histogram["failures"] += 1
+
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+
+        tmp = "%s.%d" % (METRICS_FILE, os.getpid())
+        with open(tmp, "w") as prom:
+            prom.write(metrics_render(state))
+        os.rename(tmp, METRICS_FILE)
+
+
+def spans_flush():
+    with SPANS_LOCK:
+        spans = SPANS[:]
+        del SPANS[:]
+    if not spans:
+        return
+
+    try:
+        if os.path.isdir(os.path.dirname(SPAN_LOG)):
+            with open(SPAN_LOG, "a") as fd:
+                fd.write("".join([json.dumps(record) + "\n"
+                                  for record in spans]))
+        if os.path.isdir(os.path.dirname(METRICS_FILE)):
+            metrics_update(spans)
+    except (IOError, OSError) as e:
+        sys.stderr.write("failed to record timings (%s)" % (str(e)))
+
+
+def run_command(args):
+    # Runs a subcommand inside a span named after it and writes out the
+    # spans it produced. Other commands, e.g. status, which kubelet calls
+    # often, skip the timing and the write out altogether.
+    if args.func == plugin_agent:
+        args.func(args)
+        return
+
+    if args.command_name not in TIMED_COMMANDS:
+        SPAN_CONTEXT.command = None
+        try:
+            args.func(args)
+        finally:
+            SPAN_CONTEXT.command = "background"
+        return
+
+    SPAN_CONTEXT.command = args.command_name
+    k8_args = getattr(args, "k8_args", None) or []
+    SPAN_CONTEXT.container_id = k8_args[2] if len(k8_args) > 2 else ""
+    try:
+        with span("command", args.command_name):
+            args.func(args)
+    finally:
+        SPAN_CONTEXT.command = "background"
+        SPAN_CONTEXT.container_id = ""
+        spans_flush()
 
 
 def call_popen(cmd):
-    child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    output = child.communicate()
-    if child.returncode:
-        raise RuntimeError("Fatal error executing %s" % (cmd))
-    if len(output) == 0 or output[0] == None:
-        output = ""
-    else:
-        output = output[0].strip()
-    return output
+    with span("exec", os.path.basename(cmd[0])):
+        child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        output = child.communicate()
+        if child.returncode:
+            raise RuntimeError("Fatal error executing %s" % (cmd))
+        if len(output) == 0 or output[0] == None:
+            output = ""
+        else:
+            output = output[0].strip()
+        return output
 
 
 def call_prog(prog, args_list):
@@ -40,6 +233,204 @@ def ovs_vsctl(args):
     return call_prog("ovs-vsctl", shlex.split(args))
 
 
+def ovsdb_datum(value):
+    # Converts a column value from ovs-vsctl's --data=json output.
+    if isinstance(value, list):
+        if value[0] == "map":
+            return dict((k, ovsdb_datum(v)) for k, v in value[1])
+        elif value[0] == "set":
+            return [ovsdb_datum(v) for v in value[1]]
+        else:
+            return value[1]
+    return value
+
+
+def ovs_vsctl_rows(output):
+    data = json.loads(output)
+    rows = []
+    for row in data["data"]:
+        rows.append(dict(zip(data["headings"],
+                             [ovsdb_datum(value) for value in row])))
+    return rows
+
+
+def ovs_vsctl_list(table, columns, record=""):
+    if not record:
+        rows = ovsdb_select(table, columns)
+        if rows is not None:
+            return rows
+    return ovs_vsctl_rows(ovs_vsctl("--format=json --data=json --columns=%s "
+                                    "list %s %s"
+                                    % (",".join(columns), table, record)))
+
+
+def ovs_vsctl_find(table, columns, condition):
+    rows = ovsdb_select(table, columns, [condition])
+    if rows is not None:
+        return rows
+    return ovs_vsctl_rows(ovs_vsctl("--format=json --data=json --columns=%s "
+                                    "find %s %s"
+                                    % (",".join(columns), table, condition)))
+
+
+class OvsdbReplica(threading.Thread):
+    """Keeps an in-memory replica of some columns of an OVSDB database over
+    one long lived connection, so that a long running agent answers reads
+    from memory instead of running ovs-vsctl. The IDL's rows are slow to
+    read, so every row it changes is copied into a plain dict, which is
+    what select() searches. Until the replica has its first copy of the
+    database, and while the connection is down, select() returns None and
+    callers go to the command line tools instead. 'synced' is set once the
+    first copy is in, or the first attempt to get it has failed."""
+
+    def __init__(self, remote, database, columns):
+        threading.Thread.__init__(self, name="ovsdb-%s" % (database))
+        self.daemon = True
+        self.remote = remote
+        self.database = database
+        self.columns = columns
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.idl = None
+        self.changed = set()
+        self.names = dict([(table.lower(), table) for table in columns])
+        self.rows = dict([(table, {}) for table in columns])
+
+    def connect(self):
+        import ovs.db.idl
+        import ovs.jsonrpc
+        import ovs.stream
+
+        # The schema is fetched once; the IDL then only monitors the
+        # columns registered here.
+        (error, stream) = ovs.stream.Stream.open_block(
+                                ovs.stream.Stream.open(self.remote))
+        if error:
+            raise RuntimeError("failed to connect to %s (%s)"
+                               % (self.remote, os.strerror(error)))
+        rpc = ovs.jsonrpc.Connection(stream)
+        try:
+            (error, reply) = rpc.transact_block(
+                    ovs.jsonrpc.Message.create_request("get_schema",
+                                                       [self.database]))
+        finally:
+            rpc.close()
+        if error or reply.error:
+            raise RuntimeError("failed to fetch the %s schema"
+                               % (self.database))
+
+        helper = ovs.db.idl.SchemaHelper(schema_json=reply.result)
+        for (table, columns) in self.columns.items():
+            helper.register_columns(table, columns)
+        self.idl = ovs.db.idl.Idl(self.remote, helper)
+        self.idl.notify = self.notify
+
+    def notify(self, event, row, updates=None):
+        # Called by the IDL, from its run(), for every row it changes.
+        self.changed.add((row._table.name, row.uuid))
+
+    def copy_rows(self):
+        changed = {}
+        for (table, uuid) in self.changed:
+            row = self.idl.tables[table].rows.get(uuid)
+            if row:
+                row = dict([(column, getattr(row, column))
+                            for column in self.columns[table]])
+            changed.setdefault(table, {})[uuid] = row
+        self.changed.clear()
+
+        # Rows dropped while reconnecting are not notified; a table whose
+        # row count is off is copied again in full.
+        for (table, replica) in self.idl.tables.items():
+            rows = self.rows[table]
+            for (uuid, row) in changed.get(table, {}).items():
+                if row:
+                    rows[uuid] = row
+                else:
+                    rows.pop(uuid, None)
+            if len(rows) != len(replica.rows):
+                rows.clear()
+                for (uuid, row) in replica.rows.items():
+                    rows[uuid] = dict([(column, getattr(row, column))
+                                       for column in self.columns[table]])
+
+    def select(self, table, columns, conditions=[]):
+        # The rows of 'table' that match every "column[:key]=value" in
+        # 'conditions', with 'columns', as ovs_vsctl_rows() returns them.
+        with self.lock:
+            if (not self.idl or not self.idl.has_ever_connected() or
+                    not self.idl._session.is_connected()):
+                return None
+
+            table = self.names.get(table.lower())
+            matches = []
+            for condition in conditions:
+                (column, value) = condition.split("=", 1)
+                (column, key) = (column.split(":", 1) + [None])[0:2]
+                matches.append((column.replace("-", "_"), key, value))
+            needed = set(columns + [match[0] for match in matches])
+            if not table or not needed.issubset(self.columns[table]):
+                return None
+
+            selected = []
+            for row in self.rows[table].values():
+                for (column, key, value) in matches:
+                    actual = row[column]
+                    if key is not None:
+                        actual = actual.get(key)
+                    if actual != value:
+                        break
+                else:
+                    selected.append(dict([(column, row[column])
+                                          for column in columns]))
+            return selected
+
+    def run(self):
+        try:
+            import ovs.poller
+        except ImportError:
+            sys.stderr.write("ovs python library not found, reading the "
+                             "database with ovs-vsctl\n")
+            self.synced.set()
+            return
+
+        while True:
+            try:
+                if not self.idl:
+                    self.connect()
+                poller = ovs.poller.Poller()
+                seqno = self.idl.change_seqno
+                self.idl.run()
+                self.idl.wait(poller)
+                if self.idl.change_seqno != seqno or self.changed:
+                    with self.lock:
+                        self.copy_rows()
+                if self.idl.has_ever_connected():
+                    self.synced.set()
+                poller.block()
+            except Exception as e:
+                sys.stderr.write("ovsdb replica: %s\n" % (str(e)))
+                self.synced.set()
+                time.sleep(5)
+
+
+def start_ovsdb_replica():
+    # Replicates the columns the plugin reads from the local Open_vSwitch
+    # database, and waits a little for the first copy.
+    global OVSDB_REPLICA
+    OVSDB_REPLICA = OvsdbReplica(OVSDB_REMOTE, "Open_vSwitch",
+                                 {"Open_vSwitch": ["external_ids"],
+                                  "Interface": ["name", "external_ids"]})
+    OVSDB_REPLICA.start()
+    OVSDB_REPLICA.synced.wait(2)
+
+
+def ovsdb_select(table, columns, conditions=[]):
+    if not OVSDB_REPLICA:
+        return None
+    return OVSDB_REPLICA.select(table, columns, conditions)
+
+
 def ovn_nbctl(args):
     args_list = shlex.split(args)
     database_option = "%s=%s" % ("--db", OVN_REMOTE)
@@ -48,218 +439,983 @@ def ovn_nbctl(args):
 
 
 def plugin_init(args):
-    pass
+    try:
+        with span("step", "reconcile"):
+            pod_reconcile()
+    except Exception as e:
+        error = "failed to reconcile the pods on this node (%s)" % (str(e))
+        sys.exit(error)
+
+    try:
+        lport_pool_adjust(blocking=True)
+    except Exception as e:
+        error = "failed to adjust the lport pool (%s)" % (str(e))
+        sys.stderr.write(error)
+
+
+def get_api_server():
+    get_node_config()
+    return API_SERVER
+
+
+def get_api_session():
+    global API_SESSION
+    if not API_SESSION:
+        import requests
+        API_SESSION = requests.Session()
+    return API_SESSION
 
 
-def get_annotations(pod_name, namespace):
-    api_server = ovs_vsctl("--if-exists get open_vswitch . "
-                           "external-ids:api_server").strip('"')
+def get_annotations(namespace, pod_name):
+    # In the agent, annotations come from the pod informer's index. Pods it
+    # has not seen yet are fetched with a single pod GET over a keep-alive
+    # session and cached briefly, since setup and teardown of a pod tend to
+    # ask for them again.
+    if POD_INFORMER and POD_INFORMER.synced.is_set():
+        (found, annotations) = POD_INFORMER.get(namespace, pod_name)
+        if found:
+            return annotations
+
+    key = (namespace, pod_name)
+    cached = ANNOTATIONS_CACHE.get(key)
+    if cached and cached[0] > time.time():
+        return cached[1]
+
+    api_server = get_api_server()
     if not api_server:
         return None
+    if not api_server.startswith("http"):
+        api_server = "http://%s" % (api_server)
 
-    url = "http://%s/api/v1/pods" % (api_server)
-    response = requests.get("http://0.0.0.0:8080/api/v1/pods")
-    if response:
-        pods = response.json()['items']
-    else:
+    url = "%s/api/v1/namespaces/%s/pods/%s" % (api_server, namespace,
+                                              pod_name)
+    import requests
+    try:
+        response = get_api_session().get(url, timeout=5)
+    except requests.RequestException as e:
+        sys.stderr.write("failed to fetch pod %s/%s (%s)"
+                         % (namespace, pod_name, str(e)))
+        return None
+    if not response:
         return None
 
-    for pod in pods:
-        if (pod['metadata']['namespace'] == namespace and
-           pod['metadata']['name'] == pod_name):
-            annotations = pod['metadata'].get('annotations', "")
-            if annotations:
-                return annotations
+    annotations = response.json()['metadata'].get('annotations') or None
+
+    if len(ANNOTATIONS_CACHE) > 1024:
+        now = time.time()
+        for stale in [k for k, v in ANNOTATIONS_CACHE.items() if v[0] < now]:
+            ANNOTATIONS_CACHE.pop(stale, None)
+    ANNOTATIONS_CACHE[key] = (time.time() + ANNOTATIONS_TTL, annotations)
+    return annotations
+
+
+class PodInformer(threading.Thread):
+    """Keeps a local index of the annotations of the pods scheduled on this
+    node. The index is filled by a list and kept current by a watch from
+    the list's resourceVersion; when the API server reports that version
+    as expired, the pods are listed again."""
+
+    def __init__(self, api_server, node_name):
+        import requests
+        threading.Thread.__init__(self, name="pod-informer")
+        self.daemon = True
+        self.url = "%s/api/v1/pods" % (api_server)
+        self.selector = "spec.nodeName=%s" % (node_name)
+        self.session = requests.Session()
+        self.pods = {}
+        self.resource_version = None
+        self.synced = threading.Event()
+
+    def get(self, namespace, pod_name):
+        key = (namespace, pod_name)
+        if key not in self.pods:
+            return (False, None)
+        return (True, self.pods[key])
+
+    def relist(self):
+        response = self.session.get(self.url, timeout=30,
+                                    params={"fieldSelector": self.selector})
+        response.raise_for_status()
+        data = response.json()
+
+        pods = {}
+        for pod in data['items']:
+            metadata = pod['metadata']
+            pods[(metadata['namespace'], metadata['name'])] = \
+                metadata.get('annotations') or None
+        self.pods = pods
+        self.resource_version = data['metadata']['resourceVersion']
+        self.synced.set()
+
+    def watch(self):
+        # Returns False if the pods have to be listed again.
+        params = {"fieldSelector": self.selector, "watch": "true",
+                  "resourceVersion": self.resource_version,
+                  "timeoutSeconds": 300}
+        response = self.session.get(self.url, params=params, stream=True,
+                                    timeout=(5, 330))
+        if response.status_code == 410:
+            return False
+        response.raise_for_status()
+
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event['type'] == "ERROR":
+                if event['object'].get('code') == 410:
+                    return False
+                raise RuntimeError(event['object'].get('message', ""))
+
+            metadata = event['object']['metadata']
+            key = (metadata['namespace'], metadata['name'])
+            if event['type'] == "DELETED":
+                self.pods.pop(key, None)
             else:
-                return None
+                self.pods[key] = metadata.get('annotations') or None
+            self.resource_version = metadata['resourceVersion']
+        return True
+
+    def run(self):
+        while True:
+            try:
+                if not self.resource_version:
+                    self.relist()
+                if not self.watch():
+                    self.resource_version = None
+            except Exception as e:
+                sys.stderr.write("pod informer: %s\n" % (str(e)))
+                time.sleep(1)
+
+
+def start_pod_informer():
+    global POD_INFORMER
+    api_server = get_api_server()
+    if not api_server:
+        return
+    if not api_server.startswith("http"):
+        api_server = "http://%s" % (api_server)
+
+    node_name = ovs_vsctl("--if-exists get open_vswitch . "
+                          "external-ids:node_name").strip('"')
+    if not node_name:
+        node_name = socket.gethostname()
+
+    POD_INFORMER = PodInformer(api_server, node_name)
+    POD_INFORMER.start()
 
 
 def associate_security_group(lport_id, security_group_id):
     pass
 
 
-def get_ovn_remote():
+def get_node_config():
+    # Fetches everything this node needs from the Open_vSwitch table with
+    # a single query.
+    global OVN_REMOTE, LSWITCH, API_SERVER
+    global LPORT_POOL_SIZE, LPORT_POOL_LOW, LPORT_POOL_HIGH
+    if OVN_REMOTE and LSWITCH and not OVSDB_REPLICA:
+        return
+
     try:
-        global OVN_REMOTE
-        OVN_REMOTE = ovs_vsctl("get Open_vSwitch . "
-                               "external_ids:ovn-remote").strip('"')
+        external_ids = ovs_vsctl_list("open_vswitch",
+                                      ["external_ids"])[0]["external_ids"]
     except Exception as e:
-        error = "failed to fetch ovn-remote (%s)" % (str(e))
+        error = "failed to fetch external_ids (%s)" % (str(e))
+        sys.stderr.write(error)
+        return
 
+    OVN_REMOTE = external_ids.get("ovn-remote", "")
+    LSWITCH = external_ids.get("lswitch", "")
+    API_SERVER = external_ids.get("api_server", "")
+    LPORT_POOL_SIZE = int(external_ids.get("lport-pool-size") or 0)
+    LPORT_POOL_LOW = int(external_ids.get("lport-pool-low") or
+                         max(1, LPORT_POOL_SIZE // 4))
+    LPORT_POOL_HIGH = int(external_ids.get("lport-pool-high") or
+                          LPORT_POOL_SIZE * 2)
 
-def plugin_setup(args):
-    ns = args.k8_args[0]
-    pod_name = args.k8_args[1]
-    container_id = args.k8_args[2]
 
-    get_ovn_remote()
+def netns_link(pid):
+    netns_dst = "/var/run/netns/%s" % (pid)
+    if not os.path.lexists(netns_dst):
+        os.symlink("/proc/%s/ns/net" % (pid), netns_dst)
+
 
-    client = Client(base_url='unix://var/run/docker.sock')
+def host_links():
+    # The names of all the network devices in the host namespace, from a
+    # single netlink dump.
+    from pyroute2 import IPRoute
+    ipr = IPRoute()
     try:
-        inspect = client.inspect_container(container_id)
-        pid = inspect["State"]["Pid"]
-        ip_address = inspect["NetworkSettings"]["IPAddress"]
-        netmask = inspect["NetworkSettings"]["IPPrefixLen"]
-        mac = inspect["NetworkSettings"]["MacAddress"]
-        gateway_ip = inspect["NetworkSettings"]["Gateway"]
-    except Exception as e:
-        error = "failed to get container pid and ip address (%s)" % (str(e))
-        sys.exit(error)
+        return set([link.get_attr('IFLA_IFNAME')
+                    for link in ipr.get_links()])
+    finally:
+        ipr.close()
 
-    if not pid:
-        sys.exit("failed to fetch the pid")
 
-    netns_dst = "/var/run/netns/%s" % (pid)
-    if not os.path.isfile(netns_dst):
-        netns_src = "/proc/%s/ns/net" % (pid)
-        command = "ln -s %s %s" % (netns_src, netns_dst)
+def netns_prune():
+    # Drops the /var/run/netns links of the containers that are gone.
+    if not os.path.isdir("/var/run/netns"):
+        return
+    for name in os.listdir("/var/run/netns"):
+        path = os.path.join("/var/run/netns", name)
+        if os.path.islink(path) and not os.path.exists(path):
+            os.unlink(path)
+
 
+def pod_link_setup(pid, veth_outside, veth_inside, ip_address, netmask,
+                   mac, gateway_ip, pooled=False):
+    # Everything is done over netlink: one socket in the host namespace to
+    # create the veth pair, unless it comes from the veth pool, and one
+    # session inside the pod's namespace to configure its end.
+    from pyroute2 import IPRoute, NetNS
+
+    with span("step", "veth-create"):
+        ipr = IPRoute()
         try:
-            call_popen(shlex.split(command))
+            if not pooled:
+                step = "create veth pair"
+                ipr.link('add', ifname=veth_outside, kind='veth',
+                         peer=veth_inside)
+
+                step = "admin up veth_outside"
+                outside = ipr.link_lookup(ifname=veth_outside)[0]
+                ipr.link('set', index=outside, state='up')
+
+            step = "move veth inside"
+            inside = ipr.link_lookup(ifname=veth_inside)[0]
+            ipr.link('set', index=inside, net_ns_fd=str(pid))
         except Exception as e:
-            error = "failed to create the netns link"
-            sys.exit(error)
+            raise RuntimeError("Failed to %s (%s)" % (step, str(e)))
+        finally:
+            ipr.close()
 
-    # Delete the existing veth pair
-    command = "ip netns exec %s ip link del eth0" % (pid)
-    try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "failed to delete the default veth pair"
-        sys.stderr.write(error)
+    with span("step", "address-config"):
+        step = "enter the pod netns"
+        try:
+            netns = NetNS(str(pid))
+        except Exception as e:
+            raise RuntimeError("Failed to %s (%s)" % (step, str(e)))
 
-    veth_outside = container_id[0:15]
-    veth_inside = container_id[0:13] + "_c"
-    command = "ip link add %s type veth peer name %s" \
-              % (veth_outside, veth_inside)
-    try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to create veth pair (%s)" % (str(e))
-        sys.exit(error)
+        try:
+            # Delete the existing veth pair
+            eth0 = netns.link_lookup(ifname='eth0')
+            if eth0:
+                try:
+                    netns.link('del', index=eth0[0])
+                except Exception as e:
+                    sys.stderr.write("failed to delete the default veth pair")
+
+            # Rename veth_inside to eth0 and set its mac address and the mtu
+            # to handle tunnels.
+            step = "configure eth0"
+            inside = netns.link_lookup(ifname=veth_inside)[0]
+            netns.link('set', index=inside, ifname='eth0', address=mac,
+                       mtu=1450)
+
+            step = "admin up veth_inside"
+            netns.link('set', index=inside, state='up')
+
+            step = "set ip address"
+            netns.addr('add', index=inside, address=ip_address,
+                       mask=int(netmask))
+
+            step = "set gateway"
+            netns.route('add', dst='0.0.0.0/0', gateway=gateway_ip)
+        except Exception as e:
+            raise RuntimeError("Failed to %s (%s)" % (step, str(e)))
+        finally:
+            netns.close()
 
-    # Up the outer interface
-    command = "ip link set %s up" % veth_outside
+
+def pod_link_delete(ifname):
+    from pyroute2 import IPRoute
+
+    ipr = IPRoute()
     try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to admin up veth_outside (%s)" % (str(e))
-        sys.exit(error)
+        ipr.link('del', index=ipr.link_lookup(ifname=ifname)[0])
+    finally:
+        ipr.close()
+
 
-    # Move the inner veth inside the container
-    command = "ip link set %s netns %s" % (veth_inside, pid)
+def pod_unlink(veth_outside, pooled):
+    # Deletes the veth pair of a pod whose setup failed, and its OVS port
+    # if it came from the veth pool, which makes up for it.
     try:
-        call_popen(shlex.split(command))
+        if pooled:
+            ovs_vsctl("--if-exists del-port %s" % (veth_outside))
+        pod_link_delete(veth_outside)
     except Exception as e:
-        error = "Failed to move veth inside (%s)" % (str(e))
-        sys.exit(error)
+        sys.stderr.write("failed to delete veth pair %s (%s)\n"
+                         % (veth_outside, str(e)))
+
+
+def get_pod_interface(container_id):
+    # Returns the name and external_ids of the OVS interface of a pod.
+    # Interfaces taken from the veth pool are not named after the
+    # container, so they are looked up by external_ids:container_id.
+    rows = ovs_vsctl_find("interface", ["name", "external_ids"],
+                          "external_ids:container_id=%s" % (container_id))
+    if not rows:
+        rows = ovs_vsctl_find("interface", ["name", "external_ids"],
+                              "name=%s" % (container_id[0:15]))
+    if not rows:
+        return (None, {})
+    return (rows[0]["name"], rows[0]["external_ids"])
+
+
+class VethPool(threading.Thread):
+    """Keeps up to 'size' veth pairs created, with their outer end up and
+    attached to OVN_BRIDGE, so that pod setup only has to move the inner
+    end into the pod and relabel the OVS interface. Free pairs are marked
+    with external_ids:ovn-k8-pool, which also lets a restarted agent adopt
+    them."""
+
+    def __init__(self, size):
+        threading.Thread.__init__(self, name="veth-pool")
+        self.daemon = True
+        self.size = size
+        self.free = Queue.Queue()
+        self.wakeup = threading.Event()
+
+    def claim(self):
+        try:
+            pair = self.free.get_nowait()
+        except Queue.Empty:
+            return None
+        self.wakeup.set()
+        return pair
+
+    def adopt(self):
+        from pyroute2 import IPRoute
+        rows = ovs_vsctl_find("interface", ["name", "external_ids"],
+                              "external_ids:ovn-k8-pool=free")
+        ipr = IPRoute()
+        try:
+            for row in rows:
+                veth_outside = row["name"]
+                veth_inside = row["external_ids"].get("ovn-k8-pool-peer", "")
+                if veth_inside and ipr.link_lookup(ifname=veth_inside):
+                    self.free.put((veth_outside, veth_inside))
+                else:
+                    ovs_vsctl("--if-exists del-port %s" % (veth_outside))
+        finally:
+            ipr.close()
+
+    def delete(self, pairs):
+        # Pairs that did not make it into the pool would never be used.
+        for (veth_outside, veth_inside) in pairs:
+            try:
+                pod_link_delete(veth_outside)
+            except Exception as e:
+                sys.stderr.write("veth pool: failed to delete %s (%s)\n"
+                                 % (veth_outside, str(e)))
+
+    def fill(self):
+        import uuid
+        from pyroute2 import IPRoute
+
+        pairs = []
+        ipr = IPRoute()
+        try:
+            for i in range(self.size - self.free.qsize()):
+                name = "ovnp%s" % (uuid.uuid4().hex[0:8])
+                veth_outside = name
+                veth_inside = name + "_c"
+                ipr.link('add', ifname=veth_outside, kind='veth',
+                         peer=veth_inside)
+                pairs.append((veth_outside, veth_inside))
+                ipr.link('set', index=ipr.link_lookup(ifname=veth_outside)[0],
+                         state='up')
+        except Exception:
+            self.delete(pairs)
+            raise
+        finally:
+            ipr.close()
+
+        if not pairs:
+            return
+
+        # Attach the whole batch in one transaction.
+        command = []
+        for (veth_outside, veth_inside) in pairs:
+            command.append("add-port %s %s -- set interface %s "
+                           "external_ids:ovn-k8-pool=free "
+                           "external_ids:ovn-k8-pool-peer=%s"
+                           % (OVN_BRIDGE, veth_outside, veth_outside,
+                              veth_inside))
+        try:
+            ovs_vsctl(" -- ".join(command))
+        except Exception:
+            self.delete(pairs)
+            raise
+
+        for pair in pairs:
+            self.free.put(pair)
+
+    def run(self):
+        try:
+            self.adopt()
+        except Exception as e:
+            sys.stderr.write("veth pool: %s\n" % (str(e)))
+
+        while True:
+            try:
+                self.fill()
+            except Exception as e:
+                sys.stderr.write("veth pool: %s\n" % (str(e)))
+            self.wakeup.wait(30)
+            self.wakeup.clear()
 
-    # Change the name of veth_inside to eth0
-    command = "ip netns exec %s ip link set dev %s name eth0" \
-              % (pid, veth_inside)
+
+def start_veth_pool():
+    global VETH_POOL
+    size = ovs_vsctl("--if-exists get open_vswitch . "
+                     "external-ids:veth-pool-size").strip('"')
+    if not size or not int(size):
+        return
+
+    VETH_POOL = VethPool(int(size))
+    VETH_POOL.start()
+
+
+def veth_pool_claim():
+    if not VETH_POOL:
+        return None
+    return VETH_POOL.claim()
+
+
+def lport_pooled(lport):
+    # Pooled lports are named after the node's lswitch, so that they are
+    # unique in the northbound database and can be told from the lports
+    # named after a container.
+    return lport.startswith("%s-pool-" % (LSWITCH))
+
+
+@contextlib.contextmanager
+def lport_pool_transaction():
+    # Yields the list of free pooled lports, which have no addresses, and
+    # writes it back. The file is only locked while it is read and
+    # written, not for the northbound calls in between.
+    with LPORT_POOL_LOCK:
+        fd = os.open(LPORT_POOL_FILE, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                free = json.load(f)
+            except ValueError:
+                free = []
+
+            yield free
+
+            f.seek(0)
+            f.truncate()
+            json.dump(free, f)
+
+
+@contextlib.contextmanager
+def lport_pool_lock(blocking):
+    # Keeps two processes from growing or shrinking the pool at once.
+    fd = os.open(LPORT_POOL_FILE + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
     try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to change name to eth0 (%s)" % (str(e))
-        sys.exit(error)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX |
+                        (0 if blocking else fcntl.LOCK_NB))
+            locked = True
+        except IOError:
+            locked = False
+        yield locked
+    finally:
+        os.close(fd)
+
+
+def lport_pool_put(lports):
+    with lport_pool_transaction() as free:
+        free.extend([lport for lport in lports if lport not in free])
+
+
+def lport_pool_take(count):
+    with lport_pool_transaction() as free:
+        lports = free[0:count]
+        del free[0:count]
+    return lports
+
+
+def lport_pool_create(count, chunk_size):
+    # Creates the lports in the node's lswitch, without addresses, with
+    # one northbound transaction per chunk.
+    import uuid
 
-    # Up the inner interface
-    command = "ip netns exec %s ip link set eth0 up" % (pid)
+    for i in range(0, count, chunk_size):
+        lports = ["%s-pool-%s" % (LSWITCH, uuid.uuid4().hex[0:12])
+                  for j in range(min(chunk_size, count - i))]
+        ovn_nbctl(" -- ".join(["lport-add %s %s" % (LSWITCH, lport)
+                               for lport in lports]))
+        lport_pool_put(lports)
+
+
+def lport_pool_adjust(blocking=False, need=0, chunk_size=100):
+    # Once the free lports drop below the low watermark, or below the
+    # 'need' lports about to be claimed, creates enough to bring them back
+    # to the pool size once those are claimed. Above the high watermark,
+    # deletes the free lports above the pool size, all of them once the
+    # pool is turned off. Returns the number of lports created, or deleted
+    # as a negative number.
+    get_node_config()
+    if not LSWITCH:
+        return 0
+    if not LPORT_POOL_SIZE and not os.path.exists(LPORT_POOL_FILE):
+        return 0
+
+    with lport_pool_lock(blocking) as locked:
+        if not locked:
+            return 0
+
+        with lport_pool_transaction() as free:
+            count = len(free)
+        if LPORT_POOL_SIZE and (count < LPORT_POOL_LOW or count < need):
+            lport_pool_create(LPORT_POOL_SIZE + need - count, chunk_size)
+            return LPORT_POOL_SIZE + need - count
+
+        if count > LPORT_POOL_HIGH:
+            with lport_pool_transaction() as free:
+                surplus = free[LPORT_POOL_SIZE:]
+                del free[LPORT_POOL_SIZE:]
+            try:
+                ovn_nbctl(" -- ".join(["lport-del %s" % (lport)
+                                       for lport in surplus]))
+            except Exception:
+                lport_pool_put(surplus)
+                raise
+            return -len(surplus)
+    return 0
+
+
+def lport_pool_claim(count):
+    # Takes 'count' free lports. Should the pool run dry, it is topped up
+    # right away, waiting for a top up already under way. Returns fewer
+    # when there is no pool or it could not be topped up.
+    get_node_config()
+    if not LPORT_POOL_SIZE:
+        return []
+
+    lports = lport_pool_take(count)
+    if len(lports) < count:
+        try:
+            lport_pool_adjust(blocking=True, need=count - len(lports))
+        except Exception as e:
+            sys.stderr.write("lport pool: %s\n" % (str(e)))
+        lports.extend(lport_pool_take(count - len(lports)))
+    if LPORT_POOL:
+        LPORT_POOL.wakeup.set()
+    return lports
+
+
+def lport_pool_reconcile(bound):
+    # Rebuilds the list of free lports from the pooled lports in the
+    # node's lswitch that are not bound to a pod. The ones that were not
+    # listed already may still have addresses and are cleared first.
+    output = ovn_nbctl("lport-list %s" % (LSWITCH))
+    lports = [line.split(" ", 1)[1].strip("()")
+              for line in output.splitlines() if " " in line]
+    lports = [lport for lport in lports
+              if lport_pooled(lport) and lport not in bound]
+
+    with lport_pool_transaction() as free:
+        known = set(free)
+        del free[:]
+    found = [lport for lport in lports if lport not in known]
+    if found:
+        ovn_nbctl(" -- ".join(["lport-set-addresses %s" % (lport)
+                               for lport in found]))
+    lport_pool_put(lports)
+    return len(found)
+
+
+class LportPool(threading.Thread):
+    """Keeps the free pooled lports between the pool's low and high
+    watermarks, checking after every claim and once a minute."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="lport-pool")
+        self.daemon = True
+        self.wakeup = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                lport_pool_adjust()
+            except Exception as e:
+                sys.stderr.write("lport pool: %s\n" % (str(e)))
+            self.wakeup.wait(60)
+            self.wakeup.clear()
+
+
+def start_lport_pool():
+    global LPORT_POOL
+    get_node_config()
+    if not LSWITCH or not LPORT_POOL_SIZE:
+        return
+
+    LPORT_POOL = LportPool()
+    LPORT_POOL.start()
+
+
+def get_docker_client():
+    global DOCKER_CLIENT
+    if not DOCKER_CLIENT:
+        from docker import Client
+        DOCKER_CLIENT = Client(base_url=DOCKER_URL, timeout=10)
+    return DOCKER_CLIENT
+
+
+def container_info(inspect):
+    return {"pid": inspect["State"]["Pid"],
+            "ip_address": inspect["NetworkSettings"]["IPAddress"],
+            "netmask": inspect["NetworkSettings"]["IPPrefixLen"],
+            "mac": inspect["NetworkSettings"]["MacAddress"],
+            "gateway_ip": inspect["NetworkSettings"]["Gateway"]}
+
+
+def container_cache_put(container_id, info):
+    if not info["pid"]:
+        return
+    if len(CONTAINER_CACHE) >= CONTAINER_CACHE_SIZE:
+        CONTAINER_CACHE.clear()
+    CONTAINER_CACHE[container_id] = info
+
+
+def inspect_container(container_id):
+    # Returns the pid and network settings of a container. They are served
+    # from the cache, which the agent fills from Docker's events, for as
+    # long as the container's process is alive.
+    info = CONTAINER_CACHE.get(container_id)
+    if info and os.path.exists("/proc/%s" % (info["pid"])):
+        return info
+
+    info = container_info(get_docker_client().inspect_container(container_id))
+    container_cache_put(container_id, info)
+    return info
+
+
+class ContainerWatcher(threading.Thread):
+    """Follows Docker's event stream and keeps the container cache current,
+    so that by the time kubelet asks for a pod to be set up its container
+    has usually been inspected already."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="container-watcher")
+        self.daemon = True
+
+    def run(self):
+        from docker import Client
+
+        while True:
+            try:
+                client = Client(base_url=DOCKER_URL, timeout=None)
+                for event in client.events(decode=True):
+                    container_id = event.get("id")
+                    if not container_id:
+                        continue
+                    if event.get("status") == "start":
+                        info = container_info(
+                                    client.inspect_container(container_id))
+                        container_cache_put(container_id, info)
+                    elif event.get("status") in ("die", "destroy"):
+                        CONTAINER_CACHE.pop(container_id, None)
+            except Exception as e:
+                sys.stderr.write("container watcher: %s\n" % (str(e)))
+                time.sleep(1)
+
+
+def pod_link(container_id):
+    # Gives the container a veth pair, from the pool if it has one, and
+    # configures the container's end with the address Docker gave it.
+    # Returns the container's network settings, the outer end and whether
+    # it came from the pool.
     try:
-        call_popen(shlex.split(command))
+        with span("step", "docker-inspect"):
+            info = inspect_container(container_id)
+        pid = info["pid"]
     except Exception as e:
-        error = "Failed to admin up veth_inside (%s)" % (str(e))
+        error = "failed to get container pid and ip address (%s)" % (str(e))
         sys.exit(error)
 
-    # Set the mtu to handle tunnels
-    command = "ip netns exec %s ip link set dev eth0 mtu %s" \
-              % (pid, 1450)
+    if not pid:
+        sys.exit("failed to fetch the pid")
+
     try:
-        call_popen(shlex.split(command))
+        with span("step", "netns-link"):
+            netns_link(pid)
     except Exception as e:
-        error = "Failed to set mtu (%s)" % (str(e))
+        error = "failed to create the netns link"
         sys.exit(error)
 
-    # Set the ip address
-    command = "ip netns exec %s ip addr add %s/%s dev eth0" \
-              % (pid, ip_address, netmask)
+    pair = veth_pool_claim()
+    if pair:
+        (veth_outside, veth_inside) = pair
+    else:
+        veth_outside = container_id[0:15]
+        veth_inside = container_id[0:13] + "_c"
     try:
-        call_popen(shlex.split(command))
+        pod_link_setup(pid, veth_outside, veth_inside, info["ip_address"],
+                       info["netmask"], info["mac"], info["gateway_ip"],
+                       pooled=bool(pair))
     except Exception as e:
-        error = "Failed to set ip address (%s)" % (str(e))
-        sys.exit(error)
+        pod_unlink(veth_outside, bool(pair))
+        sys.exit(str(e))
+    return (info, veth_outside, bool(pair))
+
+
+def pod_lport_command(lport, info):
+    # Binds the pod's ip address and mac address to a pooled lport with a
+    # single update, or creates a logical port with them in one
+    # transaction, so that a failure cannot leave a half configured lport.
+    addresses = ("lport-set-addresses %s \"%s %s\""
+                 % (lport, info["mac"], info["ip_address"]))
+    if lport_pooled(lport):
+        return addresses
+    return "lport-add %s %s -- %s" % (LSWITCH, lport, addresses)
 
-    # Set the mac address
-    command = "ip netns exec %s ip link set dev eth0 address %s" % (pid, mac)
+
+def pod_lport_unbind_command(lport):
+    # Clears the addresses of a pooled lport, so that it can go back to
+    # the pool, or deletes the pod's own lport.
+    if lport_pooled(lport):
+        return "lport-set-addresses %s" % (lport)
+    return "lport-del %s" % (lport)
+
+
+def pod_lport_unbind(lports, release=True):
+    # Unbinds the lports in one transaction, or one by one should that
+    # fail, and puts the pooled ones that were cleared back in the pool.
+    # Only release them once no OVS interface has them as its iface-id,
+    # or a pod set up meanwhile could share a lport with the old one.
+    if not lports:
+        return
     try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to set mac address (%s)" % (str(e))
+        ovn_nbctl(" -- ".join([pod_lport_unbind_command(lport)
+                               for lport in lports]))
+        unbound = lports
+    except Exception:
+        # Some of the lports are already gone.
+        unbound = []
+        for lport in lports:
+            try:
+                ovn_nbctl(pod_lport_unbind_command(lport))
+                unbound.append(lport)
+            except Exception as e:
+                error = "failed to delete logical port (%s)" % (str(e))
+                sys.stderr.write(error)
+    pooled = [lport for lport in unbound if lport_pooled(lport)]
+    if pooled and release:
+        lport_pool_put(pooled)
+
+
+def pod_port_command(container_id, lport, info, veth_outside, pooled,
+                     security_group):
+    # Adds the port to a OVS bridge, or relabels the pooled one. The
+    # security group is kept, empty or not, so that teardown knows what to
+    # undo.
+    external_ids = ("external_ids:attached_mac=%s external_ids:iface-id=%s "
+                    "external_ids:ip_address=%s "
+                    "external_ids:security_group='\"%s\"' "
+                    "external_ids:container_id=%s"
+                    % (info["mac"], lport, info["ip_address"],
+                       security_group, container_id))
+    if pooled:
+        return ("remove interface %s external_ids ovn-k8-pool "
+                "ovn-k8-pool-peer -- set interface %s %s"
+                % (veth_outside, veth_outside, external_ids))
+    return ("add-port %s %s -- set interface %s %s"
+            % (OVN_BRIDGE, veth_outside, veth_outside, external_ids))
+
+
+def pod_security_group(namespace, pod_name):
+    with span("step", "annotations"):
+        annotations = get_annotations(namespace, pod_name)
+    return (annotations or {}).get("security-group", "")
+
+
+def plugin_setup(args):
+    ns = args.k8_args[0]
+    pod_name = args.k8_args[1]
+    container_id = args.k8_args[2]
+
+    with span("step", "node-config"):
+        get_node_config()
+    if not LSWITCH:
+        error = "No lswitch created for this host"
         sys.exit(error)
 
-    # Set the gateway
-    command = "ip netns exec %s ip route add default via %s" \
-              % (pid, gateway_ip)
+    (info, veth_outside, pooled) = pod_link(container_id)
+
+    # The security group is recorded with the pod, so that teardown does
+    # not have to ask the API server again.
+    security_group = pod_security_group(ns, pod_name)
+
+    # Take a lport from the pool, if the node has one, or have one of the
+    # pod's own.
+    with span("step", "lport-claim"):
+        lport = (lport_pool_claim(1) or [container_id])[0]
+
+    # From here on, a pooled lport is handed back should setup fail.
     try:
-        call_popen(shlex.split(command))
+        with span("step", "ovn-lport"):
+            ovn_nbctl(pod_lport_command(lport, info))
     except Exception as e:
-        error = "Failed to set gateway (%s)" % (str(e))
+        if lport_pooled(lport):
+            pod_lport_unbind([lport])
+        pod_unlink(veth_outside, pooled)
+        error = "lport-add %s" % (str(e))
         sys.exit(error)
 
-    # Get the logical switch
     try:
-        lswitch = ovs_vsctl("--if-exists get open_vswitch . "
-                            "external_ids:lswitch").strip('"')
-        if not lswitch:
-            error = "No lswitch created for this host"
-            sys.exit(error)
+        with span("step", "ovs-port"):
+            ovs_vsctl(pod_port_command(container_id, lport, info,
+                                       veth_outside, pooled, security_group))
     except Exception as e:
-        error = "Failed to get external_ids:lswitch  (%s)" % (str(e))
+        pod_lport_unbind([lport])
+        pod_unlink(veth_outside, pooled)
+        error = "failed to create a OVS port. (%s)" % (str(e))
         sys.exit(error)
 
-    # Create a logical port
+    pod_index_add(container_id, {"ip": info["ip_address"],
+                                 "interface": veth_outside,
+                                 "lport": lport,
+                                 "security_group": security_group})
+
+    if security_group:
+        associate_security_group(lport, security_group)
+
+
+def pod_index_path(container_id):
+    return os.path.join(POD_INDEX_DIR, os.path.basename(container_id))
+
+
+def pod_index_add(container_id, record):
+    # Pod records are kept in memory and, so that separate plugin
+    # invocations and a restarted agent see them as well, in one small
+    # file per container.
+    POD_INDEX[container_id] = record
+    path = pod_index_path(container_id)
+    tmp = "%s.%d" % (path, os.getpid())
     try:
-        ovn_nbctl("lport-add %s %s" % (lswitch, container_id))
-    except Exception as e:
-        error = "lport-add %s" % (str(e))
-        sys.exit(error)
+        if not os.path.isdir(POD_INDEX_DIR):
+            os.makedirs(POD_INDEX_DIR)
+        with open(tmp, "w") as fd:
+            json.dump(record, fd)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        sys.stderr.write("failed to record pod %s (%s)"
+                         % (container_id, str(e)))
+
+
+def pod_index_get(container_id):
+    record = POD_INDEX.get(container_id)
+    if record:
+        return record
 
-    # Set the ip address and mac address
     try:
-        ovn_nbctl("lport-set-addresses %s \"%s %s\""
-                  % (container_id, mac, ip_address))
-    except Exception as e:
-        error = "lport-set-addresses %s" % (str(e))
-        sys.exit(error)
+        with open(pod_index_path(container_id)) as fd:
+            record = json.load(fd)
+    except (IOError, ValueError):
+        return None
+    POD_INDEX[container_id] = record
+    return record
 
-    # Add the port to a OVS bridge and set the vlan
+
+def pod_index_remove(container_id):
+    POD_INDEX.pop(container_id, None)
     try:
-        ovs_vsctl("add-port %s %s -- set interface %s "
-                  "external_ids:attached_mac=%s external_ids:iface-id=%s "
-                  "external_ids:ip_address=%s"
-                  % (OVN_BRIDGE, veth_outside, veth_outside, mac,
-                     container_id, ip_address))
-    except Exception as e:
-        ovn_nbctl("lport-del %s" % container_id)
-        error = "failed to create a OVS port. (%s)" % (str(e))
-        sys.exit(error)
+        os.unlink(pod_index_path(container_id))
+    except OSError:
+        pass
+
+
+def pod_status_all():
+    # Every pod on this node, from a single dump of the Interface table.
+    pods = []
+    for row in ovs_vsctl_list("interface", ["name", "external_ids"]):
+        ip_address = row["external_ids"].get("ip_address", "")
+        if not ip_address:
+            continue
+        pods.append({"container_id": row["external_ids"].get("container_id",
+                                                             ""),
+                     "interface": row["name"],
+                     "ip": ip_address})
+    return pods
+
+
+def pod_reconcile():
+    # Rebuilds the local state after a restart from a single dump of the
+    # Interface table. A pod is alive as long as the outer end of its veth
+    # pair is, as the pair goes away with the pod's netns. The ports and
+    # lports of the pods that are gone are deleted, their pooled lports
+    # go back to the pool, and the pod index is rebuilt from the ports
+    # that are left.
+    links = host_links()
+    pods = {}
+    stale = {}
+    for row in ovs_vsctl_list("interface", ["name", "external_ids"]):
+        external_ids = row["external_ids"]
+        container_id = external_ids.get("container_id", "")
+        if not container_id or not external_ids.get("ip_address"):
+            continue
+        if row["name"] in links:
+            pods[container_id] = (row["name"], external_ids)
+        else:
+            stale[container_id] = (row["name"],
+                                   external_ids.get("iface-id",
+                                                    container_id))
+
+    get_node_config()
+    if stale:
+        ovs_vsctl(" -- ".join(["--if-exists del-port %s" % (name)
+                               for (name, lport) in stale.values()]))
+        pod_lport_unbind([lport for (name, lport) in stale.values()])
+    netns_prune()
+
+    if LSWITCH and (LPORT_POOL_SIZE or os.path.exists(LPORT_POOL_FILE)):
+        try:
+            lport_pool_reconcile(set([ids.get("iface-id")
+                                      for (name, ids) in pods.values()]))
+        except Exception as e:
+            error = "failed to rebuild the lport pool (%s)" % (str(e))
+            sys.stderr.write(error)
+
+    for (container_id, (name, external_ids)) in pods.items():
+        record = {"ip": external_ids["ip_address"],
+                  "interface": name,
+                  "lport": external_ids.get("iface-id", container_id),
+                  "security_group": external_ids.get("security_group")}
+        if pod_index_get(container_id) != record:
+            pod_index_add(container_id, record)
+    if os.path.isdir(POD_INDEX_DIR):
+        for name in os.listdir(POD_INDEX_DIR):
+            if name not in pods:
+                pod_index_remove(name)
 
-    annotations = get_annotations(ns, pod_name)
-    if annotations:
-        security_group = annotations.get("security-group", "")
-        if security_group:
-            associate_security_group(lport, security_group)
+    return (len(pods), len(stale))
 
 
 def plugin_status(args):
+    if args.all:
+        print json.dumps(pod_status_all())
+        return
+
+    if len(args.k8_args) != 3:
+        sys.exit("status needs the namespace, pod name and container id")
     ns = args.k8_args[0]
     pod_name = args.k8_args[1]
     container_id = args.k8_args[2]
 
-    veth_outside = container_id[0:15]
-    ip_address = ovs_vsctl("--if-exists get interface %s "
-                           "external_ids:ip_address"
-                           % (veth_outside)).strip('"')
+    record = pod_index_get(container_id)
+    if record:
+        ip_address = record["ip"]
+    else:
+        (veth_outside, external_ids) = get_pod_interface(container_id)
+        ip_address = external_ids.get("ip_address", "")
     if ip_address:
         style = {"ip": ip_address}
         print json.dumps(style)
@@ -274,36 +1430,352 @@ def plugin_teardown(args):
     pod_name = args.k8_args[1]
     container_id = args.k8_args[2]
 
-    get_ovn_remote()
+    record = pod_index_get(container_id)
+    pod_index_remove(container_id)
+
+    with span("step", "node-config"):
+        get_node_config()
 
-    veth_outside = container_id[0:15]
-    command = "ip link delete %s" % (veth_outside)
+    if record:
+        veth_outside = record["interface"]
+        lport = record.get("lport", container_id)
+        security_group = record.get("security_group")
+    else:
+        with span("step", "ovs-lookup"):
+            (veth_outside, external_ids) = get_pod_interface(container_id)
+        lport = external_ids.get("iface-id", container_id)
+        security_group = external_ids.get("security_group")
+    if not veth_outside:
+        veth_outside = container_id[0:15]
     try:
-        call_popen(shlex.split(command))
+        with span("step", "link-delete"):
+            pod_link_delete(veth_outside)
     except Exception as e:
         error = "Failed to delete veth_outside (%s)" % (str(e))
         sys.stderr.write(error)
 
-    annotations = get_annotations(ns, pod_name)
-    if annotations:
-        security_group = annotations.get("security-group", "")
-        if security_group:
-            disassociate_security_group(container_id)
+    # Only local state decides what to clean up. Ports that predate
+    # recording the security group may have one.
+    if security_group != "":
+        disassociate_security_group(lport)
 
+    # The OVS port goes first, so that the lport is no longer bound when
+    # it is back in the pool. Should that fail, reconcile puts it back.
+    deleted = True
     try:
-        ovn_nbctl("lport-del %s" % container_id)
+        with span("step", "ovs-port"):
+            ovs_vsctl("--if-exists del-port %s" % (veth_outside))
     except Exception as e:
-        error = "failed to delete logical port (%s)" % (str(e))
+        deleted = False
+        error = "failed to delete OVS port (%s)" % (veth_outside)
         sys.stderr.write(error)
 
+    with span("step", "ovn-lport"):
+        pod_lport_unbind([lport], release=deleted)
+
+
+def pod_batch_parse(args):
+    # Pods are given as NAMESPACE/POD/CONTAINER_ID, on the command line
+    # and, one per line, in --file.
+    entries = list(args.pods)
+    if args.file:
+        if args.file == "-":
+            entries.extend(sys.stdin.read().split())
+        else:
+            with open(args.file) as fd:
+                entries.extend(fd.read().split())
+
+    pods = []
+    for entry in entries:
+        fields = entry.split("/")
+        if len(fields) != 3 or not all(fields):
+            sys.exit("%s is not NAMESPACE/POD/CONTAINER_ID" % (entry))
+        pods.append(tuple(fields))
+    return pods
+
+
+def pod_batch_run(function, pods, workers):
+    # Calls function(pod) for every pod, at most 'workers' at a time.
+    # Returns a (result, error) per pod.
+    from multiprocessing.pool import ThreadPool
+
+    command = getattr(SPAN_CONTEXT, "command", "background")
+
+    def run(pod):
+        SPAN_CONTEXT.command = command
+        SPAN_CONTEXT.container_id = pod[2]
+        try:
+            return (function(pod), None)
+        except SystemExit as e:
+            return (None, str(e.code) if e.code else None)
+        except Exception as e:
+            return (None, str(e))
+
+    if not pods:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(pods))))
+    try:
+        return pool.map(run, pods)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def pod_batch_report(pods, errors):
+    for pod in pods:
+        if pod in errors:
+            sys.stderr.write("%s/%s: %s\n" % (pod[0], pod[1], errors[pod]))
+    if errors:
+        sys.exit("%d of %d pods failed" % (len(errors), len(pods)))
+
+
+def pod_interfaces():
+    # Every interface with its external_ids, by container id and by name,
+    # from a single dump of the Interface table.
+    interfaces = {}
+    for row in ovs_vsctl_list("interface", ["name", "external_ids"]):
+        interfaces[row["name"]] = (row["name"], row["external_ids"])
+        container_id = row["external_ids"].get("container_id")
+        if container_id:
+            interfaces[container_id] = (row["name"], row["external_ids"])
+    return interfaces
+
+
+def plugin_setup_batch(args):
+    pods = pod_batch_parse(args)
+    errors = {}
+
+    with span("step", "node-config"):
+        get_node_config()
+    if not LSWITCH:
+        error = "No lswitch created for this host"
+        sys.exit(error)
+
+    def link(pod):
+        return pod_link(pod[2]) + (pod_security_group(pod[0], pod[1]),)
+
+    links = {}
+    for (pod, (result, error)) in zip(pods, pod_batch_run(link, pods,
+                                                          args.workers)):
+        if error:
+            errors[pod] = error
+        else:
+            links[pod] = result
+
+    # The lports, and then the OVS ports, of all the pods are created, or
+    # bound, in one transaction each. Should one fail, its commands are run
+    # one by one so that one bad pod does not fail the others.
+    linked = [pod for pod in pods if pod in links]
+    with span("step", "lport-claim"):
+        lports = lport_pool_claim(len(linked))
+    lports = dict(zip(linked, lports + [pod[2] for pod in
+                                        linked[len(lports):]]))
+    commands = dict([(pod, pod_lport_command(lports[pod], links[pod][0]))
+                     for pod in linked])
+    if commands:
+        try:
+            with span("step", "ovn-lport"):
+                ovn_nbctl(" -- ".join(commands.values()))
+        except Exception:
+            for (pod, command) in commands.items():
+                try:
+                    ovn_nbctl(command)
+                except Exception as e:
+                    errors[pod] = "lport-add %s" % (str(e))
+            pod_lport_unbind([lports[pod] for pod in commands
+                              if pod in errors and lport_pooled(lports[pod])])
+
+    commands = dict([(pod, pod_port_command(pod[2], lports[pod],
+                                            *links[pod]))
+                     for pod in linked if pod not in errors])
+    if commands:
+        try:
+            with span("step", "ovs-port"):
+                ovs_vsctl(" -- ".join(commands.values()))
+        except Exception:
+            for (pod, command) in commands.items():
+                try:
+                    ovs_vsctl(command)
+                except Exception as e:
+                    errors[pod] = ("failed to create a OVS port. (%s)"
+                                   % (str(e)))
+            pod_lport_unbind([lports[pod] for pod in commands
+                              if pod in errors])
+    attached = [pod for pod in pods if pod in links and pod not in errors]
+    for pod in linked:
+        if pod in errors:
+            pod_unlink(links[pod][1], links[pod][2])
+
+    for pod in attached:
+        pod_index_add(pod[2], {"ip": links[pod][0]["ip_address"],
+                               "interface": links[pod][1],
+                               "lport": lports[pod],
+                               "security_group": links[pod][3]})
+
+    def secure(pod):
+        associate_security_group(lports[pod], links[pod][3])
+
+    secured = [pod for pod in attached if links[pod][3]]
+    for (pod, (result, error)) in zip(secured, pod_batch_run(secure,
+                                                             secured,
+                                                             args.workers)):
+        if error:
+            errors[pod] = error
+
+    pod_batch_report(pods, errors)
+
+
+def plugin_teardown_batch(args):
+    pods = pod_batch_parse(args)
+    errors = {}
+
+    for pod in pods:
+        pod_index_remove(pod[2])
+
+    with span("step", "node-config"):
+        get_node_config()
+
+    with span("step", "ovs-lookup"):
+        interfaces = pod_interfaces()
+    ports = {}
+    lports = {}
+    security_groups = {}
+    for pod in pods:
+        (veth_outside, external_ids) = interfaces.get(pod[2], (None, {}))
+        ports[pod] = veth_outside or pod[2][0:15]
+        lports[pod] = external_ids.get("iface-id", pod[2])
+        security_groups[pod] = external_ids.get("security_group")
+
+    def unlink(pod):
+        try:
+            with span("step", "link-delete"):
+                pod_link_delete(ports[pod])
+        except Exception as e:
+            error = "Failed to delete veth_outside (%s)" % (str(e))
+            sys.stderr.write(error)
+
+        if security_groups[pod] != "":
+            disassociate_security_group(lports[pod])
+
+    for (pod, (result, error)) in zip(pods, pod_batch_run(unlink, pods,
+                                                          args.workers)):
+        if error:
+            errors[pod] = error
+
+    if pods:
+        deleted = True
+        try:
+            with span("step", "ovs-port"):
+                ovs_vsctl(" -- ".join(["--if-exists del-port %s"
+                                       % (ports[pod]) for pod in pods]))
+        except Exception as e:
+            deleted = False
+            error = "failed to delete OVS ports (%s)" % (str(e))
+            sys.stderr.write(error)
+
+        with span("step", "ovn-lport"):
+            pod_lport_unbind([lports[pod] for pod in pods],
+                             release=deleted)
+
+    pod_batch_report(pods, errors)
+
+
+class AgentOutput(object):
+    """Stands in for sys.stdout/sys.stderr inside the agent so that each
+    request thread writes into its own buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buf = StringIO.StringIO()
+
+    def release(self):
+        output = self.local.buf.getvalue()
+        self.local.buf = None
+        return output
+
+    def write(self, data):
+        buf = getattr(self.local, "buf", None)
+        if buf is None:
+            self.stream.write(data)
+        else:
+            buf.write(data)
+
+    def flush(self):
+        if getattr(self.local, "buf", None) is None:
+            self.stream.flush()
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class AgentHandler(SocketServer.StreamRequestHandler):
+    """Runs one shim request, i.e. a JSON object with the command line
+    that kubelet handed to the shim, and replies with its exit status and
+    output."""
+
+    def handle(self):
+        try:
+            argv = json.loads(self.rfile.readline())["argv"]
+        except Exception as e:
+            sys.stderr.write("agent: malformed request (%s)\n" % (str(e)))
+            return
+
+        sys.stdout.capture()
+        sys.stderr.capture()
+        status = 0
+        try:
+            args = get_parser().parse_args(argv)
+            if args.func == plugin_agent:
+                sys.exit("agent is already running")
+            run_command(args)
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                sys.stderr.write("%s\n" % (e.code))
+                status = 1
+        except Exception as e:
+            sys.stderr.write("%s failed (%s)\n" % (" ".join(argv), str(e)))
+            status = 1
+
+        reply = {"status": status,
+                 "stdout": sys.stdout.release(),
+                 "stderr": sys.stderr.release()}
+        self.wfile.write(json.dumps(reply) + "\n")
+
+
+def plugin_agent(args):
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    sys.stdout = AgentOutput(sys.stdout)
+    sys.stderr = AgentOutput(sys.stderr)
+
+    start_ovsdb_replica()
+
     try:
-        ovs_vsctl("del-port %s" % (veth_outside))
+        with span("step", "reconcile"):
+            pod_reconcile()
     except Exception as e:
-        error = "failed to delete OVS port (%s)" % (veth_outside)
-        sys.stderr.write(error)
+        sys.stderr.write("reconcile: %s\n" % (str(e)))
 
+    start_pod_informer()
+    ContainerWatcher().start()
+    start_veth_pool()
+    start_lport_pool()
 
-def main():
+    server = AgentServer(args.socket, AgentHandler)
+    os.chmod(args.socket, 0o600)
+    server.serve_forever()
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(title='Subcommands',
                                        dest='command_name')
@@ -322,8 +1794,11 @@ def main():
     # Parser for sub-command status
     parser_plugin_status = subparsers.add_parser('status',
                                                  help="pod status")
-    parser_plugin_status.add_argument('k8_args', nargs=3,
+    parser_plugin_status.add_argument('k8_args', nargs='*',
                                       help='arguments passed by kubectl')
+    parser_plugin_status.add_argument('--all', action='store_true',
+                                      help="status of every pod on this "
+                                      "node, as JSON")
     parser_plugin_status.set_defaults(func=plugin_status)
 
     # Parser for sub-command teardown
@@ -333,8 +1808,37 @@ def main():
                                         help='arguments passed by kubectl')
     parser_plugin_teardown.set_defaults(func=plugin_teardown)
 
-    args = parser.parse_args()
-    args.func(args)
+    # Parsers for sub-commands setup-batch and teardown-batch
+    for (name, func, action) in (('setup-batch', plugin_setup_batch,
+                                  "Set up"),
+                                 ('teardown-batch', plugin_teardown_batch,
+                                  "Tear down")):
+        parser_batch = subparsers.add_parser(
+                            name, help="%s many pods at once" % (action))
+        parser_batch.add_argument('pods', nargs='*',
+                                  metavar="NAMESPACE/POD/CONTAINER_ID")
+        parser_batch.add_argument('--file', help="file with more pods, "
+                                  "one per line ('-' for stdin)")
+        parser_batch.add_argument('--workers', type=int, default=8,
+                                  help="pods worked on in parallel "
+                                  "(default: 8)")
+        parser_batch.set_defaults(func=func)
+
+    # Parser for sub-command agent
+    parser_plugin_agent = subparsers.add_parser(
+                                'agent', help="Run as a long lived node "
+                                "agent serving the kubelet shim")
+    parser_plugin_agent.add_argument('--socket', default=AGENT_SOCKET,
+                                     help="unix socket to listen on "
+                                     "(default: %s)" % AGENT_SOCKET)
+    parser_plugin_agent.set_defaults(func=plugin_agent)
+
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    run_command(args)
 
 if __name__ == '__main__':
     main()
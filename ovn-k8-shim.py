@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# Minimal kubelet network plugin that forwards its arguments to the
+# ovn-k8-overlay.py / ovn-k8-underlay.py node agent and relays the reply.
+# It deliberately imports nothing beyond the standard library basics so that
+# every kubelet call stays cheap.
+import json
+import socket
+import sys
+
+AGENT_SOCKET = "/var/run/openvswitch/ovn-k8.sock"
+
+
+def main():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(AGENT_SOCKET)
+    except socket.error as e:
+        sys.exit("failed to connect to the ovn-k8 agent at %s (%s)"
+                 % (AGENT_SOCKET, str(e)))
+
+    sock.sendall(json.dumps({"argv": sys.argv[1:]}) + "\n")
+    sock.shutdown(socket.SHUT_WR)
+
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    sock.close()
+
+    try:
+        reply = json.loads("".join(chunks))
+    except ValueError:
+        sys.exit("ovn-k8 agent closed the connection without replying")
+
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    sys.exit(reply["status"])
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,260 @@
 #!/usr/bin/python
 import argparse
-import ast
-import atexit
-import getpass
+import calendar
+import contextlib
+import fcntl
 import json
+import mmap
 import os
-import re
-import requests
+import Queue
 import shlex
+import socket
+import SocketServer
+import StringIO
+import struct
 import subprocess
 import sys
+import threading
 import time
-import uuid
-
-import ovs.util
-import ovs.daemon
-
-from neutronclient.v2_0 import client
-from docker import Client
 
+AGENT_SOCKET = "/var/run/openvswitch/ovn-k8.sock"
+ANNOTATIONS_CACHE = {}
+ANNOTATIONS_TTL = 5
+API_SERVER = ""
+API_SESSION = None
 AUTH_STRATEGY = ""
 AUTH_URL = ""
+CONTAINER_CACHE = {}
+CONTAINER_CACHE_SIZE = 4096
+DOCKER_CLIENT = None
+DOCKER_URL = "unix://var/run/docker.sock"
+FLOW_CHECK_INTERVAL = 2
+FLOW_COOKIE = "0x4b38"
+FLOW_MONITOR = None
+FLOW_RESYNC_INTERVAL = 300
+FLOW_STAMP = "/var/run/openvswitch/ovn-k8-flows.pid"
+LPORT_CACHE = "/etc/openvswitch/ovn-k8-lport.cache"
+LPORT_CACHE_FDS = {}
+LPORT_CACHE_LOCK = threading.Lock()
+LPORT_CACHE_MAPS = {}
+LPORT_POOL = None
+LPORT_SHARDS = None
+MAX_VLAN = 4095
+METRICS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10]
+METRICS_FILE = "/var/lib/node_exporter/textfile_collector/ovn-k8.prom"
+METRICS_STATE = "/var/run/openvswitch/ovn-k8-metrics.json"
+# FIXME Add the correct linux bridge.
+NEIGH_DEVICE = "breth1"
+# Node-wide flows owned by this plugin, tagged with FLOW_COOKIE.
+NODE_FLOWS = ["priority=65000,ipv6 actions=drop"]
+NEUTRON = None
+NEUTRON_CONFIG = ""
+NEUTRON_CONFIG_MTIME = 0
+NEUTRON_TOKEN = None
+NEUTRON_WORKER = threading.local()
+NUD_PERMANENT = 0x80
 OVN_BRIDGE = "br-int"
+OVSDB_REMOTE = "unix:/var/run/openvswitch/db.sock"
+OVSDB_REPLICA = None
 PASSWORD = ""
+POD_INDEX = {}
+POD_INDEX_DIR = "/var/run/openvswitch/ovn-k8-pods"
+POD_INFORMER = None
+SECURITY_GROUP_QUEUE = None
+SECURITY_GROUP_QUEUE_DIR = "/var/run/openvswitch/ovn-k8-sg-queue"
+SPAN_CONTEXT = threading.local()
+SPAN_LOG = "/var/log/openvswitch/ovn-k8-spans.log"
+SPANS = []
+SPANS_LOCK = threading.Lock()
 TENANT_ID = ""
+TIMED_COMMANDS = ["setup", "teardown", "setup-batch",
+                  "teardown-batch"]
+TOKEN_CACHE = ""
+TOKEN_LIFETIME = 3000   # when Keystone gives no expiry
+TOKEN_MARGIN = 60
 USERNAME = ""
+VETH_POOL = None
 VIF_ID = ""
+VSWITCHD_PIDFILE = "/var/run/openvswitch/ovs-vswitchd.pid"
+
+
+# Timing spans. Steps of pod setup and teardown, and every run of an
+# external program, are timed and buffered; when one of TIMED_COMMANDS
+# finishes, its spans are appended as JSON lines to SPAN_LOG and folded
+# into histograms that are written out for node_exporter's textfile
+# collector. Either output is skipped while its directory does not exist.
+METRIC_FAMILIES = {
+    "command": ("ovn_k8_command_duration_seconds", ["command"],
+                "Time taken by each plugin command."),
+    "step": ("ovn_k8_step_duration_seconds", ["command", "step"],
+             "Time taken by each step of pod setup and teardown."),
+    "exec": ("ovn_k8_exec_duration_seconds", ["program"],
+             "Time taken by each run of an external program."),
+}
+
+
+@contextlib.contextmanager
+def span(kind, name):
+    # Nothing is recorded for the commands that are not timed.
+    if getattr(SPAN_CONTEXT, "command", "background") is None:
+        yield
+        return
+
+    start = time.time()
+    failed = False
+    try:
+        yield
+    except SystemExit as e:
+        failed = bool(e.code)
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        record = {"time": start, "kind": kind, "name": name,
+                  "duration": time.time() - start, "failed": failed,
+                  "command": getattr(SPAN_CONTEXT, "command", "background"),
+                  "container_id": getattr(SPAN_CONTEXT, "container_id", "")}
+        with SPANS_LOCK:
+            SPANS.append(record)
+
+
+def metrics_labels(record):
+    if record["kind"] == "command":
+        return [record["name"]]
+    elif record["kind"] == "step":
+        return [record["command"], record["name"]]
+    return [record["name"]]
+
+
+def metrics_render(state):
+    lines = []
+    for kind in sorted(METRIC_FAMILIES):
+        (metric, label_names, description) = METRIC_FAMILIES[kind]
+        histograms = state.get(kind, {})
+        lines.append("# HELP %s %s" % (metric, description))
+        lines.append("# TYPE %s histogram" % (metric))
+        for key in sorted(histograms):
+            histogram = histograms[key]
+            labels = ",".join(['%s="%s"' % (label, value) for (label, value)
+                               in zip(label_names, key.split("\t"))])
+            for (bound, count) in zip(METRICS_BUCKETS, histogram["buckets"]):
+                lines.append('%s_bucket{%s,le="%s"} %d'
+                             % (metric, labels, bound, count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d'
+                         % (metric, labels, histogram["count"]))
+            lines.append("%s_sum{%s} %f" % (metric, labels, histogram["sum"]))
+            lines.append("%s_count{%s} %d"
+                         % (metric, labels, histogram["count"]))
+
+        failures = metric.replace("_duration_seconds", "_failures_total")
+        lines.append("# HELP %s Failures counted in %s." % (failures, metric))
+        lines.append("# TYPE %s counter" % (failures))
+        for key in sorted(histograms):
+            labels = ",".join(['%s="%s"' % (label, value) for (label, value)
+                               in zip(label_names, key.split("\t"))])
+            lines.append("%s{%s} %d" % (failures, labels,
+                                        histograms[key]["failures"]))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_update(spans):
+    # The histograms outlive the process in METRICS_STATE, which is locked
+    # while they are updated so that concurrent plugin calls add up.
+    fd = os.open(METRICS_STATE, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            state = json.load(f)
+        except ValueError:
+            state = {}
+
+        for record in spans:
+            histograms = state.setdefault(record["kind"], {})
+            key = "\t".join(metrics_labels(record))
+            histogram = histograms.setdefault(
+                            key, {"buckets": [0] * len(METRICS_BUCKETS),
+                                  "sum": 0.0, "count": 0, "failures": 0})
+            for (i, bound) in enumerate(METRICS_BUCKETS):
+                if record["duration"] <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += record["duration"]
+            histogram["count"] += 1
+            if record["failed"]:
+                histogram["failures"] += 1
+
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+
+        tmp = "%s.%d" % (METRICS_FILE, os.getpid())
+        with open(tmp, "w") as prom:
+            prom.write(metrics_render(state))
+        os.rename(tmp, METRICS_FILE)
+
+
+def spans_flush():
+    with SPANS_LOCK:
+        spans = SPANS[:]
+        del SPANS[:]
+    if not spans:
+        return
 
+    try:
+        if os.path.isdir(os.path.dirname(SPAN_LOG)):
+            with open(SPAN_LOG, "a") as fd:
+                fd.write("".join([json.dumps(record) + "\n"
+                                  for record in spans]))
+        if os.path.isdir(os.path.dirname(METRICS_FILE)):
+            metrics_update(spans)
+    except (IOError, OSError) as e:
+        sys.stderr.write("failed to record timings (%s)" % (str(e)))
+
+
+def run_command(args):
+    # Runs a subcommand inside a span named after it and writes out the
+    # spans it produced. Other commands, e.g. status, which kubelet calls
+    # often, skip the timing and the write out altogether.
+    if args.func == plugin_agent:
+        args.func(args)
+        return
 
-def call_popen(cmd):
-    child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    output = child.communicate()
-    if child.returncode:
-        raise RuntimeError("Fatal error executing %s" % (cmd))
-    if len(output) == 0 or output[0] == None:
-        output = ""
-    else:
-        output = output[0].strip()
-    return output
+    if args.command_name not in TIMED_COMMANDS:
+        SPAN_CONTEXT.command = None
+        try:
+            args.func(args)
+        finally:
+            SPAN_CONTEXT.command = "background"
+        return
+
+    SPAN_CONTEXT.command = args.command_name
+    k8_args = getattr(args, "k8_args", None) or []
+    SPAN_CONTEXT.container_id = k8_args[2] if len(k8_args) > 2 else ""
+    try:
+        with span("command", args.command_name):
+            args.func(args)
+    finally:
+        SPAN_CONTEXT.command = "background"
+        SPAN_CONTEXT.container_id = ""
+        spans_flush()
+
+
+def call_popen(cmd, stdin=None):
+    with span("exec", os.path.basename(cmd[0])):
+        if stdin is None:
+            child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        else:
+            child = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                     stdin=subprocess.PIPE)
+        output = child.communicate(stdin)
+        if child.returncode:
+            raise RuntimeError("Fatal error executing %s" % (cmd))
+        if len(output) == 0 or output[0] == None:
+            output = ""
+        else:
+            output = output[0].strip()
+        return output
 
 
 def call_prog(prog, args_list):
@@ -49,123 +266,732 @@ def ovs_vsctl(args):
     return call_prog("ovs-vsctl", shlex.split(args))
 
 
+def ovsdb_datum(value):
+    # Converts a column value from ovs-vsctl's --data=json output.
+    if isinstance(value, list):
+        if value[0] == "map":
+            return dict((k, ovsdb_datum(v)) for k, v in value[1])
+        elif value[0] == "set":
+            return [ovsdb_datum(v) for v in value[1]]
+        else:
+            return value[1]
+    return value
+
+
+def ovs_vsctl_rows(output):
+    data = json.loads(output)
+    rows = []
+    for row in data["data"]:
+        rows.append(dict(zip(data["headings"],
+                             [ovsdb_datum(value) for value in row])))
+    return rows
+
+
+def ovs_vsctl_list(table, columns, record=""):
+    if not record:
+        rows = ovsdb_select(table, columns)
+        if rows is not None:
+            return rows
+    return ovs_vsctl_rows(ovs_vsctl("--format=json --data=json --columns=%s "
+                                    "list %s %s"
+                                    % (",".join(columns), table, record)))
+
+
+def ovs_vsctl_find(table, columns, condition):
+    rows = ovsdb_select(table, columns, [condition])
+    if rows is not None:
+        return rows
+    return ovs_vsctl_rows(ovs_vsctl("--format=json --data=json --columns=%s "
+                                    "find %s %s"
+                                    % (",".join(columns), table, condition)))
+
+
+class OvsdbReplica(threading.Thread):
+    """Keeps an in-memory replica of some columns of an OVSDB database over
+    one long lived connection, so that a long running agent answers reads
+    from memory instead of running ovs-vsctl. The IDL's rows are slow to
+    read, so every row it changes is copied into a plain dict, which is
+    what select() searches. Until the replica has its first copy of the
+    database, and while the connection is down, select() returns None and
+    callers go to the command line tools instead. 'synced' is set once the
+    first copy is in, or the first attempt to get it has failed."""
+
+    def __init__(self, remote, database, columns):
+        threading.Thread.__init__(self, name="ovsdb-%s" % (database))
+        self.daemon = True
+        self.remote = remote
+        self.database = database
+        self.columns = columns
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.idl = None
+        self.changed = set()
+        self.names = dict([(table.lower(), table) for table in columns])
+        self.rows = dict([(table, {}) for table in columns])
+
+    def connect(self):
+        import ovs.db.idl
+        import ovs.jsonrpc
+        import ovs.stream
+
+        # The schema is fetched once; the IDL then only monitors the
+        # columns registered here.
+        (error, stream) = ovs.stream.Stream.open_block(
+                                ovs.stream.Stream.open(self.remote))
+        if error:
+            raise RuntimeError("failed to connect to %s (%s)"
+                               % (self.remote, os.strerror(error)))
+        rpc = ovs.jsonrpc.Connection(stream)
+        try:
+            (error, reply) = rpc.transact_block(
+                    ovs.jsonrpc.Message.create_request("get_schema",
+                                                       [self.database]))
+        finally:
+            rpc.close()
+        if error or reply.error:
+            raise RuntimeError("failed to fetch the %s schema"
+                               % (self.database))
+
+        helper = ovs.db.idl.SchemaHelper(schema_json=reply.result)
+        for (table, columns) in self.columns.items():
+            helper.register_columns(table, columns)
+        self.idl = ovs.db.idl.Idl(self.remote, helper)
+        self.idl.notify = self.notify
+
+    def notify(self, event, row, updates=None):
+        # Called by the IDL, from its run(), for every row it changes.
+        self.changed.add((row._table.name, row.uuid))
+
+    def copy_rows(self):
+        changed = {}
+        for (table, uuid) in self.changed:
+            row = self.idl.tables[table].rows.get(uuid)
+            if row:
+                row = dict([(column, getattr(row, column))
+                            for column in self.columns[table]])
+            changed.setdefault(table, {})[uuid] = row
+        self.changed.clear()
+
+        # Rows dropped while reconnecting are not notified; a table whose
+        # row count is off is copied again in full.
+        for (table, replica) in self.idl.tables.items():
+            rows = self.rows[table]
+            for (uuid, row) in changed.get(table, {}).items():
+                if row:
+                    rows[uuid] = row
+                else:
+                    rows.pop(uuid, None)
+            if len(rows) != len(replica.rows):
+                rows.clear()
+                for (uuid, row) in replica.rows.items():
+                    rows[uuid] = dict([(column, getattr(row, column))
+                                       for column in self.columns[table]])
+
+    def select(self, table, columns, conditions=[]):
+        # The rows of 'table' that match every "column[:key]=value" in
+        # 'conditions', with 'columns', as ovs_vsctl_rows() returns them.
+        with self.lock:
+            if (not self.idl or not self.idl.has_ever_connected() or
+                    not self.idl._session.is_connected()):
+                return None
+
+            table = self.names.get(table.lower())
+            matches = []
+            for condition in conditions:
+                (column, value) = condition.split("=", 1)
+                (column, key) = (column.split(":", 1) + [None])[0:2]
+                matches.append((column.replace("-", "_"), key, value))
+            needed = set(columns + [match[0] for match in matches])
+            if not table or not needed.issubset(self.columns[table]):
+                return None
+
+            selected = []
+            for row in self.rows[table].values():
+                for (column, key, value) in matches:
+                    actual = row[column]
+                    if key is not None:
+                        actual = actual.get(key)
+                    if actual != value:
+                        break
+                else:
+                    selected.append(dict([(column, row[column])
+                                          for column in columns]))
+            return selected
+
+    def run(self):
+        try:
+            import ovs.poller
+        except ImportError:
+            sys.stderr.write("ovs python library not found, reading the "
+                             "database with ovs-vsctl\n")
+            self.synced.set()
+            return
+
+        while True:
+            try:
+                if not self.idl:
+                    self.connect()
+                poller = ovs.poller.Poller()
+                seqno = self.idl.change_seqno
+                self.idl.run()
+                self.idl.wait(poller)
+                if self.idl.change_seqno != seqno or self.changed:
+                    with self.lock:
+                        self.copy_rows()
+                if self.idl.has_ever_connected():
+                    self.synced.set()
+                poller.block()
+            except Exception as e:
+                sys.stderr.write("ovsdb replica: %s\n" % (str(e)))
+                self.synced.set()
+                time.sleep(5)
+
+
+def start_ovsdb_replica():
+    # Replicates the columns the plugin reads from the local Open_vSwitch
+    # database, and waits a little for the first copy.
+    global OVSDB_REPLICA
+    OVSDB_REPLICA = OvsdbReplica(OVSDB_REMOTE, "Open_vSwitch",
+                                 {"Open_vSwitch": ["external_ids"],
+                                  "Interface": ["name", "external_ids"]})
+    OVSDB_REPLICA.start()
+    OVSDB_REPLICA.synced.wait(2)
+
+
+def ovsdb_select(table, columns, conditions=[]):
+    if not OVSDB_REPLICA:
+        return None
+    return OVSDB_REPLICA.select(table, columns, conditions)
+
+
 def neutron_setup():
     global USERNAME, PASSWORD, TENANT_ID, AUTH_URL, AUTH_STRATEGY, VIF_ID
+    global NEUTRON, NEUTRON_CONFIG, NEUTRON_CONFIG_MTIME, TOKEN_CACHE
+
+    if not NEUTRON_CONFIG:
+        NEUTRON_CONFIG = ovs_vsctl("--if-exists get open_vswitch . "
+                                   "external-ids:neutron-config").strip('"')
+        if not NEUTRON_CONFIG:
+            raise RuntimeError("Neutron config file not specified")
 
-    CONFIG_FILE = ovs_vsctl("--if-exists get open_vswitch . "
-                            "external-ids:neutron-config").strip('"')
-    if not CONFIG_FILE:
-        sys.exit("Neutron config file not specified")
+    # The parsed config is kept for as long as the file does not change.
+    try:
+        mtime = os.stat(NEUTRON_CONFIG).st_mtime
+    except OSError as e:
+        raise RuntimeError("failed to read %s (%s)"
+                           % (NEUTRON_CONFIG, str(e)))
+    if VIF_ID and mtime == NEUTRON_CONFIG_MTIME:
+        return
 
     key_value = {}
-    with open(CONFIG_FILE) as fd:
+    with open(NEUTRON_CONFIG) as fd:
         for line in fd:
             output = line.rstrip('\n').split('=', 1)
             key_value[output[0]] = output[1]
 
     VIF_ID = key_value.get('OS_VIF_ID', '').strip('"')
     if not VIF_ID:
-        sys.exit("OS_VIF_ID not set")
+        raise RuntimeError("OS_VIF_ID not set")
     USERNAME = key_value.get('OS_USERNAME', '').strip('"')
     if not USERNAME:
-        sys.exit("OS_USERNAME not set")
+        raise RuntimeError("OS_USERNAME not set")
     TENANT_ID = key_value.get('OS_TENANT_ID', '').strip('"')
     if not TENANT_ID:
-        sys.exit("OS_TENANT_ID not set")
+        raise RuntimeError("OS_TENANT_ID not set")
     AUTH_URL = key_value.get('OS_AUTH_URL', '').strip('"')
     if not AUTH_URL:
-        sys.exit("OS_AUTH_URL not set")
+        raise RuntimeError("OS_AUTH_URL not set")
     AUTH_STRATEGY = "keystone"
 
     PASSWORD = key_value.get('OS_PASSWORD', '').strip('"')
     if not PASSWORD:
-        sys.exit("OS_PASSWORD not set")
+        raise RuntimeError("OS_PASSWORD not set")
+
+    # Optional file in which the Keystone token is shared between processes.
+    TOKEN_CACHE = key_value.get('OS_TOKEN_CACHE', '').strip('"')
+
+    NEUTRON_CONFIG_MTIME = mtime
+    NEUTRON = None
+
+
+def neutron_client(token=None):
+    # With a token the client skips Keystone until Neutron answers 401, at
+    # which point it authenticates again with the credentials.
+    kwargs = {"username": USERNAME,
+              "password": PASSWORD,
+              "tenant_id": TENANT_ID,
+              "auth_url": AUTH_URL,
+              "auth_strategy": AUTH_STRATEGY}
+    if token:
+        kwargs["token"] = token["token"]
+        kwargs["endpoint_url"] = token["endpoint_url"]
+    from neutronclient.v2_0 import client
+    neutron = client.Client(**kwargs)
+
+    # Every login, including the one after a 401, replaces the shared token.
+    authenticate = neutron.httpclient.authenticate
+
+    def neutron_authenticate():
+        authenticate()
+        neutron_token_renew(neutron.httpclient)
+    neutron.httpclient.authenticate = neutron_authenticate
+    return neutron
+
+
+def neutron_token_load():
+    if not TOKEN_CACHE:
+        return None
+
+    try:
+        with open(TOKEN_CACHE) as fd:
+            token = json.load(fd)
+    except (IOError, ValueError):
+        return None
+
+    if (token.get("auth_url") != AUTH_URL or
+       token.get("username") != USERNAME or
+       token.get("tenant_id") != TENANT_ID or
+       token.get("expires", 0) < time.time()):
+        return None
+    return token
+
+
+def neutron_token_save(token):
+    if not TOKEN_CACHE:
+        return
+
+    tmp = "%s.%d" % (TOKEN_CACHE, os.getpid())
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(token, f)
+        os.rename(tmp, TOKEN_CACHE)
+    except (IOError, OSError) as e:
+        sys.stderr.write("failed to save the neutron token (%s)" % str(e))
+
+
+def neutron_token_renew(httpclient):
+    global NEUTRON_TOKEN
+    expires = time.time() + TOKEN_LIFETIME
+    auth_ref = httpclient.get_auth_ref()
+    if auth_ref and auth_ref.expires:
+        expires = (calendar.timegm(auth_ref.expires.utctimetuple()) -
+                   TOKEN_MARGIN)
+
+    token = {"token": httpclient.auth_token,
+             "endpoint_url": httpclient.endpoint_url,
+             "expires": expires,
+             "auth_url": AUTH_URL,
+             "username": USERNAME,
+             "tenant_id": TENANT_ID}
+    neutron_token_save(token)
+    NEUTRON_TOKEN = token
 
 
 def neutron_login():
+    global NEUTRON, NEUTRON_TOKEN
     neutron_setup()
+    if NEUTRON and NEUTRON_TOKEN["expires"] > time.time():
+        return NEUTRON
+
     try:
-        neutron = client.Client(username=USERNAME,
-                                password=PASSWORD,
-                                tenant_id=TENANT_ID,
-                                auth_url=AUTH_URL,
-                                auth_strategy=AUTH_STRATEGY)
+        token = neutron_token_load()
+        if token:
+            neutron = neutron_client(token)
+            NEUTRON_TOKEN = token
+        else:
+            neutron = neutron_client()
+            neutron.httpclient.authenticate()
     except Exception as e:
         raise RuntimeError("Failed to login into Neutron(%s)" % str(e))
-    return neutron
 
+    NEUTRON = neutron
+    return NEUTRON
+
+
+def neutron_worker_login():
+    # Neutron clients are not safe to share between threads, so each thread
+    # that talks to Neutron, be it a worker of a bulk job or an agent
+    # request, gets its own, built on the shared token.
+    neutron_login()
+    if getattr(NEUTRON_WORKER, "token", None) is not NEUTRON_TOKEN:
+        NEUTRON_WORKER.neutron = neutron_client(NEUTRON_TOKEN)
+        NEUTRON_WORKER.token = NEUTRON_TOKEN
+    return NEUTRON_WORKER.neutron
+
+
+# The lport cache is a file of fixed size records, one per vlan, behind a
+# small header. Records of unused ports are chained into a doubly linked
+# free list whose head lives in the header, so claiming, releasing and
+# removing a port only touches the header and a couple of records.
+#
+# Every update runs under cache_transaction(), which locks the file against
+# other processes and the agent's other threads. The state byte of a record
+# is the source of truth and is written first; the header's dirty flag is
+# set while the free list is being changed, so that if a process dies
+# halfway the next transaction rebuilds the list from the states.
+#
+# Vlan tags are only unique per parent VIF, so a node that needs more than
+# MAX_VLAN ports puts them behind several parent VIFs. Each of those shards
+# has its own cache file; shard 0 keeps the original one.
+CACHE_MAGIC = "OVNK8LPC"
+CACHE_HEADER = struct.Struct("!8siiB")   # magic, free head, free count,
+                                         # dirty
+CACHE_RECORD = struct.Struct("!Bii36s16sB17s16s64s")
+                                         # state, prev free, next free,
+                                         # port id, ip, netmask, mac,
+                                         # gateway, owner container
+CACHE_SIZE = CACHE_HEADER.size + CACHE_RECORD.size * (MAX_VLAN + 1)
+PORT_EMPTY = 0
+PORT_FREE = 1
+PORT_USED = 2
+
+
+def cache_path(shard=0):
+    if not shard:
+        return LPORT_CACHE
+    return "%s.%d" % (LPORT_CACHE, int(shard))
+
+
+def cache_open(shard=0):
+    shard = int(shard)
+    if shard in LPORT_CACHE_MAPS:
+        return LPORT_CACHE_MAPS[shard]
 
-def cache_port_init():
-    cache = ovs_vsctl("--if-exists  get open_vswitch . "
-                      "external-ids:lport-cache")
-    if cache:
-        sys.exit("cache already built for this node")
+    try:
+        fd = os.open(cache_path(shard), os.O_RDWR)
+    except OSError:
+        sys.exit("fatal error. cache not initialized")
+    cache = mmap.mmap(fd, CACHE_SIZE)
+
+    (magic, head, count, dirty) = CACHE_HEADER.unpack_from(cache)
+    if magic != CACHE_MAGIC:
+        sys.exit("fatal error. %s is not a lport cache" % cache_path(shard))
+    LPORT_CACHE_MAPS[shard] = cache
+    LPORT_CACHE_FDS[shard] = fd
+    return cache
+
+
+@contextlib.contextmanager
+def cache_transaction(shard=0):
+    cache = cache_open(shard)
+    fd = LPORT_CACHE_FDS[int(shard)]
+    with LPORT_CACHE_LOCK:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            (magic, head, count, dirty) = CACHE_HEADER.unpack_from(cache)
+            if dirty:
+                cache_rebuild_free_list(cache)
+            struct.pack_into("!B", cache, 16, 1)
 
-    ovs_vsctl("set open_vswitch . external-ids:lport-cache={}")
+            yield cache
 
+            struct.pack_into("!B", cache, 16, 0)
+            cache.flush()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
 
-def cache_port_destroy():
-    ovs_vsctl("--if-exists remove open_vswitch . external-ids lport-cache")
 
+def cache_read_header(cache):
+    (magic, head, count, dirty) = CACHE_HEADER.unpack_from(cache)
+    return (head, count)
 
-def cache_set_port_details(port_id, ip, netmask, mac, vlan, gateway_ip):
-    cache = ovs_vsctl("--if-exists  get open_vswitch . "
-                      "external-ids:lport-cache").strip('"')
-    if not cache:
-        sys.exit("fata error. cache not initialized")
 
-    cache_dict = ast.literal_eval(cache)
-    cache_dict[port_id] = {"ip": ip, "netmask": str(netmask), "mac": mac,
-                           "vlan": str(vlan), "gateway_ip": gateway_ip,
-                           "used": "no"}
-    ovs_vsctl("set open_vswitch . "
-              "external-ids:lport-cache=\"%s\"" % str(cache_dict))
+def cache_write_header(cache, head, count):
+    struct.pack_into("!ii", cache, 8, head, count)
 
 
-def cache_get_port_details(port_id):
-    cache = ovs_vsctl("--if-exists get open_vswitch . "
-                      "external-ids:lport-cache").strip('"')
-    if not cache:
-        sys.exit("fata error. cache not initialized")
+def cache_record_offset(vlan):
+    return CACHE_HEADER.size + CACHE_RECORD.size * vlan
+
+
+def cache_read_record(cache, vlan):
+    (state, prev_free, next_free, port_id, ip, netmask, mac, gateway_ip,
+     owner) = CACHE_RECORD.unpack_from(cache, cache_record_offset(vlan))
+    details = {"port_id": port_id.rstrip("\0"), "ip": ip.rstrip("\0"),
+               "netmask": str(netmask), "mac": mac.rstrip("\0"),
+               "vlan": str(vlan), "gateway_ip": gateway_ip.rstrip("\0"),
+               "used": "yes" if state == PORT_USED else "no",
+               "owner": owner.rstrip("\0")}
+    return (state, prev_free, next_free, details)
+
+
+def cache_write_record(cache, vlan, state, details):
+    # Neutron's replies are unicode, which struct does not pack.
+    CACHE_RECORD.pack_into(cache, cache_record_offset(vlan), state, -1, -1,
+                           str(details["port_id"]), str(details["ip"]),
+                           int(details["netmask"]), str(details["mac"]),
+                           str(details["gateway_ip"]), "")
+
+
+def cache_set_state(cache, vlan, state, owner=""):
+    struct.pack_into("!B", cache, cache_record_offset(vlan), state)
+    struct.pack_into("!64s", cache, cache_record_offset(vlan) +
+                     CACHE_RECORD.size - 64, owner)
+
+
+def cache_set_links(cache, vlan, prev_free, next_free):
+    struct.pack_into("!ii", cache, cache_record_offset(vlan) + 1,
+                     prev_free, next_free)
 
-    cache_dict = ast.literal_eval(cache)
-    lport_id = cache_dict.get(port_id, "")
-    if lport_id:
-        return cache_dict[lport_id]
+
+def cache_push_free(cache, vlan):
+    (head, count) = cache_read_header(cache)
+    cache_set_links(cache, vlan, -1, head)
+    if head >= 0:
+        (state, prev_free, next_free, details) = cache_read_record(cache,
+                                                                   head)
+        cache_set_links(cache, head, vlan, next_free)
+    cache_write_header(cache, vlan, count + 1)
+
+
+def cache_unlink_free(cache, vlan):
+    (head, count) = cache_read_header(cache)
+    (state, prev_free, next_free, details) = cache_read_record(cache, vlan)
+    if prev_free >= 0:
+        (s, p, n, d) = cache_read_record(cache, prev_free)
+        cache_set_links(cache, prev_free, p, next_free)
     else:
-        return None
+        head = next_free
+    if next_free >= 0:
+        (s, p, n, d) = cache_read_record(cache, next_free)
+        cache_set_links(cache, next_free, prev_free, n)
+    cache_set_links(cache, vlan, -1, -1)
+    cache_write_header(cache, head, count - 1)
+
+
+def cache_rebuild_free_list(cache):
+    cache_write_header(cache, -1, 0)
+    for vlan in range(MAX_VLAN, 0, -1):
+        (state, prev_free, next_free, details) = cache_read_record(cache,
+                                                                   vlan)
+        if state == PORT_FREE:
+            cache_push_free(cache, vlan)
+        else:
+            cache_set_links(cache, vlan, -1, -1)
+
+
+def cache_port_init(shard=0):
+    if os.path.exists(cache_path(shard)):
+        sys.exit("cache already built for this node")
+
+    with open(cache_path(shard), "wb") as fd:
+        fd.write(CACHE_HEADER.pack(CACHE_MAGIC, -1, 0, 0))
+        fd.write("\0" * (CACHE_SIZE - CACHE_HEADER.size))
+        fd.flush()
+        os.fsync(fd.fileno())
 
 
-def cache_get_free_port():
+def cache_import_external_ids():
+    # Older versions kept the cache as a dict in the Open_vSwitch table's
+    # external-ids:lport-cache. Moves it, once, into the cache file so that
+    # an upgraded node keeps its lports. Used ports get their owners back
+    # from reconcile. Returns the number of ports imported.
     cache = ovs_vsctl("--if-exists get open_vswitch . "
                       "external-ids:lport-cache").strip('"')
     if not cache:
-        sys.exit("fata error. cache not initialized")
+        return 0
+    if os.path.exists(LPORT_CACHE):
+        sys.stderr.write("external-ids:lport-cache left alone, %s already "
+                         "exists\n" % (LPORT_CACHE))
+        return 0
+
+    import ast
+    ports = []
+    used = []
+    for (port_id, details) in ast.literal_eval(cache).items():
+        if not 0 < int(details["vlan"]) <= MAX_VLAN:
+            sys.stderr.write("lport %s has vlan %s, not imported\n"
+                             % (port_id, details["vlan"]))
+            continue
+        ports.append(dict(details, port_id=port_id))
+        if details.get("used") == "yes":
+            used.append(int(details["vlan"]))
 
-    cache_dict = ast.literal_eval(cache)
-    lport_details = None
-    lport = None
-    for port_id in cache_dict.keys():
-        if cache_dict[port_id]['used'] == "no":
-            lport = port_id
-            lport_details = cache_dict[port_id]
-            break
+    cache_port_init()
+    cache_set_ports(ports)
+    with cache_transaction() as cache:
+        for vlan in used:
+            cache_set_state(cache, vlan, PORT_USED)
+            cache_unlink_free(cache, vlan)
+    ovs_vsctl("--if-exists remove open_vswitch . external-ids lport-cache")
+    return len(ports)
 
-    return (lport, lport_details)
 
+def cache_port_destroy(shard=0):
+    shard = int(shard)
+    if shard in LPORT_CACHE_MAPS:
+        LPORT_CACHE_MAPS.pop(shard).close()
+        os.close(LPORT_CACHE_FDS.pop(shard))
 
-def cache_mark_port_usage(port_id, usage):
-    cache = ovs_vsctl("--if-exists get open_vswitch . "
-                      "external-ids:lport-cache").strip('"')
-    if not cache:
-        sys.exit("fatal error. cache not initialized")
+    if os.path.exists(cache_path(shard)):
+        os.unlink(cache_path(shard))
+
+
+def cache_set_ports(ports, shard=0):
+    # Adds a batch of new free ports in a single transaction.
+    with cache_transaction(shard) as cache:
+        for details in ports:
+            vlan = int(details["vlan"])
+            cache_write_record(cache, vlan, PORT_FREE, details)
+            cache_push_free(cache, vlan)
+
+
+def cache_get_port_details(vlan, shard=0):
+    (state, prev_free, next_free, details) = \
+        cache_read_record(cache_open(shard), int(vlan))
+    if state == PORT_EMPTY:
+        return None
+    return details
+
+
+def cache_claim_ports(owners, shard=0):
+    # Takes a port off the head of the free list for each container in
+    # 'owners' and marks it as used by it, all in one transaction. Returns
+    # a (port id, details) per owner, or (None, None) once the list is
+    # empty.
+    claims = []
+    with cache_transaction(shard) as cache:
+        for owner in owners:
+            (head, count) = cache_read_header(cache)
+            if head < 0:
+                claims.append((None, None))
+                continue
+
+            cache_set_state(cache, head, PORT_USED, owner)
+            cache_unlink_free(cache, head)
+            (state, prev_free, next_free, details) = \
+                cache_read_record(cache, head)
+            details["shard"] = str(shard)
+            claims.append((details["port_id"], details))
+    return claims
+
+
+def cache_claim_port(owner, shard=0):
+    return cache_claim_ports([owner], shard)[0]
+
+
+def cache_release_ports(vlans, shard=0, owner=None):
+    # Puts used ports back on the free list, in one transaction. With an
+    # owner, only the ports still claimed by it.
+    with cache_transaction(shard) as cache:
+        for vlan in vlans:
+            vlan = int(vlan)
+            (state, prev_free, next_free, details) = \
+                cache_read_record(cache, vlan)
+            if state != PORT_USED:
+                continue
+            if owner and details["owner"] != owner:
+                continue
+
+            cache_set_state(cache, vlan, PORT_FREE)
+            cache_push_free(cache, vlan)
+
+
+def cache_release_port(vlan, shard=0):
+    cache_release_ports([vlan], shard)
+
+
+def cache_remove_port(vlan, shard=0):
+    # Forgets a port, e.g. once it has been deleted from Neutron.
+    vlan = int(vlan)
+    with cache_transaction(shard) as cache:
+        (state, prev_free, next_free, details) = cache_read_record(cache,
+                                                                   vlan)
+        if state == PORT_FREE:
+            cache_unlink_free(cache, vlan)
+        cache_set_state(cache, vlan, PORT_EMPTY)
+
+
+def cache_take_free_ports(vlans, shard=0):
+    # Takes free ports out of the cache, in one transaction, so that they
+    # can be deleted. Ports claimed in the meantime are left alone.
+    # Returns the details of the ports taken.
+    taken = []
+    with cache_transaction(shard) as cache:
+        for vlan in vlans:
+            vlan = int(vlan)
+            (state, prev_free, next_free, details) = \
+                cache_read_record(cache, vlan)
+            if state != PORT_FREE:
+                continue
+
+            cache_unlink_free(cache, vlan)
+            cache_set_state(cache, vlan, PORT_EMPTY)
+            details["shard"] = str(shard)
+            taken.append(details)
+    return taken
+
+
+def cache_ports(shard=0):
+    # Yields the details of every port in the cache, used or not.
+    cache = cache_open(shard)
+    for vlan in range(1, MAX_VLAN + 1):
+        (state, prev_free, next_free, details) = cache_read_record(cache,
+                                                                   vlan)
+        if state != PORT_EMPTY:
+            details["shard"] = str(shard)
+            yield details
+
+
+def lport_shards():
+    # Shard 0 puts pods behind OS_VIF_ID, on OVN_BRIDGE, with their
+    # neighbor entries on NEIGH_DEVICE. lswitch-setup --shard adds more,
+    # each with a parent VIF, bridge and neighbor device of its own; they
+    # are listed in a file next to the cache.
+    global LPORT_SHARDS
+    if LPORT_SHARDS is None:
+        shards = [{"vif": "", "bridge": OVN_BRIDGE, "device": NEIGH_DEVICE}]
+        try:
+            with open(LPORT_CACHE + ".shards") as fd:
+                shards.extend(json.load(fd))
+        except IOError:
+            pass
+        LPORT_SHARDS = shards
+    return LPORT_SHARDS
+
+
+def lport_shard(details):
+    # The shard a port, or a pod's record, belongs to.
+    return lport_shards()[int(details.get("shard") or 0)]
 
-    cache_dict = ast.literal_eval(cache)
-    if cache_dict.get(port_id, ""):
-        cache_dict[port_id]['used'] = usage
 
-    ovs_vsctl("set open_vswitch . "
-              "external-ids:lport-cache=\"%s\"" % str(cache_dict))
+def lport_shards_save(shards):
+    global LPORT_SHARDS
+    path = LPORT_CACHE + ".shards"
+    if shards:
+        with open(path, "w") as fd:
+            json.dump(shards, fd)
+    elif os.path.exists(path):
+        os.unlink(path)
+    LPORT_SHARDS = None
+
+
+def lswitch_create_ports(network_id, netmask, gateway_ip, vlans, shard=0):
+    try:
+        # Logging in reads VIF_ID, the default parent.
+        neutron = neutron_worker_login()
+        parent_name = lport_shards()[shard]["vif"] or VIF_ID
+        body = {'ports': [{'network_id': network_id,
+                           'binding:profile': {'parent_name': parent_name,
+                                               'tag': int(vlan)},
+                           'name': "k8",
+                           'admin_state_up': True} for vlan in vlans]}
+        ret = neutron.create_port(body)
+        ports = []
+        for vlan, port in zip(vlans, ret['ports']):
+            ports.append({"port_id": port['id'],
+                          "ip": port['fixed_ips'][0]['ip_address'],
+                          "netmask": netmask,
+                          "mac": port['mac_address'],
+                          "vlan": vlan,
+                          "gateway_ip": gateway_ip})
+    except Exception as e:
+        sys.stderr.write("Failed to create ports for vlans %d-%d. (%s)"
+                         % (vlans[0], vlans[-1], str(e)))
+        return
+
+    cache_set_ports(ports, shard)
 
 
 def lswitch_setup(args):
@@ -173,20 +999,36 @@ def lswitch_setup(args):
     subnet = args.subnet
     router_id = args.router_id
 
+    if cache_import_external_ids():
+        sys.exit("imported the lport cache of an older version, the "
+                 "lswitch is already set up for this node")
+
     ovs_vsctl("set open_vswitch . external-ids:router_id=%s" % router_id)
 
-    cache_port_init()
+    # Every --shard is another parent VIF, with its own vlan space.
+    shards = []
+    for shard in args.shard or []:
+        fields = shard.split(",")
+        if len(fields) != 3 or not all(fields):
+            sys.exit("%s is not VIF_ID,BRIDGE,DEVICE" % (shard))
+        shards.append({"vif": fields[0], "bridge": fields[1],
+                       "device": fields[2]})
 
     netmask = subnet.rsplit('/', 1)[1]
     num_ports = 2 ** (32 - int(netmask)) - 2
-    if num_ports > 4095:
-        cache_port_destroy()
-        sys.exit("Maximum number of ports that can be created is 4095")
+    if num_ports > MAX_VLAN * (len(shards) + 1):
+        sys.exit("Maximum number of ports that can be created is %d"
+                 % (MAX_VLAN * (len(shards) + 1)))
+
+    cache_port_init()
+    lport_shards_save(shards)
+    for shard in range(1, len(shards) + 1):
+        cache_port_init(shard)
 
     try:
         neutron = neutron_login()
     except Exception as e:
-        cache_port_destroy()
+        lport_caches_destroy()
         sys.exit("lswitch_setup: neutron login. (%s)" % (str(e)))
 
     try:
@@ -194,7 +1036,7 @@ def lswitch_setup(args):
         ret = neutron.create_network(body)
         network_id = ret['network']['id']
     except Exception as e:
-        cache_port_destroy()
+        lport_caches_destroy()
         sys.exit("lswitch_setup: neutron net-create call. (%s)" % str(e))
 
     ovs_vsctl("set open_vswitch . external_ids:network_id=%s" % network_id)
@@ -207,7 +1049,7 @@ def lswitch_setup(args):
         subnet_id = ret['subnet']['id']
         gateway_ip = ret['subnet']['gateway_ip']
     except Exception as e:
-        cache_port_destroy()
+        lport_caches_destroy()
         neutron.delete_network(network_id)
         sys.exit("lswitch_setup: neutron subnet-create call. (%s)" % str(e))
 
@@ -218,75 +1060,84 @@ def lswitch_setup(args):
         body = {'subnet_id': subnet_id}
         ret = neutron.add_interface_router(router_id, body)
     except Exception as e:
-        cache_port_destroy()
+        lport_caches_destroy()
         neutron.delete_network(network_id)
         sys.exit("lswitch_setup: neutron router-iface-add call. (%s)" % str(e))
     '''
 
-    vlan = 1
-    for num in range(1, num_ports):
-        try:
-            name = "k8"
-            body = {'port': {'network_id': network_id,
-                             'binding:profile': {'parent_name': VIF_ID,
-                                                 'tag': int(vlan)},
-                             'name': name,
-                             'admin_state_up': True}}
-            ret = neutron.create_port(body)
-            mac = ret['port']['mac_address']
-            ip_address = ret['port']['fixed_ips'][0]['ip_address']
-            port_id = ret['port']['id']
-            cache_set_port_details(port_id, ip_address, netmask, mac, vlan,
-                                   gateway_ip)
-        except Exception as e:
-            sys.stderr.write("Failed to create port. (%s)" % str(e))
-
-        vlan = vlan + 1
-
-
-def lswitch_destroy(args):
-    router_id = ovs_vsctl("--if-exists get open_vswitch . "
-                          "external-ids:router_id").strip('"')
-    if not router_id:
-        sys.exit("lswitch_destroy: no router-id found in Open vSwitch db")
-
-    cache = ovs_vsctl("--if-exists  get open_vswitch . "
-                      "external-ids:lport-cache").strip('"')
-    if not cache:
-        sys.exit("fata error. cache not initialized")
-    cache_dict = ast.literal_eval(cache)
-
+    # The ports are dealt out to the shards in turn. In pool mode only the
+    # first pool_size ports of each shard are created; the rest are
+    # created, and deleted again, as the pods on the node need them.
+    vlans = dict([(shard, lport_shard_vlans(num_ports - 1, shard))
+                  for shard in range(len(shards) + 1)])
+    if args.pool_size:
+        for shard in vlans:
+            vlans[shard] = vlans[shard][0:args.pool_size]
+        pool = ["external_ids:lport-pool-size=%d" % (args.pool_size)]
+        if args.pool_low:
+            pool.append("external_ids:lport-pool-low=%d" % (args.pool_low))
+        if args.pool_high:
+            pool.append("external_ids:lport-pool-high=%d"
+                        % (args.pool_high))
+        ovs_vsctl("set open_vswitch . %s" % (" ".join(pool)))
+    lport_pool_create(network_id, netmask, gateway_ip, vlans,
+                      args.chunk_size, args.workers)
+
+
+def lport_shard_vlans(num_ports, shard):
+    # The vlans of 'shard' when 'num_ports' ports are dealt out in turn to
+    # all the shards.
+    shards = len(lport_shards())
+    return range(1, (num_ports - shard + shards - 1) // shards + 1)
+
+
+def lport_caches_destroy():
+    for shard in range(len(lport_shards())):
+        cache_port_destroy(shard)
+    lport_shards_save([])
+
+
+def lswitch_delete_port(port):
+    # Deletes one lport from Neutron and then from the cache, so that the
+    # cache always lists what is left to delete. A port that Neutron no
+    # longer knows about was deleted by an earlier, interrupted run.
     try:
-        neutron = neutron_login()
+        neutron_worker_login().delete_port(port["port_id"])
     except Exception as e:
-        sys.exit("lswitch_destroy: neutron login. (%s)" % (str(e)))
-
-    port_delete_error = False
-    for port_id in cache_dict.keys():
-        try:
-            neutron.delete_port(port_id)
-        except Exception as e:
-            port_delete_error = True
+        if getattr(e, "status_code", None) != 404:
             sys.stderr.write("lswitch_destroy: neutron port-delete. (%s)"
                              % (str(e)))
-            continue
-        del cache_dict[port_id]
+            return False
+    cache_remove_port(port["vlan"], port["shard"])
+    return True
 
-    if not port_delete_error:
-        cache_port_destroy()
-    else:
-        ovs_vsctl("set open_vswitch . "
-                  "external-ids:lport-cache=\"%s\"" % str(cache_dict))
 
-    if port_delete_error:
-        sys.exit("failed deleting some lports. Look at "
-                 "external-ids:lport-cache in Open_vSwitch table for "
-                 "undeleted lports and delete them manually")
+def lswitch_destroy(args):
+    external_ids = ovs_vsctl_list("open_vswitch",
+                                  ["external_ids"])[0]["external_ids"]
+    router_id = external_ids.get("router_id", "")
+    subnet_id = external_ids.get("subnet_id", "")
+    network_id = external_ids.get("network_id", "")
+    if not (router_id or network_id or os.path.exists(LPORT_CACHE)):
+        sys.exit("lswitch_destroy: no router-id found in Open vSwitch db")
+
+    if os.path.exists(LPORT_CACHE):
+        ports = []
+        for shard in range(len(lport_shards())):
+            ports.extend(cache_ports(shard))
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(args.workers)
+        try:
+            deleted = pool.map(lswitch_delete_port, ports)
+        finally:
+            pool.close()
+            pool.join()
 
-    router_id = ovs_vsctl("--if-exists get open_vswitch . "
-                          "external_ids:router_id").strip('"')
-    subnet_id = ovs_vsctl("--if-exists get open_vswitch . "
-                          "external_ids:subnet_id").strip('"')
+        if not all(deleted):
+            sys.exit("failed deleting some lports. Look at %s for "
+                     "undeleted lports or run lswitch-destroy again"
+                     % LPORT_CACHE)
+        lport_caches_destroy()
 
     '''
     if router_id and subnet_id:
@@ -300,248 +1151,1386 @@ def lswitch_destroy(args):
                  "router_id and subnet_id found in open_vswitch table")
     '''
 
-    ovs_vsctl("remove open_vswitch . external_ids router_id")
-    ovs_vsctl("remove open_vswitch . external_ids subnet_id")
+    ovs_vsctl("--if-exists remove open_vswitch . external_ids router_id")
+    ovs_vsctl("--if-exists remove open_vswitch . external_ids subnet_id")
+    ovs_vsctl("--if-exists remove open_vswitch . external_ids "
+              "lport-pool-size lport-pool-low lport-pool-high")
 
-    network_id = ovs_vsctl("--if-exists get open_vswitch . "
-                           "external_ids:network_id").strip('"')
     if network_id:
         try:
+            neutron = neutron_login()
             neutron.delete_network(network_id)
         except Exception as e:
-            sys.exit("failed to destroy the lswitch, delete it manually (%s)"
-                     % (str(e)))
+            if getattr(e, "status_code", None) != 404:
+                sys.exit("failed to destroy the lswitch, delete it manually "
+                         "(%s)" % (str(e)))
+
+    ovs_vsctl("--if-exists remove open_vswitch . external_ids network_id")
+
+
+def lport_pool_config():
+    # The lport pool settings from the Open_vSwitch table. With no
+    # lport-pool-size, lswitch-setup created every port of the subnet and
+    # there is no pool to manage.
+    external_ids = ovs_vsctl_list("open_vswitch",
+                                  ["external_ids"])[0]["external_ids"]
+    size = int(external_ids.get("lport-pool-size") or 0)
+    low = int(external_ids.get("lport-pool-low") or max(1, size // 4))
+    high = int(external_ids.get("lport-pool-high") or size * 2)
+    return (external_ids, size, low, high)
+
+
+@contextlib.contextmanager
+def lport_pool_lock(shard, blocking):
+    # Keeps two processes from growing or shrinking a shard's pool at once.
+    # The cache itself is only locked while it is updated, not for the
+    # Neutron calls in between.
+    fd = os.open(cache_path(shard) + ".pool", os.O_RDWR | os.O_CREAT,
+                 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX |
+                        (0 if blocking else fcntl.LOCK_NB))
+            locked = True
+        except IOError:
+            locked = False
+        yield locked
+    finally:
+        os.close(fd)
+
+
+def lport_pool_create(network_id, netmask, gateway_ip, vlans, chunk_size,
+                      workers):
+    # Creates the ports on the vlans of every shard in 'vlans' with
+    # Neutron's bulk API, a chunk at a time, on a bounded pool of workers.
+    # Each chunk is added to its shard's cache in one go.
+    chunks = []
+    for (shard, shard_vlans) in vlans.items():
+        chunks.extend([(shard, shard_vlans[i:i + chunk_size])
+                       for i in range(0, len(shard_vlans), chunk_size)])
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(workers, len(chunks))))
+    try:
+        pool.map(lambda chunk: lswitch_create_ports(network_id, netmask,
+                                                    gateway_ip, chunk[1],
+                                                    chunk[0]),
+                 chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def lport_pool_delete(details):
+    try:
+        neutron_worker_login().delete_port(details["port_id"])
+    except Exception as e:
+        if getattr(e, "status_code", None) != 404:
+            sys.stderr.write("lport pool: neutron port-delete. (%s)"
+                             % (str(e)))
+            cache_set_ports([details], details["shard"])
+
+
+def lport_pool_adjust(blocking=False, need=0, chunk_size=100, workers=4):
+    # Adjusts the pool of every shard, spreading the 'need' ports about to
+    # be claimed over them. Returns the number of ports created, or
+    # deleted as a negative number.
+    if not os.path.exists(LPORT_CACHE):
+        return 0
+    (external_ids, size, low, high) = lport_pool_config()
+    if not size:
+        return 0
+
+    shards = len(lport_shards())
+    return sum([lport_pool_adjust_shard(shard, external_ids, size, low, high,
+                                        blocking, -(-need // shards),
+                                        chunk_size, workers)
+                for shard in range(shards)])
+
+
+def lport_pool_adjust_shard(shard, external_ids, size, low, high, blocking,
+                            need, chunk_size, workers):
+    # Once the free ports drop below the low watermark, or below the 'need'
+    # ports about to be claimed, creates ports on the lowest unused vlans
+    # to bring them back to the pool size once those are claimed. Above
+    # the high watermark, deletes the free ports on the highest vlans down
+    # to the pool size.
+    with lport_pool_lock(shard, blocking) as locked:
+        if not locked:
+            return 0
+
+        cache = cache_open(shard)
+        (head, free) = cache_read_header(cache)
+        states = {}
+        ports = []
+        for vlan in range(1, MAX_VLAN + 1):
+            (state, prev_free, next_free, details) = \
+                cache_read_record(cache, vlan)
+            states[vlan] = state
+            if state != PORT_EMPTY:
+                ports.append(details)
+
+        if free < max(low, need):
+            if ports:
+                (netmask, gateway_ip) = (ports[0]["netmask"],
+                                         ports[0]["gateway_ip"])
+            else:
+                ret = neutron_worker_login().show_subnet(
+                                        external_ids["subnet_id"])
+                netmask = ret['subnet']['cidr'].rsplit('/', 1)[1]
+                gateway_ip = ret['subnet']['gateway_ip']
+            vlans = lport_shard_vlans(2 ** (32 - int(netmask)) - 3, shard)
+            vlans = [vlan for vlan in vlans[0:MAX_VLAN]
+                     if states[vlan] == PORT_EMPTY][0:size + need - free]
+            if vlans:
+                lport_pool_create(external_ids["network_id"], netmask,
+                                  gateway_ip, {shard: vlans}, chunk_size,
+                                  workers)
+            return len(vlans)
+
+        if free > high:
+            vlans = sorted([vlan for vlan in states
+                            if states[vlan] == PORT_FREE],
+                           reverse=True)[0:free - size]
+            ports = cache_take_free_ports(vlans, shard)
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(max(1, min(workers, len(ports))))
+            try:
+                pool.map(lport_pool_delete, ports)
+            finally:
+                pool.close()
+                pool.join()
+            return -len(ports)
+    return 0
+
+
+def lport_claim(owners):
+    # Claims a port for each owner, each from the shard with the most free
+    # ports, in one transaction per shard.
+    free = [cache_read_header(cache_open(shard))[1]
+            for shard in range(len(lport_shards()))]
+    shards = {}
+    for i in range(len(owners)):
+        shard = free.index(max(free))
+        free[shard] -= 1
+        shards.setdefault(shard, []).append(i)
+
+    claims = [(None, None)] * len(owners)
+    for (shard, indexes) in shards.items():
+        for (i, claim) in zip(indexes, cache_claim_ports(
+                                    [owners[i] for i in indexes], shard)):
+            claims[i] = claim
+    return claims
+
+
+def lport_pool_claim(owners):
+    # Claims a port for each owner. Should the pool run dry, it is topped
+    # up right away, waiting for a top up already under way, instead of
+    # failing the pods.
+    claims = lport_claim(owners)
+    missing = [i for (i, (lport, details)) in enumerate(claims)
+               if not lport]
+    if missing:
+        # Ports waiting for their security group to be taken off may be
+        # all that is missing.
+        if not SECURITY_GROUP_QUEUE:
+            try:
+                security_group_queue_run()
+            except Exception as e:
+                sys.stderr.write("security group queue: %s\n" % (str(e)))
+        try:
+            lport_pool_adjust(blocking=True, need=len(missing))
+        except Exception as e:
+            sys.stderr.write("lport pool: %s\n" % (str(e)))
+        for (i, claim) in zip(missing, lport_claim(
+                                    [owners[i] for i in missing])):
+            claims[i] = claim
+    if LPORT_POOL:
+        LPORT_POOL.wakeup.set()
+    return claims
+
+
+class LportPool(threading.Thread):
+    """Keeps the free ports in the lport cache between the pool's low and
+    high watermarks, checking after every claim and once a minute."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="lport-pool")
+        self.daemon = True
+        self.wakeup = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                lport_pool_adjust()
+            except Exception as e:
+                sys.stderr.write("lport pool: %s\n" % (str(e)))
+            self.wakeup.wait(60)
+            self.wakeup.clear()
+
+
+def start_lport_pool():
+    global LPORT_POOL
+    if not os.path.exists(LPORT_CACHE) or not lport_pool_config()[1]:
+        return
 
-    ovs_vsctl("remove open_vswitch . external_ids network_id")
+    LPORT_POOL = LportPool()
+    LPORT_POOL.start()
 
 
 def plugin_init(args):
-    pass
+    try:
+        node_flows_check(force=True)
+    except Exception as e:
+        error = "failed to program the node flows (%s)" % (str(e))
+        sys.exit(error)
+
+    try:
+        cache_import_external_ids()
+    except Exception as e:
+        error = "failed to import the old lport cache (%s)" % (str(e))
+        sys.exit(error)
+
+    try:
+        with span("step", "reconcile"):
+            pod_reconcile()
+    except Exception as e:
+        error = "failed to reconcile the pods on this node (%s)" % (str(e))
+        sys.exit(error)
+
+    try:
+        security_group_queue_run()
+    except Exception as e:
+        error = "failed to take security groups off lports (%s)" % (str(e))
+        sys.stderr.write(error)
 
+    try:
+        lport_pool_adjust(blocking=True)
+    except Exception as e:
+        error = "failed to adjust the lport pool (%s)" % (str(e))
+        sys.stderr.write(error)
 
-def get_annotations(pod_name, namespace):
-    api_server = ovs_vsctl("--if-exists get open_vswitch . "
-                           "external-ids:api_server").strip('"')
+    try:
+        neigh_sync()
+    except Exception as e:
+        error = "failed to sync the neighbor table (%s)" % (str(e))
+        sys.stderr.write(error)
+
+
+def get_api_server():
+    global API_SERVER
+    if not API_SERVER:
+        API_SERVER = ovs_vsctl("--if-exists get open_vswitch . "
+                               "external-ids:api_server").strip('"')
+    return API_SERVER
+
+
+def get_api_session():
+    global API_SESSION
+    if not API_SESSION:
+        import requests
+        API_SESSION = requests.Session()
+    return API_SESSION
+
+
+def get_annotations(namespace, pod_name):
+    # In the agent, annotations come from the pod informer's index. Pods it
+    # has not seen yet are fetched with a single pod GET over a keep-alive
+    # session and cached briefly, since setup and teardown of a pod tend to
+    # ask for them again.
+    if POD_INFORMER and POD_INFORMER.synced.is_set():
+        (found, annotations) = POD_INFORMER.get(namespace, pod_name)
+        if found:
+            return annotations
+
+    key = (namespace, pod_name)
+    cached = ANNOTATIONS_CACHE.get(key)
+    if cached and cached[0] > time.time():
+        return cached[1]
+
+    api_server = get_api_server()
     if not api_server:
         return None
+    if not api_server.startswith("http"):
+        api_server = "http://%s" % (api_server)
 
-    url = "http://%s/api/v1/pods" % (api_server)
-    response = requests.get("http://0.0.0.0:8080/api/v1/pods")
-    if response:
-        pods = response.json()['items']
-    else:
+    url = "%s/api/v1/namespaces/%s/pods/%s" % (api_server, namespace,
+                                              pod_name)
+    import requests
+    try:
+        response = get_api_session().get(url, timeout=5)
+    except requests.RequestException as e:
+        sys.stderr.write("failed to fetch pod %s/%s (%s)"
+                         % (namespace, pod_name, str(e)))
+        return None
+    if not response:
         return None
 
-    for pod in pods:
-        if (pod['metadata']['namespace'] == namespace and
-           pod['metadata']['name'] == pod_name):
-            annotations = pod['metadata'].get('annotations', "")
-            if annotations:
-                return annotations
+    annotations = response.json()['metadata'].get('annotations') or None
+
+    if len(ANNOTATIONS_CACHE) > 1024:
+        now = time.time()
+        for stale in [k for k, v in ANNOTATIONS_CACHE.items() if v[0] < now]:
+            ANNOTATIONS_CACHE.pop(stale, None)
+    ANNOTATIONS_CACHE[key] = (time.time() + ANNOTATIONS_TTL, annotations)
+    return annotations
+
+
+class PodInformer(threading.Thread):
+    """Keeps a local index of the annotations of the pods scheduled on this
+    node. The index is filled by a list and kept current by a watch from
+    the list's resourceVersion; when the API server reports that version
+    as expired, the pods are listed again."""
+
+    def __init__(self, api_server, node_name):
+        import requests
+        threading.Thread.__init__(self, name="pod-informer")
+        self.daemon = True
+        self.url = "%s/api/v1/pods" % (api_server)
+        self.selector = "spec.nodeName=%s" % (node_name)
+        self.session = requests.Session()
+        self.pods = {}
+        self.resource_version = None
+        self.synced = threading.Event()
+
+    def get(self, namespace, pod_name):
+        key = (namespace, pod_name)
+        if key not in self.pods:
+            return (False, None)
+        return (True, self.pods[key])
+
+    def relist(self):
+        response = self.session.get(self.url, timeout=30,
+                                    params={"fieldSelector": self.selector})
+        response.raise_for_status()
+        data = response.json()
+
+        pods = {}
+        for pod in data['items']:
+            metadata = pod['metadata']
+            pods[(metadata['namespace'], metadata['name'])] = \
+                metadata.get('annotations') or None
+        self.pods = pods
+        self.resource_version = data['metadata']['resourceVersion']
+        self.synced.set()
+
+    def watch(self):
+        # Returns False if the pods have to be listed again.
+        params = {"fieldSelector": self.selector, "watch": "true",
+                  "resourceVersion": self.resource_version,
+                  "timeoutSeconds": 300}
+        response = self.session.get(self.url, params=params, stream=True,
+                                    timeout=(5, 330))
+        if response.status_code == 410:
+            return False
+        response.raise_for_status()
+
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event['type'] == "ERROR":
+                if event['object'].get('code') == 410:
+                    return False
+                raise RuntimeError(event['object'].get('message', ""))
+
+            metadata = event['object']['metadata']
+            key = (metadata['namespace'], metadata['name'])
+            if event['type'] == "DELETED":
+                self.pods.pop(key, None)
             else:
-                return None
+                self.pods[key] = metadata.get('annotations') or None
+            self.resource_version = metadata['resourceVersion']
+        return True
+
+    def run(self):
+        while True:
+            try:
+                if not self.resource_version:
+                    self.relist()
+                if not self.watch():
+                    self.resource_version = None
+            except Exception as e:
+                sys.stderr.write("pod informer: %s\n" % (str(e)))
+                time.sleep(1)
+
+
+def start_pod_informer():
+    global POD_INFORMER
+    api_server = get_api_server()
+    if not api_server:
+        return
+    if not api_server.startswith("http"):
+        api_server = "http://%s" % (api_server)
+
+    node_name = ovs_vsctl("--if-exists get open_vswitch . "
+                          "external-ids:node_name").strip('"')
+    if not node_name:
+        node_name = socket.gethostname()
+
+    POD_INFORMER = PodInformer(api_server, node_name)
+    POD_INFORMER.start()
 
 
 def associate_security_group(lport_id, security_group_id):
     try:
-        neutron = neutron_login()
+        neutron = neutron_worker_login()
     except Exception as e:
         sys.exit("associate_security_group: neutron login. (%s)" % (str(e)))
 
     try:
         body = {'port': {'security_groups': [security_group_id]}}
-        update_port(lport_id, body)
+        neutron.update_port(lport_id, body)
     except Exception as e:
         sys.exit("associate_security_group: failed port association")
 
 
-def plugin_setup(args):
-    ns = args.k8_args[0]
-    pod_name = args.k8_args[1]
-    container_id = args.k8_args[2]
+def netns_link(pid):
+    if not os.path.isdir("/var/run/netns"):
+        os.makedirs("/var/run/netns")
+    netns_dst = "/var/run/netns/%s" % (pid)
+    if not os.path.lexists(netns_dst):
+        os.symlink("/proc/%s/ns/net" % (pid), netns_dst)
+
 
-    client = Client(base_url='unix://var/run/docker.sock')
+def host_links():
+    # The names of all the network devices in the host namespace, from a
+    # single netlink dump.
+    from pyroute2 import IPRoute
+    ipr = IPRoute()
     try:
-        inspect = client.inspect_container(container_id)
-        pid = inspect["State"]["Pid"]
-    except Exception as e:
-        error = "failed to get container pid"
-        sys.exit(error)
+        return set([link.get_attr('IFLA_IFNAME')
+                    for link in ipr.get_links()])
+    finally:
+        ipr.close()
 
+
+def netns_prune():
+    # Drops the /var/run/netns links of the containers that are gone.
     if not os.path.isdir("/var/run/netns"):
-        os.makedirs("/var/run/netns")
+        return
+    for name in os.listdir("/var/run/netns"):
+        path = os.path.join("/var/run/netns", name)
+        if os.path.islink(path) and not os.path.exists(path):
+            os.unlink(path)
 
-    # Choose an unused logical port. Get its ipaddress and mac
-    (lport, lport_details) = cache_get_free_port()
-    if not lport:
-        sys.exit("No free lports available")
 
-    ip_address = lport_details['ip']
-    netmask = lport_details['netmask']
-    mac = lport_details['mac']
-    vlan = lport_details['vlan']
-    gateway_ip = lport_details['gateway_ip']
+def pod_link_setup(pid, veth_outside, veth_inside, ip_address, netmask,
+                   mac, gateway_ip, pooled=False):
+    # Everything is done over netlink: one socket in the host namespace to
+    # create the veth pair, unless it comes from the veth pool, and one
+    # session inside the pod's namespace to configure its end.
+    from pyroute2 import IPRoute, NetNS
 
-    netns_dst = "/var/run/netns/%s" % (pid)
-    if not os.path.isfile(netns_dst):
-        netns_src = "/proc/%s/ns/net" % (pid)
-        command = "ln -s %s %s" % (netns_src, netns_dst)
+    with span("step", "veth-create"):
+        ipr = IPRoute()
+        try:
+            if not pooled:
+                step = "create veth pair"
+                ipr.link('add', ifname=veth_outside, kind='veth',
+                         peer=veth_inside)
+
+                step = "admin up veth_outside"
+                outside = ipr.link_lookup(ifname=veth_outside)[0]
+                ipr.link('set', index=outside, state='up')
+
+            step = "move veth inside"
+            inside = ipr.link_lookup(ifname=veth_inside)[0]
+            ipr.link('set', index=inside, net_ns_fd=str(pid))
+        except Exception as e:
+            raise RuntimeError("Failed to %s (%s)" % (step, str(e)))
+        finally:
+            ipr.close()
 
+    with span("step", "address-config"):
+        step = "enter the pod netns"
         try:
-            call_popen(shlex.split(command))
+            netns = NetNS(str(pid))
         except Exception as e:
-            error = "failed to create the netns link"
-            sys.exit(error)
+            raise RuntimeError("Failed to %s (%s)" % (step, str(e)))
 
-    # Delete the existing veth pair
-    command = "ip netns exec %s ip link del eth0" % (pid)
-    try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "failed to delete the default veth pair"
-        sys.stderr.write(error)
+        try:
+            # Delete the existing veth pair
+            eth0 = netns.link_lookup(ifname='eth0')
+            if eth0:
+                try:
+                    netns.link('del', index=eth0[0])
+                except Exception as e:
+                    sys.stderr.write("failed to delete the default veth pair")
+
+            # Rename veth_inside to eth0 and set its mac address and the mtu
+            # to handle tunnels.
+            step = "configure eth0"
+            inside = netns.link_lookup(ifname=veth_inside)[0]
+            netns.link('set', index=inside, ifname='eth0', address=mac,
+                       mtu=1450)
+
+            step = "admin up veth_inside"
+            netns.link('set', index=inside, state='up')
+
+            step = "set ip address"
+            netns.addr('add', index=inside, address=ip_address,
+                       mask=int(netmask))
+
+            step = "set gateway"
+            netns.route('add', dst='0.0.0.0/0', gateway=gateway_ip)
+        except Exception as e:
+            raise RuntimeError("Failed to %s (%s)" % (step, str(e)))
+        finally:
+            netns.close()
 
-    veth_outside = container_id[0:15]
-    veth_inside = container_id[0:13] + "_c"
-    command = "ip link add %s type veth peer name %s" \
-              % (veth_outside, veth_inside)
-    try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to create veth pair (%s)" % (str(e))
-        sys.exit(error)
 
-    # Up the outer interface
-    command = "ip link set %s up" % veth_outside
+def pod_link_delete(ifname):
+    from pyroute2 import IPRoute
+
+    ipr = IPRoute()
     try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to admin up veth_outside (%s)" % (str(e))
-        sys.exit(error)
+        ipr.link('del', index=ipr.link_lookup(ifname=ifname)[0])
+    finally:
+        ipr.close()
+
 
-    # Move the inner veth inside the container
-    command = "ip link set %s netns %s" % (veth_inside, pid)
+def pod_unlink(veth_outside, pooled):
+    # Deletes the veth pair of a pod whose setup failed, and its OVS port
+    # if it came from the veth pool, which makes up for it.
     try:
-        call_popen(shlex.split(command))
+        if pooled:
+            ovs_vsctl("--if-exists del-port %s" % (veth_outside))
+        pod_link_delete(veth_outside)
     except Exception as e:
-        error = "Failed to move veth inside (%s)" % (str(e))
-        sys.exit(error)
+        sys.stderr.write("failed to delete veth pair %s (%s)\n"
+                         % (veth_outside, str(e)))
 
-    # Change the name of veth_inside to eth0
-    command = "ip netns exec %s ip link set dev %s name eth0" \
-              % (pid, veth_inside)
+
+def neigh_update(add=None, remove=None, device=NEIGH_DEVICE):
+    # Adds ('add' maps ip to mac) and removes permanent neighbor entries on
+    # 'device', all over one netlink socket.
+    from pyroute2 import IPRoute
+
+    ipr = IPRoute()
     try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to change name to eth0 (%s)" % (str(e))
-        sys.exit(error)
+        index = ipr.link_lookup(ifname=device)
+        if not index:
+            raise RuntimeError("device %s not found" % (device))
+        index = index[0]
+        for ip_address in (remove or []):
+            try:
+                ipr.neigh('del', dst=ip_address, ifindex=index)
+            except Exception:
+                # Already gone.
+                pass
+        for (ip_address, mac) in (add or {}).items():
+            ipr.neigh('replace', dst=ip_address, lladdr=mac, ifindex=index,
+                      state=NUD_PERMANENT)
+    finally:
+        ipr.close()
+
+
+def neigh_sync():
+    # Makes the permanent neighbor entries on the device of every shard
+    # match the used ports in its lport cache, leaving out the lports of
+    # pods that are gone and only wait for their security group to be
+    # taken off. Returns the number of entries changed.
+    if not os.path.exists(LPORT_CACHE):
+        return 0
+
+    queued = set([(int(entry["shard"]), int(entry["vlan"]))
+                  for entry in security_group_queue_entries()])
+    desired = {}
+    subnet = None
+    for (shard, config) in enumerate(lport_shards()):
+        entries = desired.setdefault(config["device"], {})
+        for details in cache_ports(shard):
+            subnet = (details["gateway_ip"], details["netmask"])
+            if (details["used"] == "yes" and
+                    (shard, int(details["vlan"])) not in queued):
+                entries[details["ip"]] = details["mac"].lower()
+
+    return sum([neigh_sync_device(device, neighbors, subnet)
+                for (device, neighbors) in desired.items()])
+
+
+def ip_in_subnet(ip_address, gateway_ip, netmask):
+    # Whether an IPv4 address is in the subnet of 'gateway_ip' with the
+    # prefix length 'netmask'.
+    try:
+        address = struct.unpack("!I", socket.inet_aton(ip_address))[0]
+        gateway = struct.unpack("!I", socket.inet_aton(gateway_ip))[0]
+    except socket.error:
+        return False
+    mask = (0xffffffff << (32 - int(netmask))) & 0xffffffff
+    return address & mask == gateway & mask
+
 
-    # Up the inner interface
-    command = "ip netns exec %s ip link set eth0 up" % (pid)
+def neigh_sync_device(device, desired, subnet):
+    # Entries outside the lswitch's subnet, such as IPv6 ones or those
+    # added by hand for other networks, are left alone.
+    from pyroute2 import IPRoute
+
+    current = {}
+    ipr = IPRoute()
     try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to admin up veth_inside (%s)" % (str(e))
-        sys.exit(error)
+        index = ipr.link_lookup(ifname=device)
+        if not index:
+            raise RuntimeError("device %s not found" % (device))
+        for msg in ipr.get_neighbours(ifindex=index[0]):
+            if not msg['state'] & NUD_PERMANENT:
+                continue
+            ip_address = msg.get_attr('NDA_DST')
+            mac = msg.get_attr('NDA_LLADDR') or ""
+            current[ip_address] = mac.lower()
+    finally:
+        ipr.close()
+
+    remove = [ip_address for ip_address in current
+              if ip_address not in desired and subnet and
+              ":" not in ip_address and ip_in_subnet(ip_address, *subnet)]
+    add = dict([(ip_address, mac) for (ip_address, mac) in desired.items()
+                if current.get(ip_address) != mac])
+    if remove or add:
+        neigh_update(add, remove, device)
+    return len(remove) + len(add)
+
+
+def get_pod_interface(container_id):
+    # Returns the name and external_ids of the OVS interface of a pod.
+    # Interfaces taken from the veth pool are not named after the
+    # container, so they are looked up by external_ids:container_id.
+    rows = ovs_vsctl_find("interface", ["name", "external_ids"],
+                          "external_ids:container_id=%s" % (container_id))
+    if not rows:
+        rows = ovs_vsctl_find("interface", ["name", "external_ids"],
+                              "name=%s" % (container_id[0:15]))
+    if not rows:
+        return (None, {})
+    return (rows[0]["name"], rows[0]["external_ids"])
+
+
+class VethPool(threading.Thread):
+    """Keeps up to 'size' veth pairs created, with their outer end up and
+    attached to OVN_BRIDGE, so that pod setup only has to move the inner
+    end into the pod and relabel the OVS interface. Free pairs are marked
+    with external_ids:ovn-k8-pool, which also lets a restarted agent adopt
+    them."""
+
+    def __init__(self, size):
+        threading.Thread.__init__(self, name="veth-pool")
+        self.daemon = True
+        self.size = size
+        self.free = Queue.Queue()
+        self.wakeup = threading.Event()
+
+    def claim(self):
+        try:
+            pair = self.free.get_nowait()
+        except Queue.Empty:
+            return None
+        self.wakeup.set()
+        return pair
+
+    def adopt(self):
+        from pyroute2 import IPRoute
+        rows = ovs_vsctl_find("interface", ["name", "external_ids"],
+                              "external_ids:ovn-k8-pool=free")
+        ipr = IPRoute()
+        try:
+            for row in rows:
+                veth_outside = row["name"]
+                veth_inside = row["external_ids"].get("ovn-k8-pool-peer", "")
+                if veth_inside and ipr.link_lookup(ifname=veth_inside):
+                    self.free.put((veth_outside, veth_inside))
+                else:
+                    ovs_vsctl("--if-exists del-port %s" % (veth_outside))
+        finally:
+            ipr.close()
+
+    def delete(self, pairs):
+        # Pairs that did not make it into the pool would never be used.
+        for (veth_outside, veth_inside) in pairs:
+            try:
+                pod_link_delete(veth_outside)
+            except Exception as e:
+                sys.stderr.write("veth pool: failed to delete %s (%s)\n"
+                                 % (veth_outside, str(e)))
+
+    def fill(self):
+        import uuid
+        from pyroute2 import IPRoute
+
+        pairs = []
+        ipr = IPRoute()
+        try:
+            for i in range(self.size - self.free.qsize()):
+                name = "ovnp%s" % (uuid.uuid4().hex[0:8])
+                veth_outside = name
+                veth_inside = name + "_c"
+                ipr.link('add', ifname=veth_outside, kind='veth',
+                         peer=veth_inside)
+                pairs.append((veth_outside, veth_inside))
+                ipr.link('set', index=ipr.link_lookup(ifname=veth_outside)[0],
+                         state='up')
+        except Exception:
+            self.delete(pairs)
+            raise
+        finally:
+            ipr.close()
+
+        if not pairs:
+            return
+
+        # Attach the whole batch in one transaction.
+        command = []
+        for (veth_outside, veth_inside) in pairs:
+            command.append("add-port %s %s -- set interface %s "
+                           "external_ids:ovn-k8-pool=free "
+                           "external_ids:ovn-k8-pool-peer=%s"
+                           % (OVN_BRIDGE, veth_outside, veth_outside,
+                              veth_inside))
+        try:
+            ovs_vsctl(" -- ".join(command))
+        except Exception:
+            self.delete(pairs)
+            raise
+
+        for pair in pairs:
+            self.free.put(pair)
+
+    def run(self):
+        try:
+            self.adopt()
+        except Exception as e:
+            sys.stderr.write("veth pool: %s\n" % (str(e)))
+
+        while True:
+            try:
+                self.fill()
+            except Exception as e:
+                sys.stderr.write("veth pool: %s\n" % (str(e)))
+            self.wakeup.wait(30)
+            self.wakeup.clear()
+
+
+def start_veth_pool():
+    global VETH_POOL
+    size = ovs_vsctl("--if-exists get open_vswitch . "
+                     "external-ids:veth-pool-size").strip('"')
+    if not size or not int(size):
+        return
 
-    # Set the mtu to handle tunnels
-    command = "ip netns exec %s ip link set dev eth0 mtu %s" \
-              % (pid, 1450)
+    VETH_POOL = VethPool(int(size))
+    VETH_POOL.start()
+
+
+def veth_pool_claim():
+    if not VETH_POOL:
+        return None
+    return VETH_POOL.claim()
+
+
+def get_docker_client():
+    global DOCKER_CLIENT
+    if not DOCKER_CLIENT:
+        from docker import Client
+        DOCKER_CLIENT = Client(base_url=DOCKER_URL, timeout=10)
+    return DOCKER_CLIENT
+
+
+def container_info(inspect):
+    return {"pid": inspect["State"]["Pid"],
+            "ip_address": inspect["NetworkSettings"]["IPAddress"],
+            "netmask": inspect["NetworkSettings"]["IPPrefixLen"],
+            "mac": inspect["NetworkSettings"]["MacAddress"],
+            "gateway_ip": inspect["NetworkSettings"]["Gateway"]}
+
+
+def container_cache_put(container_id, info):
+    if not info["pid"]:
+        return
+    if len(CONTAINER_CACHE) >= CONTAINER_CACHE_SIZE:
+        CONTAINER_CACHE.clear()
+    CONTAINER_CACHE[container_id] = info
+
+
+def inspect_container(container_id):
+    # Returns the pid and network settings of a container. They are served
+    # from the cache, which the agent fills from Docker's events, for as
+    # long as the container's process is alive.
+    info = CONTAINER_CACHE.get(container_id)
+    if info and os.path.exists("/proc/%s" % (info["pid"])):
+        return info
+
+    info = container_info(get_docker_client().inspect_container(container_id))
+    container_cache_put(container_id, info)
+    return info
+
+
+class ContainerWatcher(threading.Thread):
+    """Follows Docker's event stream and keeps the container cache current,
+    so that by the time kubelet asks for a pod to be set up its container
+    has usually been inspected already."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="container-watcher")
+        self.daemon = True
+
+    def run(self):
+        from docker import Client
+
+        while True:
+            try:
+                client = Client(base_url=DOCKER_URL, timeout=None)
+                for event in client.events(decode=True):
+                    container_id = event.get("id")
+                    if not container_id:
+                        continue
+                    if event.get("status") == "start":
+                        info = container_info(
+                                    client.inspect_container(container_id))
+                        container_cache_put(container_id, info)
+                    elif event.get("status") in ("die", "destroy"):
+                        CONTAINER_CACHE.pop(container_id, None)
+            except Exception as e:
+                sys.stderr.write("container watcher: %s\n" % (str(e)))
+                time.sleep(1)
+
+
+def flow_key(flow):
+    # Reduces a flow, either as listed in NODE_FLOWS or as printed by
+    # dump-flows, to its (match, actions) so that both forms compare equal.
+    (match, actions) = flow.strip().split("actions=", 1)
+    fields = []
+    for field in match.replace(" ", "").split(","):
+        if not field or field == "table=0":
+            continue
+        if field.split("=")[0] in ("cookie", "duration", "n_packets",
+                                   "n_bytes", "idle_age", "hard_age"):
+            continue
+        fields.append(field)
+    return (",".join(sorted(fields)), actions.strip())
+
+
+def node_flows_sync():
+    # Syncs NODE_FLOWS on every bridge pods are attached to: OVN_BRIDGE and
+    # those of the lport shards. Returns the number of changes.
+    bridges = sorted(set([shard["bridge"] for shard in lport_shards()]))
+    return sum([node_flows_sync_bridge(bridge) for bridge in bridges])
+
+
+def node_flows_sync_bridge(bridge):
+    # Compares our cookie's flows on 'bridge' with NODE_FLOWS and applies
+    # only the difference, as one bundle. Returns the number of changes.
+    output = call_popen(["ovs-ofctl", "dump-flows", bridge,
+                         "cookie=%s/-1" % (FLOW_COOKIE)])
+    current = set()
+    for line in output.splitlines():
+        if "actions=" in line:
+            current.add(flow_key(line))
+    desired = set([flow_key(flow) for flow in NODE_FLOWS])
+
+    changes = []
+    for (match, actions) in current - desired:
+        changes.append("delete_strict cookie=%s/-1,%s"
+                       % (FLOW_COOKIE, match))
+    for (match, actions) in desired - current:
+        changes.append("add cookie=%s,%s actions=%s"
+                       % (FLOW_COOKIE, match, actions))
+    if not changes:
+        return 0
+
+    flows = "\n".join(changes) + "\n"
     try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to set mtu (%s)" % (str(e))
-        sys.exit(error)
+        call_popen(["ovs-ofctl", "-O", "OpenFlow14", "--bundle",
+                    "add-flows", bridge, "-"], stdin=flows)
+    except Exception:
+        # Bundles need OpenFlow 1.4 to be enabled on the bridge.
+        call_popen(["ovs-ofctl", "add-flows", bridge, "-"], stdin=flows)
+    return len(changes)
+
 
-    # Set the ip address
-    command = "ip netns exec %s ip addr add %s/%s dev eth0" \
-              % (pid, ip_address, netmask)
+def vswitchd_pid():
     try:
-        call_popen(shlex.split(command))
-    except Exception as e:
-        error = "Failed to set ip address (%s)" % (str(e))
-        sys.exit(error)
+        with open(VSWITCHD_PIDFILE) as f:
+            return f.read().strip()
+    except IOError:
+        return None
 
-    # Set the mac address
-    command = "ip netns exec %s ip link set dev eth0 address %s" % (pid, mac)
+
+def node_flows_check(force=False):
+    # Without the agent's FlowMonitor, setup puts the node flows back once
+    # per run of ovs-vswitchd, which starts with empty flow tables. The pid
+    # they were last synced for is kept in FLOW_STAMP, so that most setups
+    # only read two small files. Returns the number of changes.
+    pid = vswitchd_pid()
+    if not force:
+        if not pid:
+            return 0
+        try:
+            with open(FLOW_STAMP) as f:
+                if f.read().strip() == pid:
+                    return 0
+        except IOError:
+            pass
+
+    changes = node_flows_sync()
+    if not pid:
+        return changes
+    tmp = "%s.%d" % (FLOW_STAMP, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            f.write(pid)
+        os.rename(tmp, FLOW_STAMP)
+    except (IOError, OSError) as e:
+        sys.stderr.write("failed to stamp the node flows (%s)" % (str(e)))
+    return changes
+
+
+class FlowMonitor(threading.Thread):
+    """Keeps NODE_FLOWS installed on every bridge pods are attached to.
+    ovs-vswitchd starts with empty flow tables, so a change of its pid
+    triggers a resync; otherwise the flows are only re-checked every
+    FLOW_RESYNC_INTERVAL seconds."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="flow-monitor")
+        self.daemon = True
+
+    def run(self):
+        pid = None
+        next_sync = 0
+        while True:
+            current_pid = vswitchd_pid()
+            if current_pid != pid or time.time() >= next_sync:
+                try:
+                    node_flows_sync()
+                    pid = current_pid
+                    next_sync = time.time() + FLOW_RESYNC_INTERVAL
+                except Exception as e:
+                    sys.stderr.write("flow monitor: %s\n" % (str(e)))
+            time.sleep(FLOW_CHECK_INTERVAL)
+
+
+def start_flow_monitor():
+    global FLOW_MONITOR
+    FLOW_MONITOR = FlowMonitor()
+    FLOW_MONITOR.start()
+
+
+def pod_link(pid, container_id, lport_details):
+    # Gives the pod a veth pair, from the pool if it has one, and
+    # configures the pod's end. Returns the outer end and whether it came
+    # from the pool.
     try:
-        call_popen(shlex.split(command))
+        with span("step", "netns-link"):
+            netns_link(pid)
     except Exception as e:
-        error = "Failed to set mac address (%s)" % (str(e))
+        error = "failed to create the netns link"
         sys.exit(error)
 
-    # Set the gateway
-    command = "ip netns exec %s ip route add default via %s" \
-              % (pid, gateway_ip)
+    # The pool's pairs are on OVN_BRIDGE.
+    pair = None
+    if lport_shard(lport_details)["bridge"] == OVN_BRIDGE:
+        pair = veth_pool_claim()
+    if pair:
+        (veth_outside, veth_inside) = pair
+    else:
+        veth_outside = container_id[0:15]
+        veth_inside = container_id[0:13] + "_c"
     try:
-        call_popen(shlex.split(command))
+        pod_link_setup(pid, veth_outside, veth_inside, lport_details['ip'],
+                       lport_details['netmask'], lport_details['mac'],
+                       lport_details['gateway_ip'], pooled=bool(pair))
     except Exception as e:
-        error = "Failed to set gateway (%s)" % (str(e))
-        sys.exit(error)
+        pod_unlink(veth_outside, bool(pair))
+        sys.exit(str(e))
+    return (veth_outside, bool(pair))
+
+
+def pod_port_command(container_id, lport, lport_details, veth_outside,
+                     pooled, security_group):
+    # The ovs-vsctl command that adds the port to a OVS bridge, or
+    # relabels the pooled one, and sets the vlan. The security group is
+    # kept, empty or not, so that teardown knows what to undo.
+    vlan = lport_details['vlan']
+    external_ids = ("external_ids:lport_id=%s external_ids:ip_address=%s "
+                    "external_ids:vlan=%s external_ids:lport_shard=%s "
+                    "external_ids:security_group='\"%s\"' "
+                    "external_ids:container_id=%s"
+                    % (lport, lport_details['ip'], vlan,
+                       lport_details['shard'], security_group,
+                       container_id))
+    if pooled:
+        return ("set port %s tag=%s -- remove interface %s "
+                "external_ids ovn-k8-pool ovn-k8-pool-peer -- "
+                "set interface %s %s"
+                % (veth_outside, vlan, veth_outside, veth_outside,
+                   external_ids))
+    return ("add-port %s %s tag=%s -- set interface %s %s"
+            % (lport_shard(lport_details)["bridge"], veth_outside, vlan,
+               veth_outside, external_ids))
+
+
+def pod_security_group(namespace, pod_name):
+    with span("step", "annotations"):
+        annotations = get_annotations(namespace, pod_name)
+    return (annotations or {}).get("security-group", "")
+
+
+def pod_attach(pid, container_id, lport, lport_details, security_group):
+    (veth_outside, pooled) = pod_link(pid, container_id, lport_details)
 
-    # Add the port to a OVS bridge and set the vlan
     try:
-        ovs_vsctl("add-port %s %s tag=%s -- set interface %s "
-                  "external_ids:lport_id=%s external_ids:ip_address=%s"
-                  % (OVN_BRIDGE, veth_outside, vlan, veth_outside, lport,
-                     ip_address))
+        with span("step", "ovs-port"):
+            ovs_vsctl(pod_port_command(container_id, lport, lport_details,
+                                       veth_outside, pooled,
+                                       security_group))
     except Exception as e:
+        pod_unlink(veth_outside, pooled)
         error = "failed to create a OVS port. (%s)" % (str(e))
         sys.exit(error)
 
-    command = "ovs-ofctl add-flow %s 'priority=65000,ipv6 actions=drop'" \
-              % (OVN_BRIDGE)
     try:
-        call_popen(shlex.split(command))
+        with span("step", "neighbor"):
+            neigh_update(add={lport_details['ip']: lport_details['mac']},
+                         device=lport_shard(lport_details)["device"])
     except Exception as e:
-        error = "Failed to add ipv6 disable (%s)" % (str(e))
+        error = "Failed to add ip neigh rules (%s)" % (str(e))
         sys.stderr.write(error)
 
-    # FIXME Add the correct linux bridge.
-    command = "ip neigh add %s lladdr %s dev breth1 nud perm" % (ip_address, mac)
+    pod_index_add(container_id, {"ip": lport_details['ip'],
+                                 "interface": veth_outside,
+                                 "lport_id": lport,
+                                 "vlan": lport_details['vlan'],
+                                 "shard": lport_details['shard'],
+                                 "security_group": security_group})
+
+
+def plugin_setup(args):
+    ns = args.k8_args[0]
+    pod_name = args.k8_args[1]
+    container_id = args.k8_args[2]
+
     try:
-        call_popen(shlex.split(command))
+        with span("step", "docker-inspect"):
+            pid = inspect_container(container_id)["pid"]
     except Exception as e:
-        error = "Failed to add ip neigh rules (%s)" % (str(e))
-        sys.stderr.write(error)
+        error = "failed to get container pid"
+        sys.exit(error)
+
+    if not FLOW_MONITOR:
+        try:
+            with span("step", "node-flows"):
+                node_flows_check()
+        except Exception as e:
+            error = "failed to program the node flows (%s)" % (str(e))
+            sys.stderr.write(error)
+
+    # The security group is recorded with the pod, so that teardown does
+    # not have to ask the API server again.
+    security_group = pod_security_group(ns, pod_name)
 
-    cache_mark_port_usage(lport, "yes")
+    # Choose an unused logical port and claim it. If the pod cannot be
+    # attached to it, give it back.
+    with span("step", "lport-claim"):
+        (lport, lport_details) = lport_pool_claim([container_id])[0]
+    if not lport:
+        sys.exit("No free lports available")
+
+    try:
+        pod_attach(pid, container_id, lport, lport_details, security_group)
+    except SystemExit:
+        cache_release_port(lport_details['vlan'], lport_details['shard'])
+        raise
 
-    annotations = get_annotations(ns, pod_name)
-    if annotations:
-        security_group = annotations.get("security-group", "")
-        if security_group:
+    if security_group:
+        with span("step", "security-group"):
             associate_security_group(lport, security_group)
 
 
+def pod_index_path(container_id):
+    return os.path.join(POD_INDEX_DIR, os.path.basename(container_id))
+
+
+def pod_index_add(container_id, record):
+    # Pod records are kept in memory and, so that separate plugin
+    # invocations and a restarted agent see them as well, in one small
+    # file per container.
+    POD_INDEX[container_id] = record
+    path = pod_index_path(container_id)
+    tmp = "%s.%d" % (path, os.getpid())
+    try:
+        if not os.path.isdir(POD_INDEX_DIR):
+            os.makedirs(POD_INDEX_DIR)
+        with open(tmp, "w") as fd:
+            json.dump(record, fd)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        sys.stderr.write("failed to record pod %s (%s)"
+                         % (container_id, str(e)))
+
+
+def pod_index_get(container_id):
+    record = POD_INDEX.get(container_id)
+    if record:
+        return record
+
+    try:
+        with open(pod_index_path(container_id)) as fd:
+            record = json.load(fd)
+    except (IOError, ValueError):
+        return None
+    POD_INDEX[container_id] = record
+    return record
+
+
+def pod_index_remove(container_id):
+    POD_INDEX.pop(container_id, None)
+    try:
+        os.unlink(pod_index_path(container_id))
+    except OSError:
+        pass
+
+
+def pod_status_all():
+    # Every pod on this node, from a single dump of the Interface table.
+    pods = []
+    for row in ovs_vsctl_list("interface", ["name", "external_ids"]):
+        ip_address = row["external_ids"].get("ip_address", "")
+        if not ip_address:
+            continue
+        pods.append({"container_id": row["external_ids"].get("container_id",
+                                                             ""),
+                     "interface": row["name"],
+                     "ip": ip_address})
+    return pods
+
+
+def pod_reconcile():
+    # Rebuilds the local state after a restart from a single dump of the
+    # Interface table. A pod is alive as long as the outer end of its veth
+    # pair is, as the pair goes away with the pod's netns. The ports of
+    # the pods that are gone are deleted, the lport cache is made to
+    # match the ports that are left and the pod index is rebuilt from
+    # them. The lports of the pods that are gone that may have a security
+    # group are queued to have it taken off and stay claimed until then.
+    # Run it before any pod is set up: a port claimed by a setup that is
+    # still in progress would be taken as unused. Ports set up by older
+    # versions have no container id, so their interface's name stands in
+    # for it.
+    links = host_links()
+    pods = {}
+    stale = {}
+    for row in ovs_vsctl_list("interface", ["name", "external_ids"]):
+        external_ids = row["external_ids"]
+        if not external_ids.get("ip_address"):
+            continue
+        if not (external_ids.get("container_id") or
+                external_ids.get("lport_id")):
+            continue
+        container_id = external_ids.get("container_id") or row["name"]
+        if row["name"] in links:
+            pods[container_id] = (row["name"], external_ids)
+        else:
+            stale[container_id] = (row["name"], external_ids)
+
+    # Ports set up by older versions only have the lport's id.
+    vlans = {}
+    if os.path.exists(LPORT_CACHE):
+        for shard in range(len(lport_shards())):
+            for details in cache_ports(shard):
+                vlans[details["port_id"]] = (shard, int(details["vlan"]))
+
+    def lport_vlan(external_ids):
+        if external_ids.get("vlan"):
+            return (int(external_ids.get("lport_shard") or 0),
+                    int(external_ids["vlan"]))
+        return vlans.get(external_ids.get("lport_id"))
+
+    if stale:
+        ovs_vsctl(" -- ".join(["--if-exists del-port %s" % (name)
+                               for (name, ids) in stale.values()]))
+        for (container_id, (name, external_ids)) in stale.items():
+            key = lport_vlan(external_ids)
+            if (external_ids.get("security_group") != "" and
+                    external_ids.get("lport_id") and key):
+                security_group_queue_add(container_id,
+                                         external_ids["lport_id"],
+                                         key[1], key[0])
+    netns_prune()
+
+    if os.path.exists(LPORT_CACHE):
+        owners = {}
+        for (container_id, (name, external_ids)) in pods.items():
+            key = lport_vlan(external_ids)
+            if key:
+                owners[key] = str(container_id)
+        for entry in security_group_queue_entries():
+            owners[(int(entry["shard"]), int(entry["vlan"]))] = \
+                str(entry["container_id"])
+
+        for shard in range(len(lport_shards())):
+            pod_reconcile_cache(shard, owners)
+
+    for (container_id, (name, external_ids)) in pods.items():
+        if not external_ids.get("container_id"):
+            continue
+        record = {"ip": external_ids["ip_address"],
+                  "interface": name,
+                  "lport_id": external_ids.get("lport_id", ""),
+                  "vlan": external_ids.get("vlan", ""),
+                  "shard": external_ids.get("lport_shard", "0"),
+                  "security_group": external_ids.get("security_group")}
+        if pod_index_get(container_id) != record:
+            pod_index_add(container_id, record)
+    if os.path.isdir(POD_INDEX_DIR):
+        for name in os.listdir(POD_INDEX_DIR):
+            if name not in pods:
+                pod_index_remove(name)
+
+    return (len(pods), len(stale))
+
+
+def pod_reconcile_cache(shard, owners):
+    # Makes a shard's lport cache match 'owners', which maps (shard, vlan)
+    # to the container that has the port.
+    with cache_transaction(shard) as cache:
+        for vlan in range(1, MAX_VLAN + 1):
+            (state, prev_free, next_free, details) = \
+                cache_read_record(cache, vlan)
+            owner = owners.get((shard, vlan))
+            if state == PORT_USED and not owner:
+                cache_set_state(cache, vlan, PORT_FREE)
+                cache_push_free(cache, vlan)
+            elif state == PORT_FREE and owner:
+                cache_set_state(cache, vlan, PORT_USED, owner)
+                cache_unlink_free(cache, vlan)
+            elif state == PORT_USED and details["owner"] != owner:
+                cache_set_state(cache, vlan, PORT_USED, owner)
+
+
 def plugin_status(args):
+    if args.all:
+        print json.dumps(pod_status_all())
+        return
+
+    if len(args.k8_args) != 3:
+        sys.exit("status needs the namespace, pod name and container id")
     ns = args.k8_args[0]
     pod_name = args.k8_args[1]
     container_id = args.k8_args[2]
 
-    veth_outside = container_id[0:15]
-    ip_address = ovs_vsctl("--if-exists get interface %s "
-                           "external_ids:ip_address"
-                           % (veth_outside)).strip('"')
+    record = pod_index_get(container_id)
+    if record:
+        ip_address = record["ip"]
+    else:
+        (veth_outside, external_ids) = get_pod_interface(container_id)
+        ip_address = external_ids.get("ip_address", "")
     if ip_address:
         style = {"ip": ip_address}
         print json.dumps(style)
 
 
-def disassociate_security_group(lport_id):
+def security_group_queue_add(container_id, lport_id, vlan, shard):
+    # Queues the lport of a pod that is gone to have its security group
+    # taken off. The lport stays claimed, so that no other pod gets it
+    # with the group still on, until security_group_queue_run() has done
+    # that and released it.
+    entry = {"container_id": container_id, "lport_id": lport_id,
+             "vlan": str(vlan), "shard": str(shard)}
+    path = os.path.join(SECURITY_GROUP_QUEUE_DIR, lport_id)
+    tmp = "%s.%d" % (path, os.getpid())
     try:
-        neutron = neutron_login()
-    except Exception as e:
-        # XXX: This is not good enough. You need to make this lport
-        # unusable, if it did have a security profile.
-        sys.exit("disassociate_security_group: neutron login. (%s)" % (str(e)))
-
+        if not os.path.isdir(SECURITY_GROUP_QUEUE_DIR):
+            os.makedirs(SECURITY_GROUP_QUEUE_DIR)
+        with open(tmp, "w") as fd:
+            json.dump(entry, fd)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        sys.stderr.write("failed to queue lport %s (%s)"
+                         % (lport_id, str(e)))
+    if SECURITY_GROUP_QUEUE:
+        SECURITY_GROUP_QUEUE.wakeup.set()
+
+
+def security_group_queue_entries():
+    if not os.path.isdir(SECURITY_GROUP_QUEUE_DIR):
+        return []
+    entries = []
+    for name in sorted(os.listdir(SECURITY_GROUP_QUEUE_DIR)):
+        if "." in name:
+            continue
+        try:
+            with open(os.path.join(SECURITY_GROUP_QUEUE_DIR, name)) as fd:
+                entries.append(json.load(fd))
+        except (IOError, ValueError):
+            pass
+    return entries
+
+
+def security_group_queue_run():
+    # Takes the security group off every queued lport and puts the lport
+    # back in the cache. Entries that fail stay queued for the next run.
+    # Returns the number of lports done.
+    entries = security_group_queue_entries()
+    if not entries:
+        return 0
+
+    lock = os.path.join(SECURITY_GROUP_QUEUE_DIR, ".lock")
+    fd = os.open(lock, os.O_RDWR | os.O_CREAT, 0o600)
     try:
-        body = {'port': {'security_groups': []}}
-        update_port(lport_id, body)
-    except Exception as e:
-        # XXX: This is not good enough either.
-        sys.exit("disassociate_security_group: failed port disassociation")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Another process is at it.
+            return 0
+
+        neutron = neutron_worker_login()
+        done = 0
+        for entry in security_group_queue_entries():
+            try:
+                body = {'port': {'security_groups': []}}
+                neutron.update_port(entry["lport_id"], body)
+            except Exception as e:
+                # A port that is gone has no security group left.
+                if getattr(e, "status_code", None) != 404:
+                    sys.stderr.write("failed to take the security group "
+                                     "off lport %s (%s)\n"
+                                     % (entry["lport_id"], str(e)))
+                    continue
+
+            if os.path.exists(LPORT_CACHE):
+                cache_release_ports([entry["vlan"]], entry["shard"],
+                                    str(entry["container_id"]))
+            os.unlink(os.path.join(SECURITY_GROUP_QUEUE_DIR,
+                                   entry["lport_id"]))
+            done += 1
+        return done
+    finally:
+        os.close(fd)
+
+
+class SecurityGroupQueue(threading.Thread):
+    """Works off the security group queue in the agent, after every
+    teardown that adds to it and every 30 seconds while it is not
+    empty."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="security-group-queue")
+        self.daemon = True
+        self.wakeup = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                security_group_queue_run()
+            except Exception as e:
+                sys.stderr.write("security group queue: %s\n" % (str(e)))
+            self.wakeup.wait(30)
+            self.wakeup.clear()
+
+
+def start_security_group_queue():
+    global SECURITY_GROUP_QUEUE
+    SECURITY_GROUP_QUEUE = SecurityGroupQueue()
+    SECURITY_GROUP_QUEUE.start()
 
 
 def plugin_teardown(args):
@@ -549,36 +2538,426 @@ def plugin_teardown(args):
     pod_name = args.k8_args[1]
     container_id = args.k8_args[2]
 
-    veth_outside = container_id[0:15]
+    record = pod_index_get(container_id)
+    pod_index_remove(container_id)
+
+    if record and record.get("lport_id") and record.get("vlan"):
+        veth_outside = record["interface"]
+        external_ids = {"container_id": container_id,
+                        "lport_id": record["lport_id"],
+                        "vlan": record["vlan"],
+                        "lport_shard": record.get("shard", "0"),
+                        "security_group": record.get("security_group"),
+                        "ip_address": record["ip"]}
+    else:
+        with span("step", "ovs-lookup"):
+            (veth_outside, external_ids) = get_pod_interface(container_id)
+    if not veth_outside:
+        return
 
-    lport = ovs_vsctl("--if-exists get interface %s external_ids:lport_id"
-                      % (veth_outside)).strip('"')
+    lport = external_ids.get("lport_id", "")
     if not lport:
         return
 
-    command = "ip link delete %s" % (veth_outside)
+    vlan = external_ids.get("vlan", "")
+    if not vlan:
+        vlan = ovs_vsctl("get port %s tag" % (veth_outside))
+    shard = int(external_ids.get("lport_shard") or 0)
+
     try:
-        call_popen(shlex.split(command))
+        with span("step", "link-delete"):
+            pod_link_delete(veth_outside)
     except Exception as e:
         error = "Failed to delete veth_outside (%s)" % (str(e))
         sys.stderr.write(error)
 
     try:
-        ovs_vsctl("del-port %s" % (veth_outside))
+        with span("step", "ovs-port"):
+            ovs_vsctl("del-port %s" % (veth_outside))
     except Exception as e:
         error = "failed to delete OVS port (%s)" % (veth_outside)
         sys.stderr.write(error)
 
-    annotations = get_annotations(ns, pod_name)
-    if annotations:
-        security_group = annotations.get("security-group", "")
-        if security_group:
-            disassociate_security_group(lport)
+    ip_address = external_ids.get("ip_address", "")
+    if ip_address:
+        try:
+            with span("step", "neighbor"):
+                neigh_update(remove=[ip_address],
+                             device=lport_shards()[shard]["device"])
+        except Exception as e:
+            error = "Failed to delete ip neigh rules (%s)" % (str(e))
+            sys.stderr.write(error)
+
+    # Everything above is local. Taking the security group off, if the pod
+    # had one or its ports predate recording it, is left to the queue.
+    # The lports of ports set up by older versions are claimed in the name
+    # of the interface, see pod_reconcile().
+    if external_ids.get("security_group") != "":
+        with span("step", "security-group"):
+            security_group_queue_add(external_ids.get("container_id") or
+                                     veth_outside, lport, vlan, shard)
+        return
 
-    cache_mark_port_usage(lport, "no")
+    with span("step", "lport-release"):
+        cache_release_port(vlan, shard)
 
 
-def main():
+def pod_batch_parse(args):
+    # Pods are given as NAMESPACE/POD/CONTAINER_ID, on the command line
+    # and, one per line, in --file.
+    entries = list(args.pods)
+    if args.file:
+        if args.file == "-":
+            entries.extend(sys.stdin.read().split())
+        else:
+            with open(args.file) as fd:
+                entries.extend(fd.read().split())
+
+    pods = []
+    for entry in entries:
+        fields = entry.split("/")
+        if len(fields) != 3 or not all(fields):
+            sys.exit("%s is not NAMESPACE/POD/CONTAINER_ID" % (entry))
+        pods.append(tuple(fields))
+    return pods
+
+
+def pod_batch_run(function, pods, workers):
+    # Calls function(pod) for every pod, at most 'workers' at a time.
+    # Returns a (result, error) per pod.
+    from multiprocessing.pool import ThreadPool
+
+    command = getattr(SPAN_CONTEXT, "command", "background")
+
+    def run(pod):
+        SPAN_CONTEXT.command = command
+        SPAN_CONTEXT.container_id = pod[2]
+        try:
+            return (function(pod), None)
+        except SystemExit as e:
+            return (None, str(e.code) if e.code else None)
+        except Exception as e:
+            return (None, str(e))
+
+    if not pods:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(pods))))
+    try:
+        return pool.map(run, pods)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def pod_batch_report(pods, errors):
+    for pod in pods:
+        if pod in errors:
+            sys.stderr.write("%s/%s: %s\n" % (pod[0], pod[1], errors[pod]))
+    if errors:
+        sys.exit("%d of %d pods failed" % (len(errors), len(pods)))
+
+
+def pod_interfaces():
+    # Every interface with its external_ids, by container id and by name,
+    # from a single dump of the Interface table.
+    interfaces = {}
+    for row in ovs_vsctl_list("interface", ["name", "external_ids"]):
+        interfaces[row["name"]] = (row["name"], row["external_ids"])
+        container_id = row["external_ids"].get("container_id")
+        if container_id:
+            interfaces[container_id] = (row["name"], row["external_ids"])
+    return interfaces
+
+
+def plugin_setup_batch(args):
+    pods = pod_batch_parse(args)
+    errors = {}
+
+    if not FLOW_MONITOR:
+        try:
+            with span("step", "node-flows"):
+                node_flows_check()
+        except Exception as e:
+            error = "failed to program the node flows (%s)" % (str(e))
+            sys.stderr.write(error)
+
+    # All the lports are claimed in one cache transaction, and the ones of
+    # pods that end up not attached are given back in another.
+    with span("step", "lport-claim"):
+        claims = dict(zip(pods, lport_pool_claim([pod[2] for pod in pods])))
+
+    def link(pod):
+        (lport, lport_details) = claims[pod]
+        if not lport:
+            sys.exit("No free lports available")
+        try:
+            with span("step", "docker-inspect"):
+                pid = inspect_container(pod[2])["pid"]
+        except Exception:
+            error = "failed to get container pid"
+            sys.exit(error)
+        security_group = pod_security_group(pod[0], pod[1])
+        return pod_link(pid, pod[2], lport_details) + (security_group,)
+
+    links = {}
+    for (pod, (result, error)) in zip(pods, pod_batch_run(link, pods,
+                                                          args.workers)):
+        if error:
+            errors[pod] = error
+        else:
+            links[pod] = result
+
+    # Attach all the ports in one transaction. Should that fail, attach
+    # them one by one so that one bad pod does not fail the others.
+    commands = {}
+    for (pod, (veth_outside, pooled, security_group)) in links.items():
+        (lport, lport_details) = claims[pod]
+        commands[pod] = pod_port_command(pod[2], lport, lport_details,
+                                         veth_outside, pooled,
+                                         security_group)
+    if commands:
+        try:
+            with span("step", "ovs-port"):
+                ovs_vsctl(" -- ".join(commands.values()))
+        except Exception:
+            for (pod, command) in commands.items():
+                try:
+                    ovs_vsctl(command)
+                except Exception as e:
+                    errors[pod] = ("failed to create a OVS port. (%s)"
+                                   % (str(e)))
+    attached = [pod for pod in pods if pod in links and pod not in errors]
+    for pod in links:
+        if pod in errors:
+            pod_unlink(links[pod][0], links[pod][1])
+
+    neighbors = {}
+    for pod in attached:
+        (lport, lport_details) = claims[pod]
+        device = lport_shard(lport_details)["device"]
+        neighbors.setdefault(device, {})[lport_details['ip']] = \
+            lport_details['mac']
+        pod_index_add(pod[2], {"ip": lport_details['ip'],
+                               "interface": links[pod][0],
+                               "lport_id": lport,
+                               "vlan": lport_details['vlan'],
+                               "shard": lport_details['shard'],
+                               "security_group": links[pod][2]})
+    for (device, add) in neighbors.items():
+        try:
+            with span("step", "neighbor"):
+                neigh_update(add=add, device=device)
+        except Exception as e:
+            error = "Failed to add ip neigh rules (%s)" % (str(e))
+            sys.stderr.write(error)
+
+    unused = {}
+    for pod in pods:
+        (lport, lport_details) = claims[pod]
+        if pod not in attached and lport:
+            unused.setdefault(int(lport_details['shard']), []).append(
+                lport_details['vlan'])
+    for (shard, vlans) in unused.items():
+        with span("step", "lport-release"):
+            cache_release_ports(vlans, shard)
+
+    def secure(pod):
+        with span("step", "security-group"):
+            associate_security_group(claims[pod][0], links[pod][2])
+
+    secured = [pod for pod in attached if links[pod][2]]
+    for (pod, (result, error)) in zip(secured, pod_batch_run(secure,
+                                                             secured,
+                                                             args.workers)):
+        if error:
+            errors[pod] = error
+
+    pod_batch_report(pods, errors)
+
+
+def plugin_teardown_batch(args):
+    pods = pod_batch_parse(args)
+    errors = {}
+
+    for pod in pods:
+        pod_index_remove(pod[2])
+
+    with span("step", "ovs-lookup"):
+        interfaces = pod_interfaces()
+    ports = {}
+    for pod in pods:
+        (veth_outside, external_ids) = interfaces.get(
+                                            pod[2],
+                                            interfaces.get(pod[2][0:15],
+                                                           (None, {})))
+        if veth_outside and external_ids.get("lport_id"):
+            ports[pod] = (veth_outside, external_ids)
+    found = [pod for pod in pods if pod in ports]
+
+    # Ports whose pod had a security group, or that predate recording it,
+    # are queued to have it taken off instead of being released.
+    vlans = {}
+    neighbors = {}
+    queued = {}
+    for pod in found:
+        (veth_outside, external_ids) = ports[pod]
+        vlan = external_ids.get("vlan", "")
+        if not vlan:
+            vlan = ovs_vsctl("get port %s tag" % (veth_outside))
+        shard = int(external_ids.get("lport_shard") or 0)
+        if external_ids.get("security_group") != "":
+            queued[pod] = (external_ids.get("container_id") or veth_outside,
+                           external_ids["lport_id"], vlan, shard)
+        else:
+            vlans.setdefault(shard, []).append(vlan)
+        if external_ids.get("ip_address"):
+            neighbors.setdefault(lport_shards()[shard]["device"], []).append(
+                external_ids["ip_address"])
+
+    def unlink(pod):
+        try:
+            with span("step", "link-delete"):
+                pod_link_delete(ports[pod][0])
+        except Exception as e:
+            error = "Failed to delete veth_outside (%s)" % (str(e))
+            sys.stderr.write(error)
+
+    for (pod, (result, error)) in zip(found, pod_batch_run(unlink, found,
+                                                           args.workers)):
+        if error:
+            errors[pod] = error
+
+    if found:
+        try:
+            with span("step", "ovs-port"):
+                ovs_vsctl(" -- ".join(["--if-exists del-port %s"
+                                       % (ports[pod][0]) for pod in found]))
+        except Exception as e:
+            error = "failed to delete OVS ports (%s)" % (str(e))
+            sys.stderr.write(error)
+
+    for (device, remove) in neighbors.items():
+        try:
+            with span("step", "neighbor"):
+                neigh_update(remove=remove, device=device)
+        except Exception as e:
+            error = "Failed to delete ip neigh rules (%s)" % (str(e))
+            sys.stderr.write(error)
+
+    for (shard, shard_vlans) in vlans.items():
+        with span("step", "lport-release"):
+            cache_release_ports(shard_vlans, shard)
+
+    for (owner, lport, vlan, shard) in queued.values():
+        with span("step", "security-group"):
+            security_group_queue_add(owner, lport, vlan, shard)
+
+    pod_batch_report(pods, errors)
+
+
+class AgentOutput(object):
+    """Stands in for sys.stdout/sys.stderr inside the agent so that each
+    request thread writes into its own buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buf = StringIO.StringIO()
+
+    def release(self):
+        output = self.local.buf.getvalue()
+        self.local.buf = None
+        return output
+
+    def write(self, data):
+        buf = getattr(self.local, "buf", None)
+        if buf is None:
+            self.stream.write(data)
+        else:
+            buf.write(data)
+
+    def flush(self):
+        if getattr(self.local, "buf", None) is None:
+            self.stream.flush()
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class AgentHandler(SocketServer.StreamRequestHandler):
+    """Runs one shim request, i.e. a JSON object with the command line
+    that kubelet handed to the shim, and replies with its exit status and
+    output."""
+
+    def handle(self):
+        try:
+            argv = json.loads(self.rfile.readline())["argv"]
+        except Exception as e:
+            sys.stderr.write("agent: malformed request (%s)\n" % (str(e)))
+            return
+
+        sys.stdout.capture()
+        sys.stderr.capture()
+        status = 0
+        try:
+            args = get_parser().parse_args(argv)
+            if args.func == plugin_agent:
+                sys.exit("agent is already running")
+            run_command(args)
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                sys.stderr.write("%s\n" % (e.code))
+                status = 1
+        except Exception as e:
+            sys.stderr.write("%s failed (%s)\n" % (" ".join(argv), str(e)))
+            status = 1
+
+        reply = {"status": status,
+                 "stdout": sys.stdout.release(),
+                 "stderr": sys.stderr.release()}
+        self.wfile.write(json.dumps(reply) + "\n")
+
+
+def plugin_agent(args):
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    sys.stdout = AgentOutput(sys.stdout)
+    sys.stderr = AgentOutput(sys.stderr)
+
+    start_ovsdb_replica()
+
+    try:
+        with span("step", "reconcile"):
+            pod_reconcile()
+    except Exception as e:
+        sys.stderr.write("reconcile: %s\n" % (str(e)))
+
+    start_pod_informer()
+    ContainerWatcher().start()
+    start_veth_pool()
+    start_lport_pool()
+    start_security_group_queue()
+    start_flow_monitor()
+
+    try:
+        neigh_sync()
+    except Exception as e:
+        sys.stderr.write("neighbor sync: %s\n" % (str(e)))
+
+    server = AgentServer(args.socket, AgentHandler)
+    os.chmod(args.socket, 0o600)
+    server.serve_forever()
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(title='Subcommands',
                                        dest='command_name')
@@ -594,12 +2973,38 @@ def main():
                                       help="The subnet CIDR for this network")
     parser_lswitch_setup.add_argument('router_id', metavar="ROUTER",
                                       help="The router the switch atteches to")
+    parser_lswitch_setup.add_argument('--chunk-size', type=int, default=100,
+                                      help="lports created per Neutron "
+                                      "bulk request (default: 100)")
+    parser_lswitch_setup.add_argument('--workers', type=int, default=8,
+                                      help="concurrent Neutron requests "
+                                      "(default: 8)")
+    parser_lswitch_setup.add_argument('--pool-size', type=int, default=0,
+                                      help="create only this many lports "
+                                      "now and keep about as many free "
+                                      "(default: all the subnet's lports)")
+    parser_lswitch_setup.add_argument('--pool-low', type=int,
+                                      help="top the free lports up once "
+                                      "fewer are left (default: a quarter "
+                                      "of the pool size)")
+    parser_lswitch_setup.add_argument('--pool-high', type=int,
+                                      help="delete free lports above this "
+                                      "many (default: twice the pool size)")
+    parser_lswitch_setup.add_argument('--shard', action='append',
+                                      metavar="VIF_ID,BRIDGE,DEVICE",
+                                      help="another parent VIF for pods, "
+                                      "with its own 4095 vlans, the bridge "
+                                      "it is on and the device for its "
+                                      "neighbor entries (repeatable)")
     parser_lswitch_setup.set_defaults(func=lswitch_setup)
 
     # Parser for sub-command lswitch-destroy
     parser_lswitch_destroy = subparsers.add_parser(
                                 'lswitch-destroy', help="Delete the lswitch"
                                 "created for this node and all its lports")
+    parser_lswitch_destroy.add_argument('--workers', type=int, default=8,
+                                        help="concurrent Neutron requests "
+                                        "(default: 8)")
     parser_lswitch_destroy.set_defaults(func=lswitch_destroy)
 
     # Parser for sub-command init
@@ -616,8 +3021,11 @@ def main():
     # Parser for sub-command status
     parser_plugin_status = subparsers.add_parser('status',
                                                  help="pod status")
-    parser_plugin_status.add_argument('k8_args', nargs=3,
+    parser_plugin_status.add_argument('k8_args', nargs='*',
                                       help='arguments passed by kubectl')
+    parser_plugin_status.add_argument('--all', action='store_true',
+                                      help="status of every pod on this "
+                                      "node, as JSON")
     parser_plugin_status.set_defaults(func=plugin_status)
 
     # Parser for sub-command teardown
@@ -627,8 +3035,37 @@ def main():
                                         help='arguments passed by kubectl')
     parser_plugin_teardown.set_defaults(func=plugin_teardown)
 
-    args = parser.parse_args()
-    args.func(args)
+    # Parsers for sub-commands setup-batch and teardown-batch
+    for (name, func, action) in (('setup-batch', plugin_setup_batch,
+                                  "Set up"),
+                                 ('teardown-batch', plugin_teardown_batch,
+                                  "Tear down")):
+        parser_batch = subparsers.add_parser(
+                            name, help="%s many pods at once" % (action))
+        parser_batch.add_argument('pods', nargs='*',
+                                  metavar="NAMESPACE/POD/CONTAINER_ID")
+        parser_batch.add_argument('--file', help="file with more pods, "
+                                  "one per line ('-' for stdin)")
+        parser_batch.add_argument('--workers', type=int, default=8,
+                                  help="pods worked on in parallel "
+                                  "(default: 8)")
+        parser_batch.set_defaults(func=func)
+
+    # Parser for sub-command agent
+    parser_plugin_agent = subparsers.add_parser(
+                                'agent', help="Run as a long lived node "
+                                "agent serving the kubelet shim")
+    parser_plugin_agent.add_argument('--socket', default=AGENT_SOCKET,
+                                     help="unix socket to listen on "
+                                     "(default: %s)" % AGENT_SOCKET)
+    parser_plugin_agent.set_defaults(func=plugin_agent)
+
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    run_command(args)
 
 if __name__ == '__main__':
     main()